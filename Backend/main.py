@@ -1,12 +1,128 @@
+import argparse
+import os
 from modules import ServerClasses
-from modules.database import Database
+from modules.Attachments import AttachmentStore
+from modules.EphemeralStore import EphemeralStore
+from modules.database import DatabaseEvents, ShardRouter
+from modules.database.Replication import ReplicaFollower
+from modules.RateLimiter import RateLimiter
+from modules.Scheduler import MaintenanceScheduler
+from modules.StaticFiles import StaticFiles
+from modules.Tracing import Tracer
 
 PORT = 9042
+SHARD_COUNT = 4
+# 'binary' or 'json'; both are read back, this only picks what save() writes
+STORAGE_FORMAT = 'binary'
+COMPRESSION_LEVEL = 6
+
+# requests per second and burst size, per user token (or client ip when logged out)
+RATE_LIMIT = (20, 40)
+ROUTE_RATE_LIMITS = {
+    '/createUserAccount': (0.2, 3),
+    '/login': (1, 5),
+    '/createServer': (0.2, 3),
+    '/createChannel': (1, 5),
+    '/createInvite': (1, 5),
+    '/sendMessage': (5, 10),
+    '/sendDM': (5, 10),
+    '/editMessage': (5, 10),
+    '/deleteMessage': (5, 10),
+    '/setTyping': (1, 5),
+    '/setPresence': (1, 5),
+    '/uploadAttachment': (0.5, 5),
+    '/exportMessages': (0.1, 2),
+}
+MAX_IN_FLIGHT = 64
+WORKERS = 16
+QUEUE_SIZE = 128
+MAX_NONCES = 100_000
+
+FRONTEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Frontend')
+# uploaded files, stored by content hash; replicas can point at the same directory
+ATTACHMENTS_DIR = 'attachments'
+MAX_ATTACHMENT_SIZE = 64 * 1024 * 1024
+
+# messages older than this move from memory to compressed segment files
+ARCHIVE_AFTER = 30 * 24 * 3600
+ARCHIVE_INTERVAL = 3600
+# memory for the newest rows of recently read channels, which serve the latest page without a table scan
+HOT_TAIL_MB = 64
+# maintenance waits while more than this fraction of MAX_IN_FLIGHT requests are running
+MAINTENANCE_MAX_LOAD = 0.5
+# the update/delete log is folded into the main file once it grows past this
+CHECKPOINT_LOG_BYTES = 1024 * 1024
+
+parser = argparse.ArgumentParser(description="Freecord backend server")
+parser.add_argument('--port', type=int, default=PORT)
+parser.add_argument('--replica-of', metavar='URL', default=None,
+                    help="run as a read-only replica of the primary at URL, e.g. http://127.0.0.1:9042")
+parser.add_argument('--workers', type=int, default=WORKERS,
+                    help="size of the request worker pool, 0 starts one thread per request")
+parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                    help="connections waiting for a worker before new ones get a 503")
+parser.add_argument('--frontend', metavar='DIR', default=FRONTEND_DIR,
+                    help="directory with the frontend files served for non-API GET requests")
+parser.add_argument('--attachments', metavar='DIR', default=ATTACHMENTS_DIR,
+                    help="directory where uploaded attachments are stored")
+parser.add_argument('--storage-format', choices=('binary', 'json'), default=STORAGE_FORMAT,
+                    help="on-disk format for the database files, existing files are converted on their next save")
+parser.add_argument('--compression-level', type=int, choices=range(0, 10), default=COMPRESSION_LEVEL, metavar='0-9',
+                    help="zlib level used when saving, lower is faster and larger")
+parser.add_argument('--hot-tail-mb', type=int, default=HOT_TAIL_MB,
+                    help="memory cap of the cache holding the newest messages of recently read channels")
+parser.add_argument('--trace', action='store_true',
+                    help="trace every request and log the slow ones to slow_requests.log")
+parser.add_argument('--slow-ms', type=float, default=250,
+                    help="requests slower than this are written to the slow request log")
+parser.add_argument('--profile-rate', type=float, default=0.0,
+                    help="fraction of traced requests to run under cProfile, kept only when slow")
+
+args, _ = parser.parse_known_args()
 
 server = ServerClasses.MessageServer()
-db = Database.FreecordDB("freecord_data")
+rate_limiter = RateLimiter(*RATE_LIMIT, route_limits=ROUTE_RATE_LIMITS, max_in_flight=MAX_IN_FLIGHT)
+static_files = StaticFiles(args.frontend) if os.path.isdir(args.frontend) else None
+tracer = Tracer(args.slow_ms, profile_rate=args.profile_rate) if args.trace else None
+# presence and typing state, kept in memory only and never saved
+ephemeral = EphemeralStore()
+# recent client nonces of sendMessage / sendDM, so retried sends are not stored twice
+nonces = EphemeralStore(max_keys=MAX_NONCES)
+attachments = AttachmentStore(args.attachments, MAX_ATTACHMENT_SIZE)
+if args.replica_of:
+    db = ShardRouter.ShardedFreecordDB("freecord_replica", SHARD_COUNT, in_memory=True,
+                                       archive_path="freecord_data.segments",
+                                       hot_tail_bytes=args.hot_tail_mb * 1024 * 1024)
+    replica = ReplicaFollower(args.replica_of, db)
+else:
+    db = ShardRouter.ShardedFreecordDB("freecord_data", SHARD_COUNT, storage_format=args.storage_format,
+                                       compression_level=args.compression_level,
+                                       hot_tail_bytes=args.hot_tail_mb * 1024 * 1024)
+    replica = None
+
+# each task gets a deadline of now + budget and stops at its next shard or batch boundary once it passes;
+# one shard save, the search index write and the ephemeral purge always run to the end, so budgets are soft
+scheduler = MaintenanceScheduler(load=lambda: rate_limiter.in_flight / rate_limiter.max_in_flight,
+                                 max_load=MAINTENANCE_MAX_LOAD)
+scheduler.add('prune_token_cache', lambda deadline: DatabaseEvents.prune_token_cache(deadline=deadline), 60, budget=0.05)
+scheduler.add('purge_ephemeral', lambda deadline: ephemeral.purge() + nonces.purge(), 30, budget=0.05)
+if replica is None:
+    scheduler.add('expire_invites', lambda deadline: db.expire_invites(deadline=deadline), 60, budget=0.2)
+    scheduler.add('checkpoint', lambda deadline: db.checkpoint(CHECKPOINT_LOG_BYTES, deadline), 300, budget=1.0)
+    # drops the rows deleted since the last run and folds the delete log into the files
+    scheduler.add('compact', lambda deadline: db.compact(deadline), 3600, budget=1.0)
+    scheduler.add('archive', lambda deadline: db.archive_messages(ARCHIVE_AFTER, deadline), ARCHIVE_INTERVAL,
+                  budget=2.0)
+    scheduler.add('save_search', lambda deadline: db.search.save(), 600, budget=1.0)
 
 def main():
+    if replica is not None:
+        replica.start()
+        scheduler.start()
+        server.start(args.port, db, replica, rate_limiter, args.workers, args.queue_size, static_files, tracer,
+                     ephemeral, attachments, nonces, scheduler)
+        return
+
     if db.exists_table('users') == False:
         db.create_table('users')
 
@@ -31,22 +147,39 @@ def main():
     if db.exists_table('dm_messages') == False:
         db.create_table('dm_messages')
 
+    if db.exists_table('read_states') == False:
+        db.create_table('read_states')
+
+    if db.exists_table('attachment_refs') == False:
+        db.create_table('attachment_refs')
+        DatabaseEvents.backfill_attachment_refs(db)
+
     print("db info ", db.get_info())
 
-    server.start(PORT, db)
+    scheduler.start()
+
+    server.start(args.port, db, None, rate_limiter, args.workers, args.queue_size, static_files, tracer,
+                 ephemeral, attachments, nonces, scheduler)
 
 if __name__ == "__main__":
-    print(f"Server is running on port {PORT}. Press Ctrl+C to stop.")
+    role = f"replica of {args.replica_of}" if replica is not None else "primary"
+    print(f"Server is running on port {args.port} ({role}). Press Ctrl+C to stop.")
 
     try:
         main()
     except KeyboardInterrupt:
         print("\nStopping server...")
+        scheduler.stop()
+        if replica is not None:
+            replica.stop()
         db.close()
         server.stop()
         print("Server stopped. database saved")
     except Exception as e:
         print(f"An error occurred: {e}")
+        scheduler.stop()
+        if replica is not None:
+            replica.stop()
         db.close()
         server.stop()
         print("Server stopped due to error. database saved")
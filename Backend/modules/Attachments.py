@@ -0,0 +1,133 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from modules.StaticFiles import send_file
+
+ATTACHMENT_ID_RE = re.compile(r'^[0-9a-f]{64}$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class UploadError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class AttachmentStore:
+    def __init__(self, root: str, max_size: int = 64 * 1024 * 1024, chunk_size: int = 64 * 1024):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self._tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def path_for(self, attachment_id: str) -> str | None:
+        if not ATTACHMENT_ID_RE.match(attachment_id):
+            return None
+        return os.path.join(self.root, attachment_id[:2], attachment_id)
+
+    def exists(self, attachment_id: str) -> bool:
+        path = self.path_for(attachment_id)
+        return path is not None and os.path.isfile(path)
+
+    def store(self, stream, length: int) -> tuple[str, int]:
+        if length > self.max_size:
+            raise UploadError(413, f"Attachments are limited to {self.max_size} bytes")
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = stream.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        raise UploadError(400, "Upload ended before Content-Length bytes were sent")
+                    digest.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+            attachment_id = digest.hexdigest()
+            path = self.path_for(attachment_id)
+            assert path is not None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self._lock:
+                self.bytes_in += length
+                if os.path.exists(path):
+                    self.deduplicated += 1
+                    os.remove(tmp_path)
+                else:
+                    self.stored += 1
+                    os.replace(tmp_path, path)
+            return attachment_id, length
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def serve(self, handler, attachment_id: str, head_only: bool = False) -> None:
+        path = self.path_for(attachment_id)
+        if path is None or not os.path.isfile(path):
+            handler.send_error(404, "Attachment not found")
+            return
+
+        size = os.path.getsize(path)
+        # the id is the content hash, so a cached copy never goes stale
+        etag = f'"{attachment_id}"'
+        if etag in handler.headers.get('If-None-Match', ''):
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = handler.headers.get('Range')
+        if range_header and handler.headers.get('If-Range', etag) == etag:
+            match = RANGE_RE.match(range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start > end or start >= size:
+                    handler.send_response(416)
+                    handler.send_header('Content-Range', f'bytes */{size}')
+                    handler.send_header('Content-Length', '0')
+                    handler.end_headers()
+                    return
+                status = 206
+
+        count = end - start + 1 if size else 0
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.send_header('Content-Length', str(count))
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('ETag', etag)
+        handler.send_header('Cache-Control', 'private, max-age=31536000, immutable')
+        if status == 206:
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        handler.end_headers()
+        if head_only or count == 0:
+            return
+
+        send_file(handler, path, start, count)
+        with self._lock:
+            self.bytes_out += count
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'stored': self.stored,
+                'deduplicated': self.deduplicated,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
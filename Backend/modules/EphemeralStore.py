@@ -0,0 +1,114 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Hashable
+
+class EphemeralStore:
+    def __init__(self, default_ttl: float = 60.0, max_keys: int | None = None):
+        self.default_ttl = default_ttl
+        # when full, the keys closest to expiring are dropped first
+        self.max_keys = max_keys
+        # namespace -> key -> (value, expires_at)
+        self._data: dict[Hashable, dict[Hashable, tuple[Any, float]]] = {}
+        # (expires_at, tiebreak, namespace, key); refreshed keys leave stale entries that are skipped when popped
+        self._heap: list[tuple[float, int, Hashable, Hashable]] = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.sets = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _pop_oldest(self) -> bool:
+        expires_at, _, namespace, key = heapq.heappop(self._heap)
+        entries = self._data.get(namespace)
+        if entries is None:
+            return False
+        entry = entries.get(key)
+        if entry is None or entry[1] != expires_at:
+            return False
+        del entries[key]
+        self._size -= 1
+        if not entries:
+            del self._data[namespace]
+        return True
+
+    def _expire(self, now: float) -> None:
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            if self._pop_oldest():
+                self.expired += 1
+
+    def _store(self, namespace: Hashable, key: Hashable, value: Any, expires_at: float) -> None:
+        entries = self._data.setdefault(namespace, {})
+        if key not in entries:
+            self._size += 1
+        entries[key] = (value, expires_at)
+        heapq.heappush(self._heap, (expires_at, next(self._counter), namespace, key))
+        self.sets += 1
+        if self.max_keys is not None:
+            while self._size > self.max_keys:
+                if self._pop_oldest():
+                    self.evicted += 1
+
+    def set(self, namespace: Hashable, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        now = time.monotonic()
+        expires_at = now + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._expire(now)
+            self._store(namespace, key, value, expires_at)
+
+    def add(self, namespace: Hashable, key: Hashable, value: Any, ttl: float | None = None) -> tuple[bool, Any]:
+        # set only if the key is absent; returns (added, the value now stored)
+        now = time.monotonic()
+        expires_at = now + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._expire(now)
+            entry = self._data.get(namespace, {}).get(key)
+            if entry is not None:
+                return False, entry[0]
+            self._store(namespace, key, value, expires_at)
+            return True, value
+
+    def get(self, namespace: Hashable, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._data.get(namespace, {}).get(key)
+            return default if entry is None else entry[0]
+
+    def delete(self, namespace: Hashable, key: Hashable) -> bool:
+        with self._lock:
+            entries = self._data.get(namespace)
+            if not entries or entries.pop(key, None) is None:
+                return False
+            self._size -= 1
+            if not entries:
+                del self._data[namespace]
+            return True
+
+    def items(self, namespace: Hashable) -> dict[Hashable, Any]:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            return {key: value for key, (value, _) in self._data.get(namespace, {}).items()}
+
+    def purge(self) -> int:
+        # expiry otherwise only happens on access, so idle namespaces would hold memory
+        with self._lock:
+            before = self._size
+            self._expire(time.monotonic())
+            return before - self._size
+
+    def metrics(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                'namespaces': len(self._data),
+                'keys': self._size,
+                'heap': len(self._heap),
+                'sets': self.sets,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
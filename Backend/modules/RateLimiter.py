@@ -0,0 +1,97 @@
+import threading
+import time
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        # refills without taking, so a request can be checked against several buckets first
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class RateLimiter:
+    def __init__(self, rate: float = 20, burst: float = 40,
+                 route_limits: dict[str, tuple[float, float]] | None = None,
+                 max_in_flight: int = 64):
+        self.rate = rate
+        self.burst = burst
+        self.route_limits = route_limits or {}
+        self.max_in_flight = max_in_flight
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._checks = 0
+        self.in_flight = 0
+        self.allowed = 0
+        self.limited = 0
+        self.shed = 0
+        self.limited_by_route: dict[str, int] = {}
+
+    def enter(self) -> bool:
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def _bucket(self, key: tuple[str, str], rate: float, burst: float, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def check(self, client_key: str, route: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._checks += 1
+            if self._checks % 4096 == 0:
+                self._prune(now)
+
+            buckets = [self._bucket((client_key, ''), self.rate, self.burst, now)]
+            if route in self.route_limits:
+                route_rate, route_burst = self.route_limits[route]
+                buckets.append(self._bucket((client_key, route), route_rate, route_burst, now))
+
+            # a token is only spent when every bucket allows the request, a 429 costs the client nothing
+            retry_after = max(bucket.wait(now) for bucket in buckets)
+            if retry_after == 0:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+
+            if retry_after > 0:
+                self.limited += 1
+                self.limited_by_route[route] = self.limited_by_route.get(route, 0) + 1
+            else:
+                self.allowed += 1
+            return retry_after
+
+    def _prune(self, now: float) -> None:
+        self._buckets = {key: b for key, b in self._buckets.items() if not b.is_full(now)}
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'allowed': self.allowed,
+                'limited': self.limited,
+                'shed': self.shed,
+                'limited_by_route': dict(self.limited_by_route),
+                'tracked_buckets': len(self._buckets),
+            }
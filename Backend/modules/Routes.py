@@ -0,0 +1,166 @@
+import threading
+from typing import Any, Callable, Mapping
+
+def _to_int(value: Any) -> int:
+    if isinstance(value, bool):
+        raise ValueError(value)
+    return int(value)
+
+def _to_float(value: Any) -> float:
+    if isinstance(value, bool):
+        raise ValueError(value)
+    return float(value)
+
+def _to_str(value: Any) -> str:
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if value in ('1', 'true'):
+        return True
+    if value in ('0', 'false'):
+        return False
+    raise ValueError(value)
+
+def _to_int_list(value: Any) -> list[int]:
+    items = value.split(',') if isinstance(value, str) else value
+    if not isinstance(items, list):
+        raise ValueError(value)
+    return [_to_int(item) for item in items if item != '']
+
+def _to_str_list(value: Any) -> list[str]:
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(value)
+    return value
+
+# type -> (coerce, what the error message says it must be)
+PARAM_TYPES: dict[Any, tuple[Callable[[Any], Any], str]] = {
+    int: (_to_int, "an integer"),
+    float: (_to_float, "a number"),
+    str: (_to_str, "a string"),
+    bool: (_to_bool, "true or false"),
+    'ints': (_to_int_list, "comma separated integers"),
+    'strings': (_to_str_list, "a list of strings"),
+}
+
+class Param:
+    __slots__ = ('name', 'dest', 'coerce', 'type_name', 'required', 'default', 'choices', 'missing', 'invalid')
+
+    def __init__(self, name: str, kind: Any = int, required: bool = True, default: Any = None,
+                 dest: str | None = None, choices: tuple | None = None, missing: str | None = None,
+                 invalid: str | None = None):
+        self.name = name
+        self.dest = dest or name
+        self.coerce, self.type_name = PARAM_TYPES[kind]
+        self.required = required
+        self.default = default
+        self.choices = choices
+        # error texts clients already match on, used instead of the generated ones when set
+        self.missing = missing
+        self.invalid = invalid
+
+class Route:
+    __slots__ = ('method', 'path', 'handler', 'params', 'auth', 'body', 'write', 'one_of', 'admission',
+                 'primary_only', '_missing_suffix', 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, method: str, path: str, handler: Callable, params: tuple[Param, ...] = (),
+                 auth: bool = True, body: bool = False, write: bool = False, one_of: tuple[str, ...] = (),
+                 admission: bool = True, primary_only: bool = False):
+        self.method = method
+        self.path = path
+        self.handler = handler
+        self.params = params
+        self.auth = auth
+        # json body routes read their params from the body, everything else from the query string
+        self.body = body
+        self.write = write
+        self.one_of = one_of
+        # False keeps the route out of in-flight accounting and rate limits
+        self.admission = admission
+        # state kept only in the primary's memory, a replica has nothing to answer with
+        self.primary_only = primary_only
+        self._missing_suffix = '' if body else ' query parameter'
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def parse(self, source: Mapping[str, Any]) -> tuple[dict[str, Any], str | None]:
+        values: dict[str, Any] = {}
+        for param in self.params:
+            value = source.get(param.name)
+            if value is None or value == '':
+                if param.required:
+                    return values, param.missing or f"Missing {param.name}{self._missing_suffix}"
+                values[param.dest] = param.default
+                continue
+            try:
+                value = param.coerce(value)
+            except (TypeError, ValueError):
+                return values, param.invalid or f"{param.name} must be {param.type_name}"
+            if param.choices is not None and value not in param.choices:
+                return values, param.invalid or f"{param.name} must be one of {', '.join(map(str, param.choices))}"
+            values[param.dest] = value
+
+        if self.one_of:
+            alternatives = [p for p in self.params if p.name in self.one_of]
+            if all(values[p.dest] is None for p in alternatives):
+                missing = next((p.missing for p in alternatives if p.missing), None)
+                return values, missing or f"Missing {' or '.join(self.one_of)}{self._missing_suffix}"
+        return values, None
+
+class RouteRegistry:
+    def __init__(self):
+        self._routes: dict[tuple[str, str], Route] = {}
+        self._methods: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+        # called as hook(route, status, seconds) after every routed request
+        self.hooks: list[Callable[[Route, int | None, float], None]] = []
+
+    def add(self, method: str, path: str, *params: Param, **options: Any) -> Callable[[Callable], Callable]:
+        def register(handler: Callable) -> Callable:
+            if (method, path) in self._routes:
+                raise ValueError(f"route {method} {path} is already registered")
+            self._routes[(method, path)] = Route(method, path, handler, params, **options)
+            self._methods.setdefault(path, set()).add(method)
+            return handler
+        return register
+
+    def get(self, path: str, *params: Param, **options: Any) -> Callable[[Callable], Callable]:
+        return self.add('GET', path, *params, **options)
+
+    def post(self, path: str, *params: Param, **options: Any) -> Callable[[Callable], Callable]:
+        options.setdefault('body', True)
+        options.setdefault('write', True)
+        return self.add('POST', path, *params, **options)
+
+    def find(self, method: str, path: str) -> Route | None:
+        return self._routes.get((method, path))
+
+    def methods(self, path: str) -> set[str]:
+        return self._methods.get(path, set())
+
+    def record(self, route: Route, status: int | None, elapsed: float) -> None:
+        with self._lock:
+            route.calls += 1
+            if status is None or status >= 500:
+                route.errors += 1
+            route.total_time += elapsed
+            route.max_time = max(route.max_time, elapsed)
+        for hook in self.hooks:
+            hook(route, status, elapsed)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                f"{route.method} {route.path}": {
+                    'calls': route.calls,
+                    'errors': route.errors,
+                    'avg_ms': round(route.total_time / route.calls * 1000, 3),
+                    'max_ms': round(route.max_time * 1000, 3),
+                }
+                for route in self._routes.values() if route.calls
+            }
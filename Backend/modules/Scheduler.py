@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from typing import Any, Callable
+
+class Task:
+    __slots__ = ('name', 'func', 'interval', 'budget', 'jitter', 'next_run', 'due_since', 'runs', 'failures',
+                 'deferred', 'over_budget', 'last_duration', 'last_result', 'last_error', 'last_error_at', 'last_run')
+
+    def __init__(self, name: str, func: Callable[[float], Any], interval: float, budget: float, jitter: float,
+                 now: float):
+        self.name = name
+        # called as func(deadline) with a time.monotonic() deadline; work left over waits for the next run.
+        # nothing interrupts func, the budget only holds if it checks the deadline, and overruns are counted
+        self.func = func
+        self.interval = interval
+        self.budget = budget
+        self.jitter = jitter
+        self.next_run = now + self._delay()
+        self.due_since: float | None = None
+        self.runs = 0
+        self.failures = 0
+        self.deferred = 0
+        self.over_budget = 0
+        self.last_duration = 0.0
+        self.last_result: Any = None
+        # kept after later successes, so a failure between two /metrics reads still shows up
+        self.last_error: str | None = None
+        self.last_error_at: float | None = None
+        self.last_run: float | None = None
+
+    def _delay(self) -> float:
+        # spreads tasks with the same interval so they don't all run on the same tick
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+class MaintenanceScheduler:
+    def __init__(self, load: Callable[[], float] | None = None, max_load: float = 0.5, tick: float = 1.0):
+        # load() returns how busy request handling is, 0.0 idle to 1.0 saturated
+        self.load = load
+        self.max_load = max_load
+        self.tick = tick
+        self._tasks: list[Task] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, name: str, func: Callable[[float], Any], interval: float, budget: float = 0.5,
+            jitter: float = 0.1) -> None:
+        with self._lock:
+            self._tasks.append(Task(name, func, interval, budget, jitter, time.monotonic()))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._loop, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.tick):
+            self.run_pending()
+
+    def run_pending(self, now: float | None = None) -> Task | None:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = [task for task in self._tasks if task.next_run <= now]
+        if not due:
+            return None
+        task = min(due, key=lambda t: t.next_run)
+        if task.due_since is None:
+            task.due_since = task.next_run
+
+        # under load the task waits, but never longer than one interval past its due time
+        if self.load is not None and self.load() > self.max_load and now - task.due_since < task.interval:
+            task.deferred += 1
+            task.next_run = now + self.tick
+            return None
+
+        # one task per tick, so back-to-back maintenance never stacks into one long stall
+        self._run(task, now)
+        return task
+
+    def _run(self, task: Task, now: float) -> None:
+        start = time.monotonic()
+        try:
+            task.last_result = task.func(start + task.budget)
+        except Exception as e:
+            task.failures += 1
+            task.last_error = f"{type(e).__name__}: {e}"
+            task.last_error_at = time.time()
+        task.last_duration = time.monotonic() - start
+        if task.last_duration > task.budget:
+            task.over_budget += 1
+        task.runs += 1
+        task.last_run = time.time()
+        task.due_since = None
+        task.next_run = now + task._delay()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            tasks = list(self._tasks)
+        now = time.monotonic()
+        return {
+            'load': round(self.load(), 3) if self.load is not None else None,
+            'tasks': {
+                task.name: {
+                    'interval': task.interval,
+                    'budget_ms': round(task.budget * 1000, 3),
+                    'runs': task.runs,
+                    'failures': task.failures,
+                    'deferred': task.deferred,
+                    'over_budget': task.over_budget,
+                    'last_duration_ms': round(task.last_duration * 1000, 3),
+                    'last_result': task.last_result,
+                    'last_error': task.last_error,
+                    'last_error_at': task.last_error_at,
+                    'last_run': task.last_run,
+                    'next_run_in': round(max(0.0, task.next_run - now), 3),
+                }
+                for task in tasks
+            },
+        }
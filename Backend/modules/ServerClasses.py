@@ -1,34 +1,193 @@
 import http.server
+import ipaddress
 import json
+import math
+import queue
 import socketserver
+import threading
+import time
+from typing import Iterator
 from urllib.parse import urlparse, parse_qs
-from modules.database import Database
-from modules import ServerEvents as Events
+from modules import ServerEvents as Events, Tracing
+from modules.database import ShardRouter
+from modules.database.Replication import ReplicaFollower
+from modules.Attachments import AttachmentStore, UploadError
+from modules.EphemeralStore import EphemeralStore
+from modules.RateLimiter import RateLimiter
+from modules.Routes import Param, Route, RouteRegistry
+from modules.Scheduler import MaintenanceScheduler
+from modules.StaticFiles import StaticFiles
+from modules.Tracing import Tracer
+
+# filled in by the @ROUTES.get / @ROUTES.post handlers of MessageServerHandler
+ROUTES = RouteRegistry()
+EXPORT_CHUNK_SIZE = 64 * 1024
+# longest a /replication/changes poll may block, the follower asks for 10s
+REPLICATION_MAX_WAIT = 10.0
+# error texts shared by the routes that take a message or a conversation reference
+MISSING_MESSAGE_REF = "Missing message_id, or channel_id / user_id"
+INVALID_MESSAGE_REF = "message_id, channel_id and user_id must be integers"
+INVALID_CONVERSATION = "channel_id and user_id must be integers"
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
-class MessageServerHandler(http.server.SimpleHTTPRequestHandler):
-    db: Database.FreecordDB | None = None
+class PooledTCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+    request_timeout = 30.0
+
+    def __init__(self, server_address, handler, workers: int = 16, queue_size: int = 128):
+        super().__init__(server_address, handler)
+        self.workers = workers
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self.accepted = 0
+        self.shed = 0
+        self.busy = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._threads = [
+            threading.Thread(target=self._work, name=f"freecord-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.request_timeout)
+        try:
+            self._queue.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self.shed += 1
+            self._reject(request)
+
+    def _reject(self, request):
+        try:
+            request.sendall(
+                b"HTTP/1.0 503 Service Unavailable\r\n"
+                b"Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address, queued_at = item
+            waited = time.monotonic() - queued_at
+            with self._stats_lock:
+                self.accepted += 1
+                self.busy += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._stats_lock:
+                    self.busy -= 1
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            return {
+                'mode': 'pool',
+                'workers': self.workers,
+                'busy_workers': self.busy,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self._queue.maxsize,
+                'accepted': self.accepted,
+                'shed': self.shed,
+                'avg_wait_ms': round(self.total_wait / self.accepted * 1000, 3) if self.accepted else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+            }
+
+class MessageServerHandler(http.server.BaseHTTPRequestHandler):
+    db: ShardRouter.ShardedFreecordDB | None = None
+    replica: ReplicaFollower | None = None
+    rate_limiter: RateLimiter | None = None
+    static_files: StaticFiles | None = None
+    tracer: Tracer | None = None
+    ephemeral: EphemeralStore | None = None
+    attachments: AttachmentStore | None = None
+    nonces: EphemeralStore | None = None
+    scheduler: MaintenanceScheduler | None = None
+    _request_id: str | None = None
+    _status: int | None = None
 
     def log_message(self, format, *args):
         pass
 
-    def list_directory(self, path):
-        self.send_error(403, "Directory listing not allowed")
-        return None
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+        if self._request_id is not None:
+            self.send_header('X-Request-Id', self._request_id)
 
     def _read_json_body(self):
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length)
         return json.loads(body.decode('utf-8'))
 
-    def _send_json(self, status_code: int, data: dict | list):
+    def _send_ndjson(self, rows: Iterator[dict]) -> None:
+        # chunked encoding needs an HTTP/1.1 status line; the connection is closed afterwards either way
+        self.protocol_version = 'HTTP/1.1'
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        buffer: list[bytes] = []
+        size = 0
+        # the rows are read lazily, so this span is the one that measures the export
+        with Tracing.span('ndjson_stream'):
+            try:
+                for row in rows:
+                    line = json.dumps(row).encode('utf-8') + b'\n'
+                    buffer.append(line)
+                    size += len(line)
+                    if size >= EXPORT_CHUNK_SIZE:
+                        self._write_chunk(b''.join(buffer))
+                        Tracing.add_rows(len(buffer))
+                        buffer, size = [], 0
+                if buffer:
+                    self._write_chunk(b''.join(buffer))
+                    Tracing.add_rows(len(buffer))
+            except Exception as e:
+                # the status is already sent, so the failure goes into the body as a last record
+                self.log_error("streaming %s failed: %r", urlparse(self.path).path, e)
+                try:
+                    error = json.dumps({"error": f"Export failed: {e}"}).encode('utf-8') + b'\n'
+                    self._write_chunk(b''.join(buffer) + error)
+                    self.wfile.write(b'0\r\n\r\n')
+                except OSError:
+                    pass
+                return
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+
+    def _send_json(self, status_code: int, data: dict | list, headers: dict[str, str] | None = None):
         response_bytes = json.dumps(data).encode('utf-8')
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json')
         self.send_header('Content-Length', str(len(response_bytes)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(response_bytes)
 
@@ -49,402 +208,696 @@ class MessageServerHandler(http.server.SimpleHTTPRequestHandler):
             return None
         return token
 
-    def do_POST(self):
-        if not self._db_guard():
+    def _is_local_request(self) -> bool:
+        try:
+            return ipaddress.ip_address(self.client_address[0]).is_loopback
+        except ValueError:
+            return False
+
+    def _send_too_many_requests(self, retry_after: float, message: str):
+        self._send_json(429, {"error": message, "retry_after": round(retry_after, 3)},
+                        {'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+    def _dispatch(self, handler) -> None:
+        if self.tracer is None:
+            self._with_admission(handler)
             return
-        assert self.db is not None
+
+        request_id, root, profiler = self.tracer.start(self.command, urlparse(self.path).path)
+        self._request_id = request_id
         try:
-            parsed_path = urlparse(self.path).path
+            self._with_admission(handler)
+        finally:
+            self.tracer.finish(request_id, root, profiler, self._status)
+
+    def _with_admission(self, handler) -> None:
+        limiter = self.rate_limiter
+        route = ROUTES.find(self.command, urlparse(self.path).path)
+        # replication long polls would pin an in-flight slot and inflate the load maintenance backs off on
+        if limiter is None or (route is not None and not route.admission):
+            handler()
+            return
 
-            if parsed_path == '/createUserAccount':
-                data = self._read_json_body()
-                name = data.get('name')
-                passwdhash = data.get('passwdhash')
+        if not limiter.enter():
+            self._send_too_many_requests(1.0, "Server is busy, try again later")
+            return
+        try:
+            handler()
+        finally:
+            limiter.leave()
+
+    def _within_rate_limit(self, user_token: str | None) -> bool:
+        if self.rate_limiter is None:
+            return True
+
+        # only a token resolved by an earlier request gets a bucket of its own, made-up headers and a
+        # token's first request share the caller's address; the handler itself validates the token
+        user_id = Events.cached_user_id(user_token) if user_token else None
+        client_key = f"user:{user_id}" if user_id is not None else self.client_address[0]
+
+        retry_after = self.rate_limiter.check(client_key, urlparse(self.path).path)
+        if retry_after > 0:
+            self._send_too_many_requests(retry_after, "Too many requests")
+            return False
+        return True
 
-                if not name or not passwdhash:
-                    self.send_error(400, "Missing name or passwdhash")
-                    return
+    def _metrics(self) -> dict:
+        metrics = {}
+        if isinstance(self.server, PooledTCPServer):
+            metrics['server'] = self.server.metrics()
+        if self.rate_limiter is not None:
+            metrics['rate_limiter'] = self.rate_limiter.metrics()
+        if self.static_files is not None:
+            metrics['static'] = self.static_files.metrics()
+        if self.tracer is not None:
+            metrics['tracing'] = self.tracer.metrics()
+        if self.ephemeral is not None:
+            metrics['ephemeral'] = self.ephemeral.metrics()
+        if self.attachments is not None:
+            metrics['attachments'] = self.attachments.metrics()
+        if self.nonces is not None:
+            metrics['nonces'] = self.nonces.metrics()
+        if self.scheduler is not None:
+            metrics['maintenance'] = self.scheduler.metrics()
+        if self.db is not None:
+            metrics['hot_tail'] = self.db.hot_tail.metrics()
+        metrics['routes'] = ROUTES.metrics()
+        return metrics
+
+    def _check_attachments(self, attachments: list[str]) -> bool:
+        if attachments and self.attachments is None:
+            self.send_error(400, "Attachments are not enabled on this server")
+            return False
+        for attachment_id in attachments:
+            assert self.attachments is not None
+            if not self.attachments.exists(attachment_id):
+                self.send_error(400, f"Unknown attachment {attachment_id}")
+                return False
+        return True
 
-                success, message = Events.create_account(name, passwdhash, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    def _serve_attachment(self, head_only: bool = False) -> None:
+        if not self._db_guard():
+            return
+        assert self.db is not None
+        user_token = self._require_auth()
+        if not user_token:
+            return
+        if not self._within_rate_limit(user_token):
+            return
 
-                self._send_json(200, {"status": "account created"})
+        if self.attachments is None:
+            self.send_error(404, "Not found")
+            return
 
-            elif parsed_path == '/login':
-                data = self._read_json_body()
-                name = data.get('name')
-                passwdhash = data.get('passwdhash')
+        attachment_id = urlparse(self.path).path[len('/attachments/'):]
+        success, message = Events.can_read_attachment(attachment_id, user_token, self.db)
+        if not success:
+            self.send_error(404 if message == "Attachment not found" else 400, message)
+            return
 
-                if not name or not passwdhash:
-                    self.send_error(400, "Missing name or passwdhash")
-                    return
+        self.attachments.serve(self, attachment_id, head_only)
 
-                user_list = self.db.select("users", {"username": name})
-                if not user_list:
-                    self.send_error(404, "User not found")
-                    return
+    def do_POST(self):
+        self._dispatch(lambda: self._run_route('POST'))
 
-                user = user_list[0]
-                if user['hashed_passwd'] != passwdhash:
-                    self.send_error(401, "Invalid password")
-                    return
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            if not self._is_local_request():
+                self.send_error(403, "Metrics are only available locally")
+                return
+            self._send_json(200, self._metrics())
+        elif ROUTES.methods(path):
+            self._dispatch(lambda: self._run_route('GET'))
+        elif path.startswith('/attachments/'):
+            self._dispatch(self._serve_attachment)
+        elif self.static_files is not None:
+            self.static_files.serve(self, path)
+        else:
+            self.send_error(404, "Not found")
+
+    def do_HEAD(self):
+        path = urlparse(self.path).path
+        if path.startswith('/attachments/'):
+            self._dispatch(lambda: self._serve_attachment(head_only=True))
+            return
+        if self.static_files is None or ROUTES.methods(path):
+            self.send_error(405, "Method not allowed")
+            return
+        self.static_files.serve(self, path, head_only=True)
+
+    def _run_route(self, method: str) -> None:
+        path = urlparse(self.path).path
+        route = ROUTES.find(method, path)
+        if route is None:
+            if ROUTES.methods(path):
+                self.send_error(405, "Method not allowed")
+            else:
+                self.send_error(404, "Not found")
+            return
 
-                self._send_json(200, {
-                    "status": "success",
-                    "message": "Logged in successfully",
-                    "user_token": user['user_token'],
-                    "user_id": user['user_id'],
-                })
+        start = time.perf_counter()
+        try:
+            self._invoke(route)
+        finally:
+            ROUTES.record(route, self._status, time.perf_counter() - start)
 
-            elif parsed_path == '/createServer':
-                user_token = self._require_auth()
-                if not user_token:
-                    return
+    def _invoke(self, route: Route) -> None:
+        if not self._db_guard():
+            return
+        if route.write and self.replica is not None:
+            self.send_error(405, "This server is a read-only replica")
+            return
+        if route.primary_only and self.replica is not None:
+            self.send_error(503, "Presence and typing are only served by the primary")
+            return
 
-                data = self._read_json_body()
-                name = data.get('name')
+        user_token = None
+        if route.auth:
+            user_token = self._require_auth()
+            if not user_token:
+                return
+        # routes without auth never read the header, so it cannot pick their bucket
+        if route.admission and not self._within_rate_limit(user_token):
+            return
 
-                if not name:
-                    self.send_error(400, "Missing server name")
+        try:
+            if route.body:
+                source = self._read_json_body()
+                if not isinstance(source, dict):
+                    self.send_error(400, "Expected a JSON object")
                     return
+            else:
+                source = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
 
-                success, message, result = Events.create_server(name, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+            params, error = route.parse(source)
+            if error is not None:
+                self.send_error(400, error)
+                return
 
-                self._send_json(200, {
-                    "status": "server created",
-                    "server_id": result['server_id'],
-                })
+            route.handler(self, user_token, **params)
 
-            elif parsed_path == '/createChannel':
-                user_token = self._require_auth()
-                if not user_token:
-                    return
+        except json.JSONDecodeError:
+            self.send_error(400, "Invalid JSON")
+        except Exception as e:
+            self.send_error(500, str(e))
 
-                data = self._read_json_body()
-                name = data.get('name')
-                server_id = data.get('server_id')
-                channel_type = data.get('channel_type', 'text')
+    # attachments are the raw request body, so this route reads no JSON
+    @ROUTES.post('/uploadAttachment', body=False)
+    def _upload_attachment(self, user_token: str) -> None:
+        assert self.db is not None
+        if self.attachments is None:
+            self.send_error(503, "Attachments are not enabled on this server")
+            return
 
-                if not name or not server_id:
-                    self.send_error(400, "Missing name or server_id")
-                    return
+        success, message, _ = Events.verify_token(user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                if channel_type not in ('text', 'voice'):
-                    self.send_error(400, "channel_type must be 'text' or 'voice'")
-                    return
+        try:
+            length = int(self.headers['Content-Length'])
+        except (KeyError, TypeError, ValueError):
+            self.send_error(411, "Content-Length required")
+            return
 
-                try:
-                    server_id = int(server_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "server_id must be an integer")
-                    return
+        try:
+            attachment_id, size = self.attachments.store(self.rfile, length)
+        except UploadError as e:
+            self.close_connection = True
+            self.send_error(e.status, str(e))
+            return
 
-                success, message, result = Events.create_channel(name, server_id, user_token, self.db, channel_type)
-                if not success:
-                    self.send_error(400, message)
-                    return
+        success, message = Events.record_upload(attachment_id, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, {
-                    "status": "channel created",
-                    "channel_id": result['channel_id'],
-                })
+        self._send_json(200, {"attachment_id": attachment_id, "size": size})
 
-            elif parsed_path == '/createInvite':
-                user_token = self._require_auth()
-                if not user_token:
-                    return
+    @ROUTES.post('/createUserAccount', Param('name', str, missing="Missing name or passwdhash"),
+                 Param('passwdhash', str, missing="Missing name or passwdhash"), auth=False)
+    def _create_user_account(self, user_token: None, name: str, passwdhash: str) -> None:
+        assert self.db is not None
+        success, message = Events.create_account(name, passwdhash, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                data = self._read_json_body()
-                server_id = data.get('server_id')
+        self._send_json(200, {"status": "account created"})
 
-                if not server_id:
-                    self.send_error(400, "Missing server_id")
-                    return
+    @ROUTES.post('/login', Param('name', str, missing="Missing name or passwdhash"),
+                 Param('passwdhash', str, missing="Missing name or passwdhash"), auth=False)
+    def _login(self, user_token: None, name: str, passwdhash: str) -> None:
+        assert self.db is not None
+        user_list = self.db.select("users", {"username": name})
+        if not user_list:
+            self.send_error(404, "User not found")
+            return
 
-                try:
-                    server_id = int(server_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "server_id must be an integer")
-                    return
+        user = user_list[0]
+        if user['hashed_passwd'] != passwdhash:
+            self.send_error(401, "Invalid password")
+            return
 
-                success, message, result = Events.create_invite(server_id, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+        self._send_json(200, {
+            "status": "success",
+            "message": "Logged in successfully",
+            "user_token": user['user_token'],
+            "user_id": user['user_id'],
+        })
 
-                self._send_json(200, {
-                    "status": "invite created",
-                    "invite_code": result['invite_code'],
-                })
+    @ROUTES.post('/createServer', Param('name', str, missing="Missing server name"))
+    def _create_server(self, user_token: str, name: str) -> None:
+        assert self.db is not None
+        success, message, result = Events.create_server(name, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-            elif parsed_path == '/joinServer':
-                user_token = self._require_auth()
-                if not user_token:
-                    return
+        self._send_json(200, {
+            "status": "server created",
+            "server_id": result['server_id'],
+        })
 
-                data = self._read_json_body()
-                invite_code = data.get('invite_code')
+    @ROUTES.post('/createChannel', Param('name', str, missing="Missing name or server_id"),
+                 Param('server_id', missing="Missing name or server_id"),
+                 Param('channel_type', str, required=False, default='text', choices=('text', 'voice'),
+                       invalid="channel_type must be 'text' or 'voice'"))
+    def _create_channel(self, user_token: str, name: str, server_id: int, channel_type: str) -> None:
+        assert self.db is not None
+        success, message, result = Events.create_channel(name, server_id, user_token, self.db, channel_type)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                if not invite_code:
-                    self.send_error(400, "Missing invite_code")
-                    return
+        self._send_json(200, {
+            "status": "channel created",
+            "channel_id": result['channel_id'],
+        })
 
-                success, message, result = Events.join_server(invite_code, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.post('/createInvite', Param('server_id'), Param('max_age', required=False),
+                 Param('max_uses', required=False))
+    def _create_invite(self, user_token: str, server_id: int, max_age: int | None, max_uses: int | None) -> None:
+        assert self.db is not None
+        success, message, result = Events.create_invite(server_id, user_token, self.db, max_age, max_uses)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, {
-                    "status": "joined server",
-                    "server_id": result['server_id'],
-                })
+        self._send_json(200, {
+            "status": "invite created",
+            "invite_code": result['invite_code'],
+            "expires_at": result['expires_at'],
+            "max_uses": result['max_uses'],
+        })
 
-            elif parsed_path == '/sendMessage':
-                user_token = self._require_auth()
-                if not user_token:
-                    return
+    @ROUTES.post('/joinServer', Param('invite_code', str))
+    def _join_server(self, user_token: str, invite_code: str) -> None:
+        assert self.db is not None
+        success, message, result = Events.join_server(invite_code, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                data = self._read_json_body()
-                channel_id = data.get('channel_id')
-                content = data.get('content')
+        self._send_json(200, {
+            "status": "joined server",
+            "server_id": result['server_id'],
+        })
 
-                if not channel_id or not content:
-                    self.send_error(400, "Missing channel_id or content")
-                    return
+    @ROUTES.post('/sendMessage', Param('channel_id', missing="Missing channel_id or content"),
+                 Param('content', str, required=False),
+                 Param('attachments', 'strings', required=False, default=()), Param('nonce', str, required=False))
+    def _send_message(self, user_token: str, channel_id: int, content: str | None, attachments: list[str],
+                      nonce: str | None) -> None:
+        assert self.db is not None
+        if not content and not attachments:
+            self.send_error(400, "Missing channel_id or content")
+            return
+        if not self._check_attachments(attachments):
+            return
 
-                try:
-                    channel_id = int(channel_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "channel_id must be an integer")
-                    return
+        success, message, result = Events.send_message(channel_id, user_token, content, self.db, list(attachments),
+                                                       nonce, self.nonces)
+        if not success:
+            self.send_error(409 if message == Events.NONCE_PENDING else 400, message)
+            return
 
-                success, message, result = Events.send_message(channel_id, user_token, content, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+        self._send_json(200, {
+            "status": "message sent",
+            "message_id": result['message_id'],
+            "duplicate": result.get('duplicate', False),
+        })
+
+    @ROUTES.post('/sendDM', Param('recipient_id', missing="Missing recipient_id or content"),
+                 Param('content', str, required=False),
+                 Param('attachments', 'strings', required=False, default=()), Param('nonce', str, required=False))
+    def _send_dm(self, user_token: str, recipient_id: int, content: str | None, attachments: list[str],
+                 nonce: str | None) -> None:
+        assert self.db is not None
+        if not content and not attachments:
+            self.send_error(400, "Missing recipient_id or content")
+            return
+        if not self._check_attachments(attachments):
+            return
 
-                self._send_json(200, {
-                    "status": "message sent",
-                    "message_id": result['message_id'],
-                })
+        success, message, result = Events.send_dm(recipient_id, user_token, content, self.db, list(attachments),
+                                                  nonce, self.nonces)
+        if not success:
+            self.send_error(409 if message == Events.NONCE_PENDING else 400, message)
+            return
 
-            elif parsed_path == '/sendDM':
-                user_token = self._require_auth()
-                if not user_token:
-                    return
+        self._send_json(200, {
+            "status": "dm sent",
+            "message_id": result['message_id'],
+            "duplicate": result.get('duplicate', False),
+        })
+
+    @ROUTES.post('/markRead', Param('message_id', missing=MISSING_MESSAGE_REF, invalid=INVALID_MESSAGE_REF),
+                 Param('channel_id', required=False, missing=MISSING_MESSAGE_REF, invalid=INVALID_MESSAGE_REF),
+                 Param('user_id', required=False, dest='other_user_id', missing=MISSING_MESSAGE_REF,
+                       invalid=INVALID_MESSAGE_REF), one_of=('channel_id', 'user_id'))
+    def _mark_read(self, user_token: str, message_id: int, channel_id: int | None, other_user_id: int | None) -> None:
+        assert self.db is not None
+        success, message, result = Events.mark_read(message_id, user_token, self.db, channel_id, other_user_id)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                data = self._read_json_body()
-                recipient_id = data.get('recipient_id')
-                content = data.get('content')
+        self._send_json(200, {"status": "ok", **result})
 
-                if not recipient_id or not content:
-                    self.send_error(400, "Missing recipient_id or content")
-                    return
+    @ROUTES.post('/editMessage', Param('message_id', missing=MISSING_MESSAGE_REF, invalid=INVALID_MESSAGE_REF),
+                 Param('content', str),
+                 Param('channel_id', required=False, missing=MISSING_MESSAGE_REF, invalid=INVALID_MESSAGE_REF),
+                 Param('user_id', required=False, dest='other_user_id', missing=MISSING_MESSAGE_REF,
+                       invalid=INVALID_MESSAGE_REF), one_of=('channel_id', 'user_id'))
+    def _edit_message(self, user_token: str, message_id: int, content: str, channel_id: int | None,
+                      other_user_id: int | None) -> None:
+        assert self.db is not None
+        success, message, result = Events.edit_message(message_id, content, user_token, self.db,
+                                                       channel_id, other_user_id)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                try:
-                    recipient_id = int(recipient_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "recipient_id must be an integer")
-                    return
+        self._send_json(200, {"status": "message edited", **result})
 
-                success, message, result = Events.send_dm(recipient_id, user_token, content, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.post('/deleteMessage', Param('message_id', missing=MISSING_MESSAGE_REF, invalid=INVALID_MESSAGE_REF),
+                 Param('channel_id', required=False, missing=MISSING_MESSAGE_REF, invalid=INVALID_MESSAGE_REF),
+                 Param('user_id', required=False, dest='other_user_id', missing=MISSING_MESSAGE_REF,
+                       invalid=INVALID_MESSAGE_REF), one_of=('channel_id', 'user_id'))
+    def _delete_message(self, user_token: str, message_id: int, channel_id: int | None,
+                        other_user_id: int | None) -> None:
+        assert self.db is not None
+        success, message, result = Events.delete_message(message_id, user_token, self.db,
+                                                         channel_id, other_user_id)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, {
-                    "status": "dm sent",
-                    "message_id": result['message_id'],
-                })
+        self._send_json(200, {"status": "message deleted", **result})
 
-            else:
-                self.send_error(404, "Not found")
+    @ROUTES.post('/setPresence', Param('status', str))
+    def _set_presence(self, user_token: str, status: str) -> None:
+        assert self.db is not None
+        if self.ephemeral is None:
+            self.send_error(503, "Presence is not enabled on this server")
+            return
 
-        except json.JSONDecodeError:
-            self.send_error(400, "Invalid JSON")
-        except Exception as e:
-            self.send_error(500, str(e))
+        success, message, result = Events.set_presence(status, user_token, self.db, self.ephemeral)
+        if not success:
+            self.send_error(400, message)
+            return
 
-    def do_GET(self):
-        if not self._db_guard():
+        self._send_json(200, {"status": "ok", **result})
+
+    @ROUTES.post('/setTyping', Param('channel_id', required=False, invalid=INVALID_CONVERSATION),
+                 Param('user_id', required=False, dest='other_user_id', invalid=INVALID_CONVERSATION),
+                 one_of=('channel_id', 'user_id'))
+    def _set_typing(self, user_token: str, channel_id: int | None, other_user_id: int | None) -> None:
+        assert self.db is not None
+        if self.ephemeral is None:
+            self.send_error(503, "Presence is not enabled on this server")
+            return
+
+        success, message, result = Events.set_typing(user_token, self.db, self.ephemeral, channel_id, other_user_id)
+        if not success:
+            self.send_error(400, message)
             return
+
+        self._send_json(200, {"status": "ok", **result})
+
+    def _send_messages(self, messages: list, authors: bool) -> None:
         assert self.db is not None
-        try:
-            parsed = urlparse(self.path)
-            path = parsed.path
-            params = parse_qs(parsed.query)
+        body: dict = {"messages": messages}
+        if authors:
+            body['authors'] = Events.get_message_authors(messages, self.db)
+        self._send_json(200, body)
+
+    @ROUTES.get('/getMessages', Param('channel_id'), Param('before', required=False),
+                Param('authors', bool, required=False, default=False))
+    def _get_messages(self, user_token: str, channel_id: int, before: int | None, authors: bool) -> None:
+        assert self.db is not None
+        success, message, messages = Events.get_messages(channel_id, user_token, self.db, before)
+        if not success:
+            self.send_error(400, message)
+            return
 
-            def param(key: str) -> str | None:
-                values = params.get(key)
-                return values[0] if values else None
+        self._send_messages(messages, authors)
 
-            user_token = self._require_auth()
-            if not user_token:
-                return
+    @ROUTES.get('/getServerMembers', Param('server_id'))
+    def _get_server_members(self, user_token: str, server_id: int) -> None:
+        assert self.db is not None
+        success, message, members = Events.get_server_members(server_id, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-            if path == '/getMessages':
-                channel_id = param('channel_id')
-                if not channel_id:
-                    self.send_error(400, "Missing channel_id query parameter")
-                    return
+        self._send_json(200, {"members": members})
 
-                try:
-                    channel_id = int(channel_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "channel_id must be an integer")
-                    return
+    @ROUTES.get('/getUser', Param('user_id'))
+    def _get_user(self, user_token: str, user_id: int) -> None:
+        assert self.db is not None
+        success, message, data = Events.get_user_by_id(user_id, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                before_id = param('before')
-                before = int(before_id) if before_id else None
+        self._send_json(200, data)
 
-                success, message, messages = Events.get_messages(channel_id, user_token, self.db, before)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.get('/getServer', Param('server_id'))
+    def _get_server(self, user_token: str, server_id: int) -> None:
+        assert self.db is not None
+        success, message, data = Events.get_server_by_id(server_id, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, {"messages": messages})
+        self._send_json(200, data)
 
-            elif path == '/getServerMembers':
-                server_id = param('server_id')
-                if not server_id:
-                    self.send_error(400, "Missing server_id query parameter")
-                    return
+    @ROUTES.get('/getUsers', Param('ids', 'ints', required=False))
+    def _get_users(self, user_token: str, ids: list[int] | None) -> None:
+        assert self.db is not None
+        if ids is None:
+            success, message, users = Events.get_all_users(user_token, self.db)
+        else:
+            success, message, users = Events.get_users(ids, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                try:
-                    server_id = int(server_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "server_id must be an integer")
-                    return
+        self._send_json(200, {"users": users})
 
-                success, message, members = Events.get_server_members(server_id, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.get('/getUserServers')
+    def _get_user_servers(self, user_token: str) -> None:
+        assert self.db is not None
+        success, message, servers = Events.get_user_servers(user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, {"members": members})
+        self._send_json(200, {"servers": servers})
 
-            elif path == '/getUser':
-                user_id = param('user_id')
-                if not user_id:
-                    self.send_error(400, "Missing user_id query parameter")
-                    return
+    @ROUTES.get('/getDMList')
+    def _get_dm_list(self, user_token: str) -> None:
+        assert self.db is not None
+        success, message, dms = Events.get_dm_list(user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                try:
-                    user_id = int(user_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "user_id must be an integer")
-                    return
+        self._send_json(200, {"dms": dms})
 
-                success, message, data = Events.get_user_by_id(user_id, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.get('/getDMMessages', Param('user_id', dest='other_user_id'), Param('before', required=False),
+                Param('authors', bool, required=False, default=False))
+    def _get_dm_messages(self, user_token: str, other_user_id: int, before: int | None, authors: bool) -> None:
+        assert self.db is not None
+        success, message, messages = Events.get_dm_messages(other_user_id, user_token, self.db, before)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, data)
+        self._send_messages(messages, authors)
 
-            elif path == '/getServer':
-                server_id = param('server_id')
-                if not server_id:
-                    self.send_error(400, "Missing server_id query parameter")
-                    return
+    @ROUTES.get('/getServerChannels', Param('server_id'))
+    def _get_server_channels(self, user_token: str, server_id: int) -> None:
+        assert self.db is not None
+        success, message, channels = Events.get_server_channels(server_id, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                try:
-                    server_id = int(server_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "server_id must be an integer")
-                    return
+        self._send_json(200, {"channels": channels})
 
-                success, message, data = Events.get_server_by_id(server_id, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.get('/getUnreadCounts')
+    def _get_unread_counts(self, user_token: str) -> None:
+        assert self.db is not None
+        success, message, counts = Events.get_unread_counts(user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, data)
+        self._send_json(200, counts)
 
-            elif path == '/getUsers':
-                success, message, users = Events.get_all_users(user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    # after/before are message id cursors, since/until are unix times
+    @ROUTES.get('/searchMessages', Param('q', str, dest='query'),
+                *(Param(key, required=False) for key in ('server_id', 'channel_id', 'user_id', 'author_id', 'after', 'before')),
+                *(Param(key, float, required=False) for key in ('since', 'until')))
+    def _search_messages(self, user_token: str, query: str, server_id: int | None, channel_id: int | None,
+                         user_id: int | None, author_id: int | None, after: int | None, before: int | None,
+                         since: float | None, until: float | None) -> None:
+        assert self.db is not None
+        success, message, results = Events.search_messages(
+            query, user_token, self.db, server_id, channel_id, user_id, author_id, after, before, since, until,
+        )
+        if not success:
+            self.send_error(400, message)
+            return
 
-                self._send_json(200, {"users": users})
+        self._send_json(200, {"results": results})
 
-            elif path == '/getUserServers':
-                success, message, servers = Events.get_user_servers(user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.get('/getPresence', Param('ids', 'ints'), primary_only=True)
+    def _get_presence(self, user_token: str, ids: list[int]) -> None:
+        assert self.db is not None
+        if self.ephemeral is None:
+            self.send_error(503, "Presence is not enabled on this server")
+            return
 
-                self._send_json(200, {"servers": servers})
+        success, message, presence = Events.get_presence(ids, user_token, self.db, self.ephemeral)
+        if not success:
+            self.send_error(400, message)
+            return
 
-            elif path == '/getDMList':
-                success, message, dms = Events.get_dm_list(user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+        self._send_json(200, {"presence": presence})
 
-                self._send_json(200, {"dms": dms})
+    @ROUTES.get('/getTyping', Param('channel_id', required=False, invalid=INVALID_CONVERSATION),
+                Param('user_id', required=False, dest='other_user_id', invalid=INVALID_CONVERSATION),
+                one_of=('channel_id', 'user_id'), primary_only=True)
+    def _get_typing(self, user_token: str, channel_id: int | None, other_user_id: int | None) -> None:
+        assert self.db is not None
+        if self.ephemeral is None:
+            self.send_error(503, "Presence is not enabled on this server")
+            return
 
-            elif path == '/getDMMessages':
-                other_user_id = param('user_id')
-                if not other_user_id:
-                    self.send_error(400, "Missing user_id query parameter")
-                    return
+        success, message, typing = Events.get_typing(user_token, self.db, self.ephemeral, channel_id, other_user_id)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                try:
-                    other_user_id = int(other_user_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "user_id must be an integer")
-                    return
+        self._send_json(200, {"typing": typing})
 
-                before_id = param('before')
-                before = int(before_id) if before_id else None
+    @ROUTES.get('/exportMessages', Param('channel_id', required=False, invalid=INVALID_CONVERSATION),
+                Param('user_id', required=False, dest='other_user_id', invalid=INVALID_CONVERSATION),
+                one_of=('channel_id', 'user_id'))
+    def _export_messages(self, user_token: str, channel_id: int | None, other_user_id: int | None) -> None:
+        assert self.db is not None
+        success, message, rows = Events.export_messages(user_token, self.db, channel_id, other_user_id)
+        if not success:
+            self.send_error(400, message)
+            return
 
-                success, message, messages = Events.get_dm_messages(other_user_id, user_token, self.db, before)
-                if not success:
-                    self.send_error(400, message)
-                    return
+        self._send_ndjson(rows)
 
-                self._send_json(200, {"messages": messages})
+    @ROUTES.get('/sync', Param('cursor', str, required=False))
+    def _sync(self, user_token: str, cursor: str | None) -> None:
+        assert self.db is not None
+        success, message, state = Events.sync(cursor, user_token, self.db)
+        if not success:
+            self.send_error(400, message)
+            return
 
-            elif path == '/getServerChannels':
-                server_id = param('server_id')
-                if not server_id:
-                    self.send_error(400, "Missing server_id query parameter")
-                    return
+        self._send_json(200, state)
 
-                try:
-                    server_id = int(server_id)
-                except (ValueError, TypeError):
-                    self.send_error(400, "server_id must be an integer")
-                    return
+    def _replication_guard(self, stream: bool) -> bool:
+        if not self._is_local_request():
+            self.send_error(403, "Replication is only available locally")
+            return False
+        if stream and self.replica is not None:
+            self.send_error(400, "Replicas do not serve replication streams")
+            return False
+        return True
 
-                success, message, channels = Events.get_server_channels(server_id, user_token, self.db)
-                if not success:
-                    self.send_error(400, message)
-                    return
+    @ROUTES.get('/replication/status', auth=False, admission=False)
+    def _replication_status(self, user_token: None) -> None:
+        assert self.db is not None
+        if not self._replication_guard(stream=False):
+            return
+        if self.replica is not None:
+            self._send_json(200, self.replica.status())
+        else:
+            self._send_json(200, {'role': 'primary', 'epoch': self.db.changes.epoch, 'seq': self.db.changes.seq})
 
-                self._send_json(200, {"channels": channels})
+    @ROUTES.get('/replication/snapshot', auth=False, admission=False)
+    def _replication_snapshot(self, user_token: None) -> None:
+        assert self.db is not None
+        if not self._replication_guard(stream=True):
+            return
+        self._send_json(200, self.db.snapshot())
 
-            else:
-                self.send_error(404, "Not found")
+    @ROUTES.get('/replication/changes',
+                Param('since', required=False, default=0, invalid="since and wait must be numbers"),
+                Param('wait', float, required=False, default=0.0, invalid="since and wait must be numbers"),
+                Param('epoch', str, required=False), auth=False, admission=False)
+    def _replication_changes(self, user_token: None, since: int, wait: float, epoch: str | None) -> None:
+        assert self.db is not None
+        if not self._replication_guard(stream=True):
+            return
 
-        except Exception as e:
-            self.send_error(500, str(e))
+        changes = None
+        if epoch == self.db.changes.epoch:
+            changes = self.db.changes.since(since, wait=min(wait, REPLICATION_MAX_WAIT))
+        self._send_json(200, {
+            'resync': changes is None,
+            'changes': changes or [],
+            'seq': self.db.changes.seq,
+            'ts': time.time(),
+        })
 
 
 class MessageServer:
     def __init__(self):
         self.httpd = None
 
-    def start(self, port: int, db: Database.FreecordDB):
-        MessageServerHandler.db = db
-        self.httpd = ThreadedTCPServer(("0.0.0.0", port), MessageServerHandler)
+    def start(self, port: int, db: ShardRouter.ShardedFreecordDB, replica: ReplicaFollower | None = None,
+              rate_limiter: RateLimiter | None = None, workers: int = 0, queue_size: int = 128,
+              static_files: StaticFiles | None = None, tracer: Tracer | None = None,
+              ephemeral: EphemeralStore | None = None, attachments: AttachmentStore | None = None,
+              nonces: EphemeralStore | None = None, scheduler: MaintenanceScheduler | None = None):
+        handler = type('MessageServerHandler', (MessageServerHandler,), {
+            'db': db,
+            'replica': replica,
+            'rate_limiter': rate_limiter,
+            'static_files': static_files,
+            'tracer': tracer,
+            'ephemeral': ephemeral,
+            'attachments': attachments,
+            'nonces': nonces,
+            'scheduler': scheduler,
+        })
+        if workers > 0:
+            self.httpd = PooledTCPServer(("0.0.0.0", port), handler, workers, queue_size)
+        else:
+            self.httpd = ThreadedTCPServer(("0.0.0.0", port), handler)
         self.httpd.serve_forever()
 
     def stop(self):
@@ -1,111 +1,266 @@
-from modules.database import DatabaseEvents as DBEvents, Database
+from typing import Iterator
+from modules import Tracing
+from modules.EphemeralStore import EphemeralStore
+from modules.database import DatabaseEvents as DBEvents, ShardRouter
 
-def create_account(username, hashed_passwd, db: Database.FreecordDB) -> tuple[bool, str]:
+NONCE_PENDING = DBEvents.NONCE_PENDING
+
+@Tracing.traced
+def create_account(username, hashed_passwd, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str]:
     success, message, _ = DBEvents.add_user(username, hashed_passwd, db)
     if not success:
         return False, message
 
     return True, "Account created successfully"
 
-def create_server(name, user_token, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def create_server(name, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     success, message, data = DBEvents.add_server(name, user_token, db)
     if not success:
         return False, message, {}
 
     return True, "Server created successfully", data
 
-def create_channel(name, server_id, user_token, db: Database.FreecordDB, channel_type: str = "text") -> tuple[bool, str, dict]:
+@Tracing.traced
+def create_channel(name, server_id, user_token, db: ShardRouter.ShardedFreecordDB, channel_type: str = "text") -> tuple[bool, str, dict]:
     success, message, data = DBEvents.add_channel(name, server_id, user_token, channel_type, db)
     if not success:
         return False, message, {}
 
     return True, "Channel created successfully", data
 
-def create_invite(server_id, user_token, db: Database.FreecordDB) -> tuple[bool, str, dict]:
-    success, message, data = DBEvents.create_invite(server_id, user_token, db)
+@Tracing.traced
+def create_invite(server_id, user_token, db: ShardRouter.ShardedFreecordDB, max_age: int | None = None,
+                  max_uses: int | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.create_invite(server_id, user_token, db, max_age, max_uses)
     if not success:
         return False, message, {}
 
     return True, "Invite created", data
 
-def join_server(invite_code, user_token, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def join_server(invite_code, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     success, message, data = DBEvents.join_server(invite_code, user_token, db)
     if not success:
         return False, message, {}
 
     return True, "Joined server successfully", data
 
-def send_message(channel_id, user_token, content, db: Database.FreecordDB) -> tuple[bool, str, dict]:
-    success, message, data = DBEvents.send_message(channel_id, user_token, content, db)
+@Tracing.traced
+def send_message(channel_id, user_token, content, db: ShardRouter.ShardedFreecordDB,
+                 attachments: list | None = None, nonce: str | None = None,
+                 nonces: EphemeralStore | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.send_message(channel_id, user_token, content, db, attachments, nonce, nonces)
     if not success:
         return False, message, {}
 
     return True, "Message sent", data
 
-def get_messages(channel_id, user_token, db: Database.FreecordDB, before: int | None = None) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_messages(channel_id, user_token, db: ShardRouter.ShardedFreecordDB, before: int | None = None) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_messages(channel_id, user_token, db, before)
     if not success:
         return False, message, []
 
     return True, "OK", data
 
-def get_all_users(user_token, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_all_users(user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_all_users(user_token, db)
     if not success:
         return False, message, []
 
     return True, "OK", data
 
-def get_server_members(server_id, user_token, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_users(user_ids, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
+    success, message, data = DBEvents.get_users(user_ids, user_token, db)
+    if not success:
+        return False, message, []
+
+    return True, "OK", data
+
+@Tracing.traced
+def get_message_authors(messages, db: ShardRouter.ShardedFreecordDB) -> dict[str, dict]:
+    return DBEvents.message_authors(messages, db)
+
+@Tracing.traced
+def get_server_members(server_id, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_server_members(server_id, user_token, db)
     if not success:
         return False, message, []
 
     return True, "OK", data
 
-def get_server_channels(server_id, user_token, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_server_channels(server_id, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_server_channels(server_id, user_token, db)
     if not success:
         return False, message, []
 
     return True, "OK", data
 
-def get_user_servers(user_token, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_user_servers(user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_user_servers(user_token, db)
     if not success:
         return False, message, []
 
     return True, "OK", data
 
-def send_dm(recipient_id, user_token, content, db: Database.FreecordDB) -> tuple[bool, str, dict]:
-    success, message, data = DBEvents.send_dm(recipient_id, user_token, content, db)
+@Tracing.traced
+def send_dm(recipient_id, user_token, content, db: ShardRouter.ShardedFreecordDB,
+            attachments: list | None = None, nonce: str | None = None,
+            nonces: EphemeralStore | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.send_dm(recipient_id, user_token, content, db, attachments, nonce, nonces)
     if not success:
         return False, message, {}
 
     return True, "DM sent", data
 
-def get_dm_messages(other_user_id, user_token, db: Database.FreecordDB, before: int | None = None) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_dm_messages(other_user_id, user_token, db: ShardRouter.ShardedFreecordDB, before: int | None = None) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_dm_messages(other_user_id, user_token, db, before)
     if not success:
         return False, message, []
 
     return True, "OK", data
 
-def get_user_by_id(user_id, user_token, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def get_user_by_id(user_id, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     success, message, data = DBEvents.get_user_by_id(user_id, user_token, db)
     if not success:
         return False, message, {}
     return True, "OK", data
 
-def get_server_by_id(server_id, user_token, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def verify_token(user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.verify_token(user_token, db)
+    if not success:
+        return False, message, {}
+    return True, "OK", data
+
+def cached_user_id(user_token: str) -> int | None:
+    return DBEvents.cached_user_id(user_token)
+
+@Tracing.traced
+def record_upload(attachment_id: str, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str]:
+    success, message, _ = DBEvents.record_upload(attachment_id, user_token, db)
+    return success, message
+
+@Tracing.traced
+def can_read_attachment(attachment_id: str, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str]:
+    success, message, _ = DBEvents.can_read_attachment(attachment_id, user_token, db)
+    return success, message
+
+@Tracing.traced
+def get_server_by_id(server_id, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     success, message, data = DBEvents.get_server_by_id(server_id, user_token, db)
     if not success:
         return False, message, {}
     return True, "OK", data
 
-def get_dm_list(user_token, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def export_messages(user_token, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+                    other_user_id: int | None = None) -> tuple[bool, str, Iterator[dict]]:
+    success, message, rows = DBEvents.export_messages(user_token, db, channel_id, other_user_id)
+    if not success:
+        return False, message, iter(())
+    return True, "OK", rows
+
+@Tracing.traced
+def get_dm_list(user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     success, message, data = DBEvents.get_dm_list(user_token, db)
     if not success:
         return False, message, []
 
     return True, "OK", data
+
+@Tracing.traced
+def search_messages(query, user_token, db: ShardRouter.ShardedFreecordDB, server_id: int | None = None,
+                    channel_id: int | None = None, other_user_id: int | None = None, author_id: int | None = None,
+                    after: int | None = None, before: int | None = None, since: float | None = None,
+                    until: float | None = None) -> tuple[bool, str, list]:
+    success, message, data = DBEvents.search_messages(query, user_token, db, server_id, channel_id,
+                                                      other_user_id, author_id, after, before, since, until)
+    if not success:
+        return False, message, []
+
+    return True, "OK", data
+
+@Tracing.traced
+def edit_message(message_id, content, user_token, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+                 other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.edit_message(message_id, content, user_token, db, channel_id, other_user_id)
+    if not success:
+        return False, message, {}
+
+    return True, "Message edited", data
+
+@Tracing.traced
+def delete_message(message_id, user_token, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+                   other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.delete_message(message_id, user_token, db, channel_id, other_user_id)
+    if not success:
+        return False, message, {}
+
+    return True, "Message deleted", data
+
+@Tracing.traced
+def mark_read(message_id, user_token, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+              other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.mark_read(message_id, user_token, db, channel_id, other_user_id)
+    if not success:
+        return False, message, {}
+
+    return True, "OK", data
+
+@Tracing.traced
+def get_unread_counts(user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.get_unread_counts(user_token, db)
+    if not success:
+        return False, message, {}
+
+    return True, "OK", data
+
+@Tracing.traced
+def set_presence(status, user_token, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.set_presence(status, user_token, db, store)
+    if not success:
+        return False, message, {}
+
+    return True, "OK", data
+
+@Tracing.traced
+def get_presence(user_ids, user_token, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.get_presence(user_ids, user_token, db, store)
+    if not success:
+        return False, message, {}
+
+    return True, "OK", data
+
+@Tracing.traced
+def set_typing(user_token, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore, channel_id: int | None = None,
+               other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.set_typing(user_token, db, store, channel_id, other_user_id)
+    if not success:
+        return False, message, {}
+
+    return True, "OK", data
+
+@Tracing.traced
+def get_typing(user_token, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore, channel_id: int | None = None,
+               other_user_id: int | None = None) -> tuple[bool, str, list]:
+    success, message, data = DBEvents.get_typing(user_token, db, store, channel_id, other_user_id)
+    if not success:
+        return False, message, []
+
+    return True, "OK", data
+
+@Tracing.traced
+def sync(cursor, user_token, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    success, message, data = DBEvents.sync(cursor, user_token, db)
+    if not success:
+        return False, message, {}
+
+    return True, "OK", data
@@ -0,0 +1,111 @@
+import collections
+import email.utils
+import mimetypes
+import os
+import posixpath
+import threading
+from urllib.parse import unquote
+
+class StaticFiles:
+    def __init__(self, root: str, max_age: int = 3600, cache_file_size: int = 64 * 1024,
+                 cache_bytes: int = 8 * 1024 * 1024):
+        self.root = os.path.realpath(root)
+        self.max_age = max_age
+        self.cache_file_size = cache_file_size
+        self.cache_bytes = cache_bytes
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sendfile_bytes = 0
+
+    def resolve(self, url_path: str) -> str | None:
+        parts = [p for p in posixpath.normpath(unquote(url_path)).split('/') if p]
+        if any(p.startswith('.') for p in parts):
+            return None
+        path = os.path.realpath(os.path.join(self.root, *parts))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        return path if os.path.isfile(path) else None
+
+    def _read_cached(self, path: str, st: os.stat_result) -> bytes:
+        key = (path, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        with open(path, 'rb') as f:
+            body = f.read()
+        with self._lock:
+            self._cache[key] = body
+            self._cached_bytes += len(body)
+            while self._cached_bytes > self.cache_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._cached_bytes -= len(old)
+        return body
+
+    def serve(self, handler, url_path: str, head_only: bool = False) -> None:
+        path = self.resolve(url_path)
+        if path is None:
+            handler.send_error(404, "File not found")
+            return
+
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        encoding = None
+        accepts_gzip = 'gzip' in handler.headers.get('Accept-Encoding', '')
+        if accepts_gzip and os.path.isfile(path + '.gz') \
+                and os.stat(path + '.gz').st_mtime_ns >= os.stat(path).st_mtime_ns:
+            path, encoding = path + '.gz', 'gzip'
+
+        st = os.stat(path)
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}{"-gz" if encoding else ""}"'
+        cache_control = 'no-cache' if content_type == 'text/html' else f'public, max-age={self.max_age}'
+
+        if etag in handler.headers.get('If-None-Match', ''):
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Cache-Control', cache_control)
+            handler.end_headers()
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(st.st_size))
+        handler.send_header('ETag', etag)
+        handler.send_header('Cache-Control', cache_control)
+        handler.send_header('Last-Modified', email.utils.formatdate(st.st_mtime, usegmt=True))
+        handler.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            handler.send_header('Content-Encoding', encoding)
+        handler.end_headers()
+        if head_only:
+            return
+
+        if st.st_size <= self.cache_file_size:
+            handler.wfile.write(self._read_cached(path, st))
+            return
+        send_file(handler, path, 0, st.st_size)
+        with self._lock:
+            self.sendfile_bytes += st.st_size
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'cached_files': len(self._cache),
+                'cached_bytes': self._cached_bytes,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'sendfile_bytes': self.sendfile_bytes,
+            }
+
+def send_file(handler, path: str, offset: int, count: int) -> None:
+    handler.wfile.flush()
+    with open(path, 'rb') as f:
+        # socket.sendfile uses os.sendfile where the platform has it
+        handler.connection.sendfile(f, offset, count)
@@ -0,0 +1,150 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+
+_local = threading.local()
+
+class Span:
+    __slots__ = ('name', 'attrs', 'start', 'duration', 'rows', 'children')
+
+    def __init__(self, name: str, attrs: dict | None = None):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.rows = 0
+        self.children: list[Span] = []
+
+    def to_dict(self) -> dict:
+        data = {'name': self.name, 'ms': round(self.duration * 1000, 3)}
+        if self.attrs:
+            data.update(self.attrs)
+        if self.rows:
+            data['rows'] = self.rows
+        if self.children:
+            data['children'] = [child.to_dict() for child in self.children]
+        return data
+
+class _SpanContext:
+    __slots__ = ('name', 'attrs', 'span')
+
+    def __init__(self, name: str, attrs: dict | None):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if not stack:
+            self.span = None
+            return None
+        self.span = Span(self.name, self.attrs)
+        stack[-1].children.append(self.span)
+        stack.append(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        if self.span is not None:
+            self.span.duration = time.perf_counter() - self.span.start
+            _local.stack.pop()
+        return False
+
+def span(name: str, **attrs) -> _SpanContext:
+    return _SpanContext(name, attrs or None)
+
+def add_rows(count: int) -> None:
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].rows += count
+
+def traced(func):
+    name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not getattr(_local, 'stack', None):
+            return func(*args, **kwargs)
+        with _SpanContext(name, None):
+            return func(*args, **kwargs)
+    return wrapper
+
+def traced_query(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not getattr(_local, 'stack', None):
+            return method(self, *args, **kwargs)
+        attrs = {'db': self.stream_source}
+        if args:
+            attrs['table'] = args[0]
+        with _SpanContext(method.__name__, attrs):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class Tracer:
+    def __init__(self, slow_ms: float = 250, log_path: str = 'slow_requests.log',
+                 profile_rate: float = 0.0, profile_dir: str = 'profiles'):
+        self.slow_ms = slow_ms
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.logger = logging.getLogger('freecord.slow_requests')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.FileHandler(log_path))
+        self._profile_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.traced = 0
+        self.slow = 0
+        self.profiled = 0
+
+    def start(self, method: str, path: str) -> tuple[str, Span, cProfile.Profile | None]:
+        request_id = secrets.token_hex(8)
+        root = Span(f"{method} {path}")
+        _local.stack = [root]
+        profiler = None
+        if self.profile_rate > 0 and random.random() < self.profile_rate and self._profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                self._profile_lock.release()
+                profiler = None
+        return request_id, root, profiler
+
+    def finish(self, request_id: str, root: Span, profiler: cProfile.Profile | None, status: int | None) -> None:
+        root.duration = time.perf_counter() - root.start
+        _local.stack = None
+        if profiler is not None:
+            profiler.disable()
+            self._profile_lock.release()
+
+        slow = root.duration * 1000 >= self.slow_ms
+        with self._stats_lock:
+            self.traced += 1
+            if slow:
+                self.slow += 1
+        if not slow:
+            return
+
+        entry = {'request_id': request_id, 'time': time.time(), 'status': status, 'trace': root.to_dict()}
+        if profiler is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            entry['profile'] = os.path.join(self.profile_dir, f"{request_id}.prof")
+            profiler.dump_stats(entry['profile'])
+            with self._stats_lock:
+                self.profiled += 1
+        self.logger.info(json.dumps(entry))
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            return {
+                'slow_ms': self.slow_ms,
+                'traced': self.traced,
+                'slow': self.slow,
+                'profiled': self.profiled,
+            }
@@ -0,0 +1,164 @@
+import itertools
+import json
+import struct
+import sys
+import zlib
+from array import array
+from typing import Any, Dict, List
+
+MAGIC = b'FCDB\x02'
+BLOCK_ROWS = 4096
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+# column encodings inside a block
+INT_DELTA = 1
+STRING = 2
+JSON = 3
+
+_MISSING = object()
+
+# columns are little-endian like the struct headers, arrays are swapped on big-endian hosts
+_UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+assert array('q').itemsize == 8 and array(_UINT32).itemsize == 4, "unsupported array item sizes"
+_SWAP = sys.byteorder != 'little'
+
+def _array_bytes(typecode: str, values: List[int]) -> bytes:
+    packed = array(typecode, values)
+    if _SWAP:
+        packed.byteswap()
+    return packed.tobytes()
+
+def _array_from(typecode: str, payload: bytes) -> array:
+    unpacked = array(typecode)
+    unpacked.frombytes(payload)
+    if _SWAP:
+        unpacked.byteswap()
+    return unpacked
+
+def is_binary(data: bytes) -> bool:
+    return data.startswith(MAGIC)
+
+def _pack_name(name: str) -> bytes:
+    encoded = name.encode()
+    return struct.pack('<H', len(encoded)) + encoded
+
+def _encode_column(values: List[Any]) -> tuple[int, bytes]:
+    if values and all(type(v) is int for v in values):
+        deltas = [values[0]] + [b - a for a, b in zip(values, values[1:])]
+        if INT64_MIN <= min(deltas) and max(deltas) <= INT64_MAX:
+            return INT_DELTA, _array_bytes('q', deltas)
+    if all(type(v) is str for v in values):
+        encoded = [v.encode() for v in values]
+        return STRING, _array_bytes(_UINT32, [len(b) for b in encoded]) + b''.join(encoded)
+    return JSON, json.dumps(values).encode()
+
+def _decode_column(encoding: int, payload: bytes, count: int) -> List[Any]:
+    if encoding == INT_DELTA:
+        return list(itertools.accumulate(_array_from('q', payload)))
+    if encoding == STRING:
+        lengths = _array_from(_UINT32, payload[:4 * count])
+        blob = payload[4 * count:]
+        offsets = itertools.accumulate(lengths, initial=0)
+        start = next(offsets)
+        values = []
+        for end in offsets:
+            values.append(blob[start:end].decode())
+            start = end
+        return values
+    if encoding == JSON:
+        return json.loads(payload.decode())
+    raise ValueError(f"unknown column encoding {encoding}")
+
+def _encode_block(columns: List[str], rows: List[Dict[str, Any]], level: int) -> bytes:
+    parts = []
+    for column in columns:
+        present = [column in row for row in rows]
+        values = [row[column] for row in rows if column in row]
+        encoding, payload = _encode_column(values)
+        if all(present):
+            parts.append(struct.pack('<BBI', encoding, 0, len(payload)))
+        else:
+            parts.append(struct.pack('<BBI', encoding, 1, len(payload)))
+            parts.append(bytes(present))
+        parts.append(payload)
+    raw = b''.join(parts)
+    compressed = zlib.compress(raw, level)
+    return struct.pack('<III', len(rows), len(compressed), zlib.crc32(raw)) + compressed
+
+def _decode_block(columns: List[str], raw: bytes, count: int) -> List[Dict[str, Any]]:
+    decoded = []
+    offset = 0
+    for _ in columns:
+        encoding, partial, length = struct.unpack_from('<BBI', raw, offset)
+        offset += 6
+        present = None
+        if partial:
+            present = raw[offset:offset + count]
+            offset += count
+        values = _decode_column(encoding, raw[offset:offset + length], count if present is None else sum(present))
+        offset += length
+        if present is not None:
+            it = iter(values)
+            values = [next(it) if flag else _MISSING for flag in present]
+        decoded.append(values)
+
+    if all(v is not _MISSING for values in decoded for v in values):
+        return [dict(zip(columns, row)) for row in zip(*decoded)]
+    return [
+        {c: v for c, v in zip(columns, row) if v is not _MISSING}
+        for row in zip(*decoded)
+    ]
+
+def encode(tables: Dict[str, List[Dict[str, Any]]], level: int = 6) -> bytes:
+    parts = [MAGIC, struct.pack('<I', len(tables))]
+    for table_name, rows in tables.items():
+        columns: Dict[str, None] = {}
+        for row in rows:
+            for key in row:
+                if key not in columns:
+                    columns[key] = None
+        blocks = [_encode_block(list(columns), rows[i:i + BLOCK_ROWS], level) for i in range(0, len(rows), BLOCK_ROWS)]
+        parts.append(_pack_name(table_name))
+        parts.append(struct.pack('<H', len(columns)))
+        parts.extend(_pack_name(column) for column in columns)
+        parts.append(struct.pack('<I', len(blocks)))
+        parts.extend(blocks)
+    body = b''.join(parts)
+    return body + struct.pack('<I', zlib.crc32(body))
+
+def decode(data: bytes) -> Dict[str, List[Dict[str, Any]]]:
+    if not is_binary(data):
+        raise ValueError("not a binary FreecordDB file")
+    body, (checksum,) = data[:-4], struct.unpack('<I', data[-4:])
+    if zlib.crc32(body) != checksum:
+        raise ValueError("checksum mismatch, the file is corrupted")
+
+    def read_name(offset: int) -> tuple[str, int]:
+        (length,) = struct.unpack_from('<H', body, offset)
+        return body[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+    tables: Dict[str, List[Dict[str, Any]]] = {}
+    offset = len(MAGIC)
+    (table_count,) = struct.unpack_from('<I', body, offset)
+    offset += 4
+    for _ in range(table_count):
+        table_name, offset = read_name(offset)
+        (column_count,) = struct.unpack_from('<H', body, offset)
+        offset += 2
+        columns = []
+        for _ in range(column_count):
+            column, offset = read_name(offset)
+            columns.append(column)
+        (block_count,) = struct.unpack_from('<I', body, offset)
+        offset += 4
+        rows: List[Dict[str, Any]] = []
+        for _ in range(block_count):
+            count, length, block_checksum = struct.unpack_from('<III', body, offset)
+            offset += 12
+            raw = zlib.decompress(body[offset:offset + length])
+            offset += length
+            if zlib.crc32(raw) != block_checksum:
+                raise ValueError(f"checksum mismatch in a block of table '{table_name}'")
+            rows.extend(_decode_block(columns, raw, count))
+        tables[table_name] = rows
+    return tables
@@ -0,0 +1,49 @@
+import collections
+import secrets
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+class ChangeStream:
+    def __init__(self, retention: int = 100000):
+        self.epoch = secrets.token_hex(8)
+        self.seq = 0
+        self._entries: collections.deque = collections.deque(maxlen=retention)
+        self._cond = threading.Condition()
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+    def subscribe(self, listener: Callable[[Dict[str, Any]], None]) -> None:
+        self._listeners.append(listener)
+
+    def publish(self, source: str, op: str, table: str, **payload: Any) -> Dict[str, Any]:
+        with self._cond:
+            self.seq += 1
+            entry = {'seq': self.seq, 'ts': time.time(), 'source': source, 'op': op, 'table': table, **payload}
+            self._entries.append(entry)
+            self._cond.notify_all()
+        for listener in self._listeners:
+            listener(entry)
+        return entry
+
+    def reset(self) -> None:
+        # after the tables are replaced wholesale, old cursors describe another history and must resync
+        with self._cond:
+            self.epoch = secrets.token_hex(8)
+            self._entries.clear()
+            self._cond.notify_all()
+
+    def first_seq(self) -> int:
+        with self._cond:
+            return self._entries[0]['seq'] if self._entries else self.seq + 1
+
+    def since(self, seq: int, limit: int = 1000, wait: float = 0) -> Optional[List[Dict[str, Any]]]:
+        with self._cond:
+            if wait > 0 and self.seq <= seq:
+                self._cond.wait_for(lambda: self.seq > seq, timeout=wait)
+            if self.seq <= seq:
+                return []
+            first = self._entries[0]['seq'] if self._entries else self.seq + 1
+            if seq + 1 < first:
+                return None
+            start = seq + 1 - first
+            return [self._entries[i] for i in range(start, min(start + limit, len(self._entries)))]
@@ -1,47 +1,247 @@
+import bisect
 import json
 import zlib
 import os
 import threading
-from typing import Any, Dict, List, Optional
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional
+from modules import Tracing
+from modules.database import BinaryFormat
+from modules.database.ChangeStream import ChangeStream
+
+# deleted rows keep their id and this marker until the table is compacted
+TOMBSTONE = '_deleted'
+# saved next to the tables, holds the row id counters
+META_TABLE = '__meta__'
+# rows copied per lock hold by iter_rows
+ITER_BATCH = 256
+
+_row_id = itemgetter('id')
 
 class FreecordDB:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, change_stream: Optional[ChangeStream] = None,
+                 stream_source: str = 'main', in_memory: bool = False,
+                 storage_format: str = 'json', compression_level: int = 9):
+        if storage_format not in ('json', 'binary'):
+            raise ValueError(f"unknown storage format '{storage_format}'")
         self.db_path = db_path if db_path.endswith('.fcdb') else f"{db_path}.fcdb"
+        self.log_path = self.db_path + '.log'
         self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.next_ids: Dict[str, int] = {}
+        self.tombstones: Dict[str, int] = {}
+        self.change_stream = change_stream
+        self.stream_source = stream_source
+        self.in_memory = in_memory
+        self.storage_format = storage_format
+        self.compression_level = compression_level
         self._lock = threading.RLock()
+        self._undo_log: Optional[List[tuple]] = None
+        self._pending_changes: List[tuple] = []
+        self._index_columns: Dict[str, List[str]] = {}
+        # (table, column) -> value -> {row id: row}
+        self._indexes: Dict[tuple, Dict[Any, Dict[int, Dict[str, Any]]]] = {}
         self.load_or_create()
 
     def load_or_create(self) -> None:
-        if os.path.exists(self.db_path):
+        if self.in_memory:
+            self.replace_tables({})
+        elif os.path.exists(self.db_path):
             self._load_from_file()
         else:
-            self.tables = {}
+            self.replace_tables({})
             self.save()
 
     def _load_from_file(self) -> None:
         try:
             with open(self.db_path, 'rb') as f:
-                compressed_data = f.read()
-            decompressed_data = zlib.decompress(compressed_data)
-            self.tables = json.loads(decompressed_data.decode())
+                data = f.read()
+            tables = decode_file(data)
         except Exception as e:
             raise ValueError(f"Failed to load database: {e}")
+        meta = tables.pop(META_TABLE, None) or [{}]
+        self.replace_tables(tables, meta[0].get('next_ids'))
+        self._replay_log()
+
+    def replace_tables(self, tables: Dict[str, List[Dict[str, Any]]], next_ids: Optional[Dict[str, int]] = None) -> None:
+        with self._lock:
+            for rows in tables.values():
+                if any(a['id'] >= b['id'] for a, b in zip(rows, rows[1:])):
+                    # files from before ids were monotonic repeat ids after a delete
+                    for row_id, row in enumerate(rows):
+                        row['id'] = row_id
+            self.tables = tables
+            self.next_ids = dict(next_ids or {})
+            for table_name, rows in tables.items():
+                if rows:
+                    self.next_ids[table_name] = max(self.next_ids.get(table_name, 0), rows[-1]['id'] + 1)
+                self.next_ids.setdefault(table_name, 0)
+            self.tombstones = {}
+            for table_name in tables:
+                self._refresh_table(table_name)
 
+    def _replay_log(self) -> None:
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a torn write at the tail, everything before it is intact
+                    break
+                rows = self._rows_by_ids(entry['table'], entry['ids'])
+                for row in rows:
+                    if entry['op'] == 'delete':
+                        self._tombstone(entry['table'], row)
+                    else:
+                        self._set_fields(entry['table'], row, entry['data'])
+
+    def _append_log(self, op: str, table_name: str, ids: List[int], data: Optional[Dict[str, Any]] = None) -> None:
+        # inside a transaction the commit saves the whole file instead
+        if self.in_memory or self._undo_log is not None:
+            return
+        entry: Dict[str, Any] = {'op': op, 'table': table_name, 'ids': ids}
+        if data is not None:
+            entry['data'] = data
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _publish(self, op: str, table_name: str, **payload: Any) -> None:
+        if self.change_stream is None:
+            return
+        if self._undo_log is not None:
+            self._pending_changes.append((op, table_name, payload))
+        else:
+            self.change_stream.publish(self.stream_source, op, table_name, **payload)
+
+    def _record_undo(self, *action: Any) -> None:
+        if self._undo_log is not None:
+            self._undo_log.append(action)
+
+    @contextmanager
+    def transaction(self) -> Iterator['FreecordDB']:
+        with self._lock:
+            if self._undo_log is not None:
+                yield self
+                return
+            self._undo_log = []
+            self._pending_changes = []
+            try:
+                yield self
+            except BaseException:
+                self._rollback()
+                raise
+            undo_log, self._undo_log = self._undo_log, None
+            pending, self._pending_changes = self._pending_changes, []
+            for op, table_name, payload in pending:
+                self._publish(op, table_name, **payload)
+            if undo_log:
+                self.save()
+
+    def _rollback(self) -> None:
+        undo_log, self._undo_log = self._undo_log or [], None
+        self._pending_changes = []
+        touched = set()
+        for action in reversed(undo_log):
+            kind, table_name = action[0], action[1]
+            touched.add(table_name)
+            if kind == 'insert':
+                self.tables[table_name].pop()
+            elif kind == 'update':
+                row, old_row = action[2], action[3]
+                row.clear()
+                row.update(old_row)
+            elif kind == 'create_table':
+                del self.tables[table_name]
+            elif kind in ('delete', 'drop_table'):
+                self.tables[table_name] = action[2]
+        for table_name in touched:
+            self._refresh_table(table_name)
+
+    @Tracing.traced_query
     def save(self) -> None:
+        if self.in_memory:
+            return
         with self._lock:
+            if self._undo_log is not None:
+                return
             tmp_path = self.db_path + '.tmp'
-            json_data = json.dumps(self.tables).encode()
-            compressed_data = zlib.compress(json_data, level=9)
+            tables = {**self.tables, META_TABLE: [{'next_ids': self.next_ids}]}
+            data = encode_file(tables, self.storage_format, self.compression_level)
             with open(tmp_path, 'wb') as f:
-                f.write(compressed_data)
+                f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
             os.replace(tmp_path, self.db_path)
+            # the saved file already has every logged change
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+
+    def create_index(self, table_name: str, column: str) -> None:
+        with self._lock:
+            columns = self._index_columns.setdefault(table_name, [])
+            if column not in columns:
+                columns.append(column)
+                self._build_index(table_name, column)
+
+    def _build_index(self, table_name: str, column: str) -> None:
+        index: Dict[Any, Dict[int, Dict[str, Any]]] = {}
+        for row in self.tables.get(table_name, ()):
+            if column in row:
+                index.setdefault(row[column], {})[row['id']] = row
+        self._indexes[(table_name, column)] = index
+
+    def _refresh_table(self, table_name: str) -> None:
+        self.tombstones[table_name] = sum(TOMBSTONE in row for row in self.tables.get(table_name, ()))
+        for column in self._index_columns.get(table_name, ()):
+            self._build_index(table_name, column)
+
+    def _index_add(self, table_name: str, row: Dict[str, Any], columns: Optional[List[str]] = None) -> None:
+        for column in self._index_columns.get(table_name, ()) if columns is None else columns:
+            if column in row:
+                self._indexes[(table_name, column)].setdefault(row[column], {})[row['id']] = row
+
+    def _index_remove(self, table_name: str, row: Dict[str, Any], columns: Optional[List[str]] = None) -> None:
+        for column in self._index_columns.get(table_name, ()) if columns is None else columns:
+            index = self._indexes[(table_name, column)]
+            value = row.get(column)
+            bucket = index.get(value)
+            if bucket is not None:
+                bucket.pop(row['id'], None)
+                if not bucket:
+                    del index[value]
+
+    def _candidates(self, table_name: str, where: Dict[str, Any]) -> List[Dict[str, Any]]:
+        for column in self._index_columns.get(table_name, ()):
+            if column in where:
+                bucket = self._indexes[(table_name, column)].get(where[column])
+                # copying a dict of plain rows holds the GIL, so readers need no lock
+                return list(bucket.values()) if bucket else []
+        return self.tables[table_name]
+
+    def _rows_by_ids(self, table_name: str, ids: List[int]) -> List[Dict[str, Any]]:
+        rows = self.tables.get(table_name, [])
+        found = []
+        for row_id in ids:
+            index = bisect.bisect_left(rows, row_id, key=_row_id)
+            if index < len(rows) and rows[index]['id'] == row_id and TOMBSTONE not in rows[index]:
+                found.append(rows[index])
+        return found
 
     def create_table(self, table_name: str) -> None:
         if table_name in self.tables:
             raise ValueError(f"table '{table_name}' already exists")
-        self.tables[table_name] = []
+        if table_name == META_TABLE:
+            raise ValueError(f"'{META_TABLE}' is a reserved table name")
+        with self._lock:
+            self.tables[table_name] = []
+            self.next_ids.setdefault(table_name, 0)
+            self._refresh_table(table_name)
+            self._record_undo('create_table', table_name)
+            self._publish('create_table', table_name)
         self.save()
 
     def exists_table(self, table_name: str) -> bool:
@@ -50,43 +250,90 @@ class FreecordDB:
     def drop_table(self, table_name: str) -> None:
         if table_name not in self.tables:
             raise ValueError(f"table '{table_name}' doesn't exist")
-        del self.tables[table_name]
+        with self._lock:
+            self._record_undo('drop_table', table_name, self.tables.pop(table_name))
+            self._refresh_table(table_name)
+            self._publish('drop_table', table_name)
         self.save()
 
     def list_tables(self) -> List[str]:
         return list(self.tables.keys())
 
+    @Tracing.traced_query
     def insert(self, table_name: str, data: Dict[str, Any], save: bool = True) -> int:
         if table_name not in self.tables:
             raise ValueError(f"table '{table_name}' doesn't exist")
         with self._lock:
-            row_id = len(self.tables[table_name])
-            row = {'id': row_id, **data}
-            self.tables[table_name].append(row)
+            row_id = self.next_ids.get(table_name, 0)
+            self._append_row(table_name, {'id': row_id, **data})
         if save:
             self.save()
         return row_id
 
+    def _append_row(self, table_name: str, row: Dict[str, Any]) -> None:
+        self.tables[table_name].append(row)
+        self.next_ids[table_name] = max(self.next_ids.get(table_name, 0), row['id'] + 1)
+        self._index_add(table_name, row)
+        self._record_undo('insert', table_name)
+        self._publish('insert', table_name, row=dict(row))
+
+    @Tracing.traced_query
     def exists(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> bool:
         if table_name not in self.tables:
             raise ValueError(f"Table '{table_name}' does not exist")
-        rows = self.tables[table_name]
         if where is None:
-            return len(rows) > 0
-        for row in rows:
+            return len(self.tables[table_name]) > self.tombstones.get(table_name, 0)
+        rows = self._candidates(table_name, where)
+        for scanned, row in enumerate(rows, 1):
             if self._row_matches_conditions(row, where):
+                Tracing.add_rows(scanned)
                 return True
+        Tracing.add_rows(len(rows))
         return False
 
+    @Tracing.traced_query
     def select(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         if table_name not in self.tables:
             raise ValueError(f"table '{table_name}' does not exist")
         rows = self.tables[table_name]
         if where is None:
-            return rows.copy()
-        return self._filter_rows(rows, where)
+            if not self.tombstones.get(table_name):
+                return rows.copy()
+            return [row for row in rows if TOMBSTONE not in row]
+        return self._filter_rows(self._candidates(table_name, where), where)
+
+    def iter_rows(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        if table_name not in self.tables:
+            raise ValueError(f"table '{table_name}' does not exist")
+        where = where or {}
+        # rows are copied a batch at a time under the lock, edits and compaction can't change one mid-read
+        for column in self._index_columns.get(table_name, ()):
+            if column in where:
+                with self._lock:
+                    bucket = self._indexes[(table_name, column)].get(where[column])
+                    row_ids = sorted(bucket) if bucket else []
+                for start in range(0, len(row_ids), ITER_BATCH):
+                    with self._lock:
+                        bucket = self._indexes[(table_name, column)].get(where[column]) or {}
+                        batch = [dict(row) for row in map(bucket.get, row_ids[start:start + ITER_BATCH])
+                                 if row is not None and self._row_matches_conditions(row, where)]
+                    yield from batch
+                return
+        # rows are kept in id order, so the next batch starts after the last id seen even if the list was rebuilt
+        last_id = None
+        while True:
+            with self._lock:
+                rows = self.tables.get(table_name, [])
+                start = 0 if last_id is None else bisect.bisect_right(rows, last_id, key=_row_id)
+                chunk = rows[start:start + ITER_BATCH]
+                batch = [dict(row) for row in chunk if self._row_matches_conditions(row, where)]
+            if not chunk:
+                return
+            last_id = chunk[-1]['id']
+            yield from batch
 
     def _filter_rows(self, rows: List[Dict[str, Any]], where: Dict[str, Any]) -> List[Dict[str, Any]]:
+        Tracing.add_rows(len(rows))
         result = []
         for row in rows:
             if self._row_matches_conditions(row, where):
@@ -94,39 +341,150 @@ class FreecordDB:
         return result
 
     def _row_matches_conditions(self, row: Dict[str, Any], conditions: Dict[str, Any]) -> bool:
+        if TOMBSTONE in row:
+            return False
         for key, value in conditions.items():
             if key not in row or row[key] != value:
                 return False
         return True
 
+    def _set_fields(self, table_name: str, row: Dict[str, Any], data: Dict[str, Any]) -> None:
+        moved = [c for c in self._index_columns.get(table_name, ()) if c in data and row.get(c) != data[c]]
+        if moved:
+            self._index_remove(table_name, row, moved)
+        row.update(data)
+        if moved:
+            self._index_add(table_name, row, moved)
+
+    def _tombstone(self, table_name: str, row: Dict[str, Any]) -> None:
+        self._index_remove(table_name, row)
+        row_id = row['id']
+        row.clear()
+        row['id'] = row_id
+        row[TOMBSTONE] = True
+        self.tombstones[table_name] = self.tombstones.get(table_name, 0) + 1
+
+    def _update_rows(self, table_name: str, rows: List[Dict[str, Any]], data: Dict[str, Any]) -> int:
+        if not rows:
+            return 0
+        old_rows = [dict(row) for row in rows]
+        for row, old_row in zip(rows, old_rows):
+            self._record_undo('update', table_name, row, old_row)
+            self._set_fields(table_name, row, data)
+        self._publish('update', table_name, rows=old_rows, data=dict(data))
+        self._append_log('update', table_name, [row['id'] for row in old_rows], data)
+        return len(rows)
+
+    def _delete_rows(self, table_name: str, rows: List[Dict[str, Any]]) -> int:
+        if not rows:
+            return 0
+        deleted = [dict(row) for row in rows]
+        for row, old_row in zip(rows, deleted):
+            self._record_undo('update', table_name, row, old_row)
+            self._tombstone(table_name, row)
+        self._publish('delete', table_name, rows=deleted)
+        self._append_log('delete', table_name, [row['id'] for row in deleted])
+        return len(deleted)
+
+    @Tracing.traced_query
     def update(self, table_name: str, where: Dict[str, Any], data: Dict[str, Any]) -> int:
         if table_name not in self.tables:
             raise ValueError(f"Table '{table_name}' does not exist")
-        count = 0
         with self._lock:
-            for row in self.tables[table_name]:
-                if self._row_matches_conditions(row, where):
-                    row.update(data)
-                    count += 1
-        if count > 0:
-            self.save()
-        return count
+            return self._update_rows(table_name, self._filter_rows(self._candidates(table_name, where), where), data)
 
+    @Tracing.traced_query
     def delete(self, table_name: str, where: Dict[str, Any]) -> int:
         if table_name not in self.tables:
             raise ValueError(f"Table '{table_name}' does not exist")
         with self._lock:
-            original_count = len(self.tables[table_name])
+            return self._delete_rows(table_name, self._filter_rows(self._candidates(table_name, where), where))
+
+    @Tracing.traced_query
+    def delete_in(self, table_name: str, column: str, values: List[Any]) -> int:
+        # one change entry and one log append for the whole batch
+        if table_name not in self.tables:
+            raise ValueError(f"Table '{table_name}' does not exist")
+        with self._lock:
+            rows: Dict[int, Dict[str, Any]] = {}
+            for value in values:
+                for row in self._filter_rows(self._candidates(table_name, {column: value}), {column: value}):
+                    rows[row['id']] = row
+            return self._delete_rows(table_name, [rows[row_id] for row_id in sorted(rows)])
+
+    @Tracing.traced_query
+    def compact(self, table_name: Optional[str] = None) -> int:
+        removed = 0
+        with self._lock:
+            for name in [table_name] if table_name else list(self.tables):
+                if not self.tombstones.get(name):
+                    continue
+                rows = self.tables[name]
+                self.tables[name] = [row for row in rows if TOMBSTONE not in row]
+                self._record_undo('delete', name, rows)
+                removed += len(rows) - len(self.tables[name])
+                self.tombstones[name] = 0
+                self._publish('compact', name)
+        if removed:
+            self.save()
+        return removed
+
+    @Tracing.traced_query
+    def archive_older_than(self, table_name: str, group_key: str, id_column: str, cutoff: float,
+                           archive: Any = None) -> int:
+        if table_name not in self.tables:
+            raise ValueError(f"Table '{table_name}' does not exist")
+        with self._lock:
+            rows = self.tables[table_name]
+            groups: Dict[Any, List[Dict[str, Any]]] = {}
+            for row in rows:
+                if row.get('timestamp', cutoff) < cutoff:
+                    groups.setdefault(row[group_key], []).append(row)
+            if not groups:
+                return 0
+            if archive is not None:
+                for key, group in groups.items():
+                    archive.write_segments(table_name, key, group)
+            # tombstones go too, the list is rebuilt anyway
             self.tables[table_name] = [
-                row for row in self.tables[table_name]
-                if not all(row.get(k) == v for k, v in where.items())
+                row for row in rows if TOMBSTONE not in row and row.get('timestamp', cutoff) >= cutoff
             ]
-            deleted_count = original_count - len(self.tables[table_name])
-        if deleted_count > 0:
+            self._record_undo('delete', table_name, rows)
+            self._refresh_table(table_name)
+            # listeners drop just these ids instead of rescanning the table
+            archived = [[key, [row[id_column] for row in group]] for key, group in groups.items()]
+            self._publish('archive', table_name, key=group_key, id_column=id_column, cutoff=cutoff,
+                          archived=archived)
+        self.save()
+        return sum(len(group) for group in groups.values())
+
+    def apply_change(self, entry: Dict[str, Any]) -> None:
+        op, table_name = entry['op'], entry['table']
+        if op == 'create_table':
+            self.create_table(table_name)
+        elif op == 'drop_table':
+            self.drop_table(table_name)
+        elif op == 'insert':
+            with self._lock:
+                self._append_row(table_name, dict(entry['row']))
             self.save()
-        return deleted_count
+        elif op in ('update', 'delete'):
+            with self._lock:
+                rows = self._rows_by_ids(table_name, [row['id'] for row in entry['rows']])
+                if op == 'update':
+                    self._update_rows(table_name, rows, entry['data'])
+                else:
+                    self._delete_rows(table_name, rows)
+        elif op == 'compact':
+            self.compact(table_name)
+        elif op == 'archive':
+            self.archive_older_than(table_name, entry['key'], entry['id_column'], entry['cutoff'])
+        else:
+            raise ValueError(f"unknown change '{op}'")
 
     def count(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> int:
+        if where is None and table_name in self.tables:
+            return len(self.tables[table_name]) - self.tombstones.get(table_name, 0)
         return len(self.select(table_name, where))
 
     def close(self) -> None:
@@ -137,7 +495,19 @@ class FreecordDB:
             'file': self.db_path,
             'tables': len(self.tables),
             'table_info': {
-                name: len(rows) for name, rows in self.tables.items()
+                name: len(rows) - self.tombstones.get(name, 0) for name, rows in self.tables.items()
             },
-            'file_size': os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
-        }
\ No newline at end of file
+            'tombstones': sum(self.tombstones.values()),
+            'file_size': os.path.getsize(self.db_path) if not self.in_memory and os.path.exists(self.db_path) else 0,
+            'log_size': os.path.getsize(self.log_path) if not self.in_memory and os.path.exists(self.log_path) else 0,
+        }
+
+def encode_file(tables: Dict[str, List[Dict[str, Any]]], storage_format: str = 'json', compression_level: int = 9) -> bytes:
+    if storage_format == 'binary':
+        return BinaryFormat.encode(tables, compression_level)
+    return zlib.compress(json.dumps(tables).encode(), level=compression_level)
+
+def decode_file(data: bytes) -> Dict[str, List[Dict[str, Any]]]:
+    if BinaryFormat.is_binary(data):
+        return BinaryFormat.decode(data)
+    return json.loads(zlib.decompress(data).decode())
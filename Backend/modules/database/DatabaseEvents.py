@@ -1,7 +1,11 @@
-from modules.database import Database
+from modules import Tracing
+from modules.EphemeralStore import EphemeralStore
+from modules.database import ShardRouter
 from modules.database.IDManager import SnowflakeIDGenerator
+from modules.database.SearchIndex import tokenize
 import secrets
 import time
+from typing import Iterator
 
 """
 int('1' + str(SnowflakeIDGenerator.generate_id))
@@ -16,9 +20,30 @@ This is the whole list
 6 - DM Messages
 """
 
+PAGE_SIZE = 50
+# messages reference uploaded files by id, the bytes never enter the database
+MAX_ATTACHMENTS = 10
+
+# change stream entries read per /sync call; clients with more pending call again
+SYNC_BATCH = 1000
+
+# presence is refreshed by client heartbeats, typing by keystrokes; both live only in an EphemeralStore
+PRESENCE_STATUSES = ('online', 'idle', 'dnd')
+PRESENCE_TTL = 60
+TYPING_TTL = 8
+MAX_PRESENCE_IDS = 200
+MAX_USER_IDS = 200
+MAX_INVITE_AGE = 30 * 24 * 3600
+# a retried send with the same nonce inside this window returns the first message instead of a new one
+NONCE_TTL = 300
+# a retry that overlaps the first attempt gets this error right away, the route turns it into a 409
+NONCE_PENDING = "A message with this nonce is still being sent"
+MAX_NONCE_LENGTH = 64
+
 _token_cache: dict[str, dict] = {}
+TOKEN_CACHE_SIZE = 10_000
 
-def _resolve_user(user_token: str, db: Database.FreecordDB) -> dict | None:
+def _resolve_user(user_token: str, db: ShardRouter.ShardedFreecordDB) -> dict | None:
     if user_token in _token_cache:
         return _token_cache[user_token]
     users = db.select('users', {'user_token': user_token})
@@ -27,61 +52,242 @@ def _resolve_user(user_token: str, db: Database.FreecordDB) -> dict | None:
     _token_cache[user_token] = users[0]
     return users[0]
 
-def _is_member(server_id: int, user_id: int, db: Database.FreecordDB) -> bool:
+def cached_user_id(user_token: str) -> int | None:
+    # only tokens a handler has already resolved are known, so this never reads the database
+    user = _token_cache.get(user_token)
+    return user['user_id'] if user is not None else None
+
+def prune_token_cache(max_entries: int = TOKEN_CACHE_SIZE, deadline: float | None = None) -> int:
+    # the oldest resolved tokens go first; a pruned token is just looked up again on its next request
+    excess = len(_token_cache) - max_entries
+    if excess <= 0:
+        return 0
+    # list() copies the keys in one step, so request threads adding tokens meanwhile can't break the loop
+    pruned = 0
+    for token in list(_token_cache)[:excess]:
+        if pruned % 1024 == 0 and deadline is not None and time.monotonic() >= deadline:
+            break
+        _token_cache.pop(token, None)
+        pruned += 1
+    return pruned
+
+def _is_member(server_id: int, user_id: int, db: ShardRouter.ShardedFreecordDB) -> bool:
     return db.exists('members', {'server_id': server_id, 'user_id': user_id})
 
-def _add_member(server_id: int, user_id: int, db: Database.FreecordDB) -> tuple[bool, str]:
+def _add_member(server_id: int, user_id: int, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str]:
     if _is_member(server_id, user_id, db):
         return False, "User is already a member of this server"
     db.insert('members', {'server_id': server_id, 'user_id': user_id})
     return True, "Member added"
 
-def _get_or_create_dm_channel(user_id_a: int, user_id_b: int, db: Database.FreecordDB) -> int:
+def _get_or_create_dm_channel(user_id_a: int, user_id_b: int, db: ShardRouter.ShardedFreecordDB) -> int:
     lo, hi = min(user_id_a, user_id_b), max(user_id_a, user_id_b)
     existing = db.select('dm_channels', {'user1_id': lo, 'user2_id': hi})
     if existing:
         return existing[0]['dm_channel_id']
     dm_channel_id = int('5' + str(SnowflakeIDGenerator().generate_id()))
-    db.insert('dm_channels', {'dm_channel_id': dm_channel_id, 'user1_id': lo, 'user2_id': hi}, save=False)
+    db.insert('dm_channels', {'dm_channel_id': dm_channel_id, 'user1_id': lo, 'user2_id': hi})
     return dm_channel_id
 
-def add_user(username: str, hashed_passwd: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
-    if db.exists('users', {'username': username}):
-        return False, "User already exists", {}
+def _user_dm_channels(user_id: int, db: ShardRouter.ShardedFreecordDB) -> list:
+    return [c for c in db.select('dm_channels', None) if c['user1_id'] == user_id or c['user2_id'] == user_id]
+
+def _page_rows(table_name: str, key: str, channel_id: int, before: int | None, db: ShardRouter.ShardedFreecordDB) -> list:
+    if before is None:
+        # the newest page of a busy channel comes straight from the hot tail cache
+        page = db.latest_messages(table_name, channel_id, PAGE_SIZE)
+    else:
+        messages = [m for m in db.select(table_name, {key: channel_id}) if m['message_id'] < before]
+        page = messages[-PAGE_SIZE:]
+
+    if len(page) < PAGE_SIZE:
+        older_than = page[0]['message_id'] if page else before
+        page = db.archive.read_before(table_name, channel_id, older_than, PAGE_SIZE - len(page)) + page
+    return page
+
+def _message_page(table_name: str, key: str, channel_id: int, before: int | None, db: ShardRouter.ShardedFreecordDB) -> list:
+    page = _page_rows(table_name, key, channel_id, before, db)
+    return [
+        {
+            'message_id': m['message_id'],
+            'author_id': m['author_id'],
+            'content': m['content'],
+            'timestamp': m['timestamp'],
+            'edited_timestamp': m.get('edited_timestamp'),
+            'attachments': m.get('attachments', []),
+        }
+        for m in page
+    ]
 
-    try:
-        user_token = f"FCT_{secrets.token_urlsafe(84)}"
-        user_id = int('1' + str(SnowflakeIDGenerator().generate_id()))
-        db.insert('users', {
-            'username': username,
-            'hashed_passwd': hashed_passwd,
-            'user_token': user_token,
-            'user_id': user_id,
-        })
-    except Exception as e:
-        return False, f"Failed to add user: {e}", {}
+def _claim_nonce(key: tuple, nonce: str | None, store: EphemeralStore | None) -> tuple[str | None, int | None]:
+    if nonce is None or store is None:
+        return None, None
+    if len(nonce) > MAX_NONCE_LENGTH:
+        return f"nonce is limited to {MAX_NONCE_LENGTH} characters", None
+    # None marks a send that is still in progress, waiting on it would pin a worker for the whole send
+    added, message_id = store.add('nonce', key, None, NONCE_TTL)
+    if added:
+        return None, None
+    if message_id is None:
+        return NONCE_PENDING, None
+    return None, message_id
+
+def _settle_nonce(key: tuple, nonce: str | None, store: EphemeralStore | None, message_id: int | None) -> None:
+    if nonce is None or store is None:
+        return
+    if message_id is None:
+        store.delete('nonce', key)
+    else:
+        store.set('nonce', key, message_id, NONCE_TTL)
+
+def _users_by_ids(user_ids, db: ShardRouter.ShardedFreecordDB) -> dict[int, dict]:
+    users = {}
+    for user_id in user_ids:
+        if user_id not in users:
+            # users is indexed on user_id, so each lookup is a dict hit rather than a scan
+            found = db.select('users', {'user_id': user_id})
+            if found:
+                users[user_id] = {'user_id': found[0]['user_id'], 'username': found[0]['username']}
+    return users
+
+def _load_search_results(query: str, hits: list, db: ShardRouter.ShardedFreecordDB) -> list:
+    wanted: dict[tuple, set] = {}
+    for message_id, table_name, channel_id, *_ in hits:
+        wanted.setdefault((table_name, channel_id), set()).add(message_id)
+
+    rows = {}
+    for (table_name, channel_id), ids in wanted.items():
+        key = 'channel_id' if table_name == 'messages' else 'dm_channel_id'
+        for m in db.select(table_name, {key: channel_id}):
+            if m['message_id'] in ids:
+                rows[m['message_id']] = m
+        missing = ids - rows.keys()
+        if missing:
+            for m in db.archive.find(table_name, channel_id, missing):
+                rows[m['message_id']] = m
+
+    # the index on disk can trail the tables after a crash, so a hit only counts if the live text still matches
+    tokens = tokenize(query)
+    return [
+        _message_dict(table_name, rows[message_id]) for message_id, table_name, *_ in hits
+        if message_id in rows and tokens <= tokenize(rows[message_id]['content'])
+    ]
+
+def _can_see_attachment(attachment_id: str, user_id: int, db: ShardRouter.ShardedFreecordDB) -> bool:
+    # the uploader, and anyone who can read a channel or DM the attachment was posted to
+    for ref in db.select('attachment_refs', {'attachment_id': attachment_id}):
+        if ref.get('user_id') == user_id:
+            return True
+        if 'server_id' in ref and _is_member(ref['server_id'], user_id, db):
+            return True
+        if 'dm_channel_id' in ref:
+            dm_channel = db.select('dm_channels', {'dm_channel_id': ref['dm_channel_id']})
+            if dm_channel and user_id in (dm_channel[0]['user1_id'], dm_channel[0]['user2_id']):
+                return True
+    return False
+
+def _add_attachment_refs(attachments, ref: dict, db: ShardRouter.ShardedFreecordDB) -> None:
+    for attachment_id in attachments or ():
+        where = {'attachment_id': attachment_id, **ref}
+        if not db.exists('attachment_refs', where):
+            db.insert('attachment_refs', where)
+
+def _message_dict(table_name: str, m: dict) -> dict:
+    key = ShardRouter.CHANNEL_KEYS[table_name]
+    return {
+        'message_id': m['message_id'],
+        key: m[key],
+        'author_id': m['author_id'],
+        'content': m['content'],
+        'timestamp': m['timestamp'],
+        'edited_timestamp': m.get('edited_timestamp'),
+        'attachments': m.get('attachments', []),
+    }
+
+def _resolve_channel(user: dict, db: ShardRouter.ShardedFreecordDB, channel_id: int | None,
+                     other_user_id: int | None) -> tuple[str | None, int]:
+    if channel_id is not None:
+        channel_list = db.select('channels', {'channel_id': channel_id})
+        if not channel_list:
+            return "Channel not found", 0
+        if not _is_member(channel_list[0]['server_id'], user['user_id'], db):
+            return "You are not a member of this server", 0
+        return None, channel_id
+    if other_user_id is not None:
+        lo, hi = min(user['user_id'], other_user_id), max(user['user_id'], other_user_id)
+        dm_channel = db.select('dm_channels', {'user1_id': lo, 'user2_id': hi})
+        if not dm_channel:
+            return "DM channel not found", 0
+        return None, dm_channel[0]['dm_channel_id']
+    return "Missing channel_id or user_id", 0
+
+def _find_message(message_id: int, user: dict, db: ShardRouter.ShardedFreecordDB, channel_id: int | None,
+                  other_user_id: int | None) -> tuple[str | None, str, dict, dict | None]:
+    error, target_id = _resolve_channel(user, db, channel_id, other_user_id)
+    if error is not None:
+        return error, '', {}, None
+    if channel_id is not None:
+        table_name, where = 'messages', {'message_id': message_id, 'channel_id': target_id}
+    else:
+        table_name, where = 'dm_messages', {'message_id': message_id, 'dm_channel_id': target_id}
+
+    messages = db.select(table_name, where)
+    if not messages:
+        # archived messages live in immutable segment files and can't be changed
+        if db.archive.find(table_name, target_id, {message_id}):
+            return "Message is archived and read-only", '', {}, None
+        return "Message not found", '', {}, None
+    return None, table_name, where, messages[0]
+
+def _message_in_channel(table_name: str, channel_id: int, message_id: int, db: ShardRouter.ShardedFreecordDB) -> bool:
+    key = ShardRouter.CHANNEL_KEYS[table_name]
+    if db.exists(table_name, {'message_id': message_id, key: channel_id}):
+        return True
+    return bool(db.archive.find(table_name, channel_id, {message_id}))
+
+@Tracing.traced
+def add_user(username: str, hashed_passwd: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    # the name check and the insert share the global lock, so two signups can't both take a name
+    with db.transaction():
+        if db.exists('users', {'username': username}):
+            return False, "User already exists", {}
+
+        try:
+            user_token = f"FCT_{secrets.token_urlsafe(84)}"
+            user_id = int('1' + str(SnowflakeIDGenerator().generate_id()))
+            db.insert('users', {
+                'username': username,
+                'hashed_passwd': hashed_passwd,
+                'user_token': user_token,
+                'user_id': user_id,
+            })
+        except Exception as e:
+            return False, f"Failed to add user: {e}", {}
 
     return True, "User added successfully", {'user_id': user_id, 'user_token': user_token}
 
-def add_server(name: str, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def add_server(name: str, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", {}
 
     try:
         server_id = int('2' + str(SnowflakeIDGenerator().generate_id()))
-        db.insert('servers', {
-            'name': name,
-            'server_id': server_id,
-            'owner_id': user['user_id'],
-        }, save=False)
-        _add_member(server_id, user['user_id'], db)
+        with db.transaction(server_id):
+            db.insert('servers', {
+                'name': name,
+                'server_id': server_id,
+                'owner_id': user['user_id'],
+            })
+            _add_member(server_id, user['user_id'], db)
     except Exception as e:
         return False, f"Failed to create server: {e}", {}
 
     return True, "Server created successfully", {'server_id': server_id}
 
-def get_user_servers(user_token: str, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_user_servers(user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", []
@@ -104,7 +310,8 @@ def get_user_servers(user_token: str, db: Database.FreecordDB) -> tuple[bool, st
     ]
     return True, "OK", result
 
-def add_channel(name: str, server_id: int, user_token: str, channel_type: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def add_channel(name: str, server_id: int, user_token: str, channel_type: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", {}
@@ -132,7 +339,8 @@ def add_channel(name: str, server_id: int, user_token: str, channel_type: str, d
 
     return True, "Channel created successfully", {'channel_id': channel_id}
 
-def get_server_channels(server_id: int, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_server_channels(server_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", []
@@ -149,30 +357,42 @@ def get_server_channels(server_id: int, user_token: str, db: Database.FreecordDB
         for c in channels
     ]
 
-def create_invite(server_id: int, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def create_invite(server_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB, max_age: int | None = None,
+                  max_uses: int | None = None) -> tuple[bool, str, dict]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", {}
 
+    if max_age is not None and not 0 < max_age <= MAX_INVITE_AGE:
+        return False, f"max_age must be between 1 and {MAX_INVITE_AGE} seconds", {}
+
+    if max_uses is not None and max_uses < 1:
+        return False, "max_uses must be at least 1", {}
+
     if not db.exists('servers', {'server_id': server_id}):
         return False, "Server not found", {}
 
     if not _is_member(server_id, user['user_id'], db):
         return False, "You are not a member of this server", {}
 
+    expires_at = int(time.time()) + max_age if max_age is not None else None
     try:
         invite_code = secrets.token_urlsafe(8)
         db.insert('invites', {
             'invite_code': invite_code,
             'server_id': server_id,
             'creator_id': user['user_id'],
+            **({'expires_at': expires_at} if expires_at is not None else {}),
+            **({'max_uses': max_uses, 'uses': 0} if max_uses is not None else {}),
         })
     except Exception as e:
         return False, f"Failed to create invite: {e}", {}
 
-    return True, "Invite created", {'invite_code': invite_code}
+    return True, "Invite created", {'invite_code': invite_code, 'expires_at': expires_at, 'max_uses': max_uses}
 
-def join_server(invite_code: str, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def join_server(invite_code: str, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", {}
@@ -183,16 +403,34 @@ def join_server(invite_code: str, user_token: str, db: Database.FreecordDB) -> t
 
     server_id = invite_list[0]['server_id']
 
-    if _is_member(server_id, user['user_id'], db):
-        return False, "You are already a member of this server", {}
+    # the use count is checked and bumped under the shard lock so concurrent joins can't overshoot max_uses
+    with db.transaction(server_id):
+        invite_list = db.select('invites', {'invite_code': invite_code})
+        if not invite_list:
+            return False, "Invalid invite code", {}
+        invite = invite_list[0]
+
+        # the sweeper removes expired invites in batches, until then they are only refused
+        if invite.get('expires_at') is not None and invite['expires_at'] <= time.time():
+            return False, "Invite has expired", {}
+
+        if _is_member(server_id, user['user_id'], db):
+            return False, "You are already a member of this server", {}
 
-    success, message = _add_member(server_id, user['user_id'], db)
-    if not success:
-        return False, message, {}
+        success, message = _add_member(server_id, user['user_id'], db)
+        if not success:
+            return False, message, {}
+
+        if invite.get('max_uses') is not None:
+            if invite['uses'] + 1 >= invite['max_uses']:
+                db.delete('invites', {'invite_code': invite_code})
+            else:
+                db.update('invites', {'invite_code': invite_code}, {'uses': invite['uses'] + 1})
 
     return True, "Joined server successfully", {'server_id': server_id}
 
-def get_server_members(server_id: int, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_server_members(server_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", []
@@ -220,14 +458,20 @@ def get_server_members(server_id: int, user_token: str, db: Database.FreecordDB)
         for u in user_map.values()
     ]
 
-def send_message(channel_id: int, user_token: str, content: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def send_message(channel_id: int, user_token: str, content: str, db: ShardRouter.ShardedFreecordDB,
+                 attachments: list | None = None, nonce: str | None = None,
+                 nonces: EphemeralStore | None = None) -> tuple[bool, str, dict]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", {}
 
-    if not content or not content.strip():
+    if not (content and content.strip()) and not attachments:
         return False, "Message content cannot be empty", {}
 
+    if attachments and len(attachments) > MAX_ATTACHMENTS:
+        return False, f"A message can have at most {MAX_ATTACHMENTS} attachments", {}
+
     channel_list = db.select('channels', {'channel_id': channel_id})
     if not channel_list:
         return False, "Channel not found", {}
@@ -237,23 +481,43 @@ def send_message(channel_id: int, user_token: str, content: str, db: Database.Fr
     if not _is_member(server_id, user['user_id'], db):
         return False, "You are not a member of this server", {}
 
+    # knowing an attachment's hash is not enough to post it, that would open it to this channel
+    for attachment_id in attachments or ():
+        if not _can_see_attachment(attachment_id, user['user_id'], db):
+            return False, f"Unknown attachment {attachment_id}", {}
+
+    nonce_key = (user['user_id'], 'messages', channel_id, nonce)
+    error, sent_id = _claim_nonce(nonce_key, nonce, nonces)
+    if error is not None:
+        return False, error, {}
+    if sent_id is not None:
+        return True, "Message already sent", {'message_id': sent_id, 'duplicate': True}
+
     try:
-        message_id = int('4' + str(SnowflakeIDGenerator().generate_id()))
-        db.insert('messages', {
-            'message_id': message_id,
-            'channel_id': channel_id,
-            'server_id': server_id,
-            'author_id': user['user_id'],
-            'author_name': user['username'],
-            'content': content.strip(),
-            'timestamp': int(time.time()),
-        })
+        # the id is taken under the shard lock, so rows land in message_id order and pages stay sorted
+        with db.transaction(server_id):
+            message_id = int('4' + str(SnowflakeIDGenerator().generate_id()))
+            db.insert('messages', {
+                'message_id': message_id,
+                'channel_id': channel_id,
+                'server_id': server_id,
+                'author_id': user['user_id'],
+                'author_name': user['username'],
+                'content': (content or '').strip(),
+                'timestamp': int(time.time()),
+                **({'attachments': list(attachments)} if attachments else {}),
+            })
+        # refs are global rows, so they can't join the shard transaction
+        _add_attachment_refs(attachments, {'channel_id': channel_id, 'server_id': server_id}, db)
     except Exception as e:
+        _settle_nonce(nonce_key, nonce, nonces, None)
         return False, f"Failed to send message: {e}", {}
 
+    _settle_nonce(nonce_key, nonce, nonces, message_id)
     return True, "Message sent", {'message_id': message_id}
 
-def get_messages(channel_id: int, user_token: str, db: Database.FreecordDB, before: int | None = None) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_messages(channel_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB, before: int | None = None) -> tuple[bool, str, list]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", []
@@ -265,24 +529,10 @@ def get_messages(channel_id: int, user_token: str, db: Database.FreecordDB, befo
     if not _is_member(channel_list[0]['server_id'], user['user_id'], db):
         return False, "You are not a member of this server", []
 
-    messages = db.select('messages', {'channel_id': channel_id})
-
-    if before is not None:
-        idx = next((i for i, m in enumerate(messages) if m['message_id'] == before), None)
-        if idx is not None:
-            messages = messages[:idx]
+    return True, "OK", _message_page('messages', 'channel_id', channel_id, before, db)
 
-    return True, "OK", [
-        {
-            'message_id': m['message_id'],
-            'author_id': m['author_id'],
-            'content': m['content'],
-            'timestamp': m['timestamp'],
-        }
-        for m in messages[-50:]
-    ]
-
-def get_user_by_id(user_id: int, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def get_user_by_id(user_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     if _resolve_user(user_token, db) is None:
         return False, "Invalid user token", {}
 
@@ -293,7 +543,48 @@ def get_user_by_id(user_id: int, user_token: str, db: Database.FreecordDB) -> tu
     u = result[0]
     return True, "OK", {'user_id': u['user_id'], 'username': u['username']}
 
-def get_server_by_id(server_id: int, user_token: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def verify_token(user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+    return True, "OK", {'user_id': user['user_id']}
+
+@Tracing.traced
+def record_upload(attachment_id: str, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+    _add_attachment_refs([attachment_id], {'user_id': user['user_id']}, db)
+    return True, "OK", {}
+
+@Tracing.traced
+def can_read_attachment(attachment_id: str, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+    # an attachment the caller can't see is reported like a missing one, so ids can't be probed
+    if not _can_see_attachment(attachment_id, user['user_id'], db):
+        return False, "Attachment not found", {}
+    return True, "OK", {}
+
+def backfill_attachment_refs(db: ShardRouter.ShardedFreecordDB) -> int:
+    # attachments posted before refs were recorded, live and archived, stay readable where they were posted
+    added = 0
+    for channel in db.select('channels', None):
+        for m in db.iter_messages('messages', channel['channel_id']):
+            if m.get('attachments'):
+                _add_attachment_refs(m['attachments'], {'channel_id': m['channel_id'], 'server_id': channel['server_id']}, db)
+                added += 1
+    for dm_channel in db.select('dm_channels', None):
+        for m in db.iter_messages('dm_messages', dm_channel['dm_channel_id']):
+            if m.get('attachments'):
+                _add_attachment_refs(m['attachments'], {'dm_channel_id': m['dm_channel_id']}, db)
+                added += 1
+    return added
+
+@Tracing.traced
+def get_server_by_id(server_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
     if _resolve_user(user_token, db) is None:
         return False, "Invalid user token", {}
 
@@ -316,7 +607,8 @@ def get_server_by_id(server_id: int, user_token: str, db: Database.FreecordDB) -
         'channel_count': channel_count,
     }
 
-def get_all_users(user_token: str, db: Database.FreecordDB) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_all_users(user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     if _resolve_user(user_token, db) is None:
         return False, "Invalid user token", []
 
@@ -325,37 +617,73 @@ def get_all_users(user_token: str, db: Database.FreecordDB) -> tuple[bool, str,
         for u in db.select('users', None)
     ]
 
-def send_dm(recipient_id: int, user_token: str, content: str, db: Database.FreecordDB) -> tuple[bool, str, dict]:
+@Tracing.traced
+def get_users(user_ids: list[int], user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
+    if _resolve_user(user_token, db) is None:
+        return False, "Invalid user token", []
+
+    if len(user_ids) > MAX_USER_IDS:
+        return False, f"At most {MAX_USER_IDS} user ids per request", []
+
+    return True, "OK", list(_users_by_ids(user_ids, db).values())
+
+def message_authors(messages: list, db: ShardRouter.ShardedFreecordDB) -> dict[str, dict]:
+    return {str(uid): user for uid, user in _users_by_ids((m['author_id'] for m in messages), db).items()}
+
+@Tracing.traced
+def send_dm(recipient_id: int, user_token: str, content: str, db: ShardRouter.ShardedFreecordDB,
+            attachments: list | None = None, nonce: str | None = None,
+            nonces: EphemeralStore | None = None) -> tuple[bool, str, dict]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", {}
 
-    if not content or not content.strip():
+    if not (content and content.strip()) and not attachments:
         return False, "Message content cannot be empty", {}
 
+    if attachments and len(attachments) > MAX_ATTACHMENTS:
+        return False, f"A message can have at most {MAX_ATTACHMENTS} attachments", {}
+
     if user['user_id'] == recipient_id:
         return False, "You cannot DM yourself", {}
 
     if not db.exists('users', {'user_id': recipient_id}):
         return False, "Recipient not found", {}
 
+    for attachment_id in attachments or ():
+        if not _can_see_attachment(attachment_id, user['user_id'], db):
+            return False, f"Unknown attachment {attachment_id}", {}
+
+    nonce_key = (user['user_id'], 'dm_messages', recipient_id, nonce)
+    error, sent_id = _claim_nonce(nonce_key, nonce, nonces)
+    if error is not None:
+        return False, error, {}
+    if sent_id is not None:
+        return True, "DM already sent", {'message_id': sent_id, 'duplicate': True}
+
     try:
-        dm_channel_id = _get_or_create_dm_channel(user['user_id'], recipient_id, db)
-        message_id = int('6' + str(SnowflakeIDGenerator().generate_id()))
-        db.insert('dm_messages', {
-            'message_id': message_id,
-            'dm_channel_id': dm_channel_id,
-            'author_id': user['user_id'],
-            'author_name': user['username'],
-            'content': content.strip(),
-            'timestamp': int(time.time()),
-        })
+        with db.transaction():
+            dm_channel_id = _get_or_create_dm_channel(user['user_id'], recipient_id, db)
+            message_id = int('6' + str(SnowflakeIDGenerator().generate_id()))
+            db.insert('dm_messages', {
+                'message_id': message_id,
+                'dm_channel_id': dm_channel_id,
+                'author_id': user['user_id'],
+                'author_name': user['username'],
+                'content': (content or '').strip(),
+                'timestamp': int(time.time()),
+                **({'attachments': list(attachments)} if attachments else {}),
+            })
+            _add_attachment_refs(attachments, {'dm_channel_id': dm_channel_id}, db)
     except Exception as e:
+        _settle_nonce(nonce_key, nonce, nonces, None)
         return False, f"Failed to send DM: {e}", {}
 
+    _settle_nonce(nonce_key, nonce, nonces, message_id)
     return True, "DM sent", {'message_id': message_id}
 
-def get_dm_messages(other_user_id: int, user_token: str, db: Database.FreecordDB, before: int | None = None) -> tuple[bool, str, list]:
+@Tracing.traced
+def get_dm_messages(other_user_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB, before: int | None = None) -> tuple[bool, str, list]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", []
@@ -368,31 +696,30 @@ def get_dm_messages(other_user_id: int, user_token: str, db: Database.FreecordDB
     if not dm_channel:
         return True, "OK", []
 
-    messages = db.select('dm_messages', {'dm_channel_id': dm_channel[0]['dm_channel_id']})
+    return True, "OK", _message_page('dm_messages', 'dm_channel_id', dm_channel[0]['dm_channel_id'], before, db)
 
-    if before is not None:
-        idx = next((i for i, m in enumerate(messages) if m['message_id'] == before), None)
-        if idx is not None:
-            messages = messages[:idx]
+@Tracing.traced
+def export_messages(user_token: str, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+                    other_user_id: int | None = None) -> tuple[bool, str, Iterator[dict]]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", iter(())
 
-    return True, "OK", [
-        {
-            'message_id': m['message_id'],
-            'author_id': m['author_id'],
-            'content': m['content'],
-            'timestamp': m['timestamp'],
-        }
-        for m in messages[-50:]
-    ]
+    error, target_id = _resolve_channel(user, db, channel_id, other_user_id)
+    if error is not None:
+        return False, error, iter(())
 
-def get_dm_list(user_token: str, db: Database.FreecordDB) -> tuple[bool, str, list]:
+    table_name = 'messages' if channel_id is not None else 'dm_messages'
+    return True, "OK", (_message_dict(table_name, m) for m in db.iter_messages(table_name, target_id))
+
+@Tracing.traced
+def get_dm_list(user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, list]:
     user = _resolve_user(user_token, db)
     if user is None:
         return False, "Invalid user token", []
 
     uid = user['user_id']
-    all_channels = db.select('dm_channels', None)
-    my_channels = [c for c in all_channels if c['user1_id'] == uid or c['user2_id'] == uid]
+    my_channels = _user_dm_channels(uid, db)
     if not my_channels:
         return True, "OK", []
 
@@ -415,4 +742,384 @@ def get_dm_list(user_token: str, db: Database.FreecordDB) -> tuple[bool, str, li
             'username': other['username'],
         })
 
-    return True, "OK", result
\ No newline at end of file
+    return True, "OK", result
+
+@Tracing.traced
+def search_messages(query: str, user_token: str, db: ShardRouter.ShardedFreecordDB, server_id: int | None = None,
+                    channel_id: int | None = None, other_user_id: int | None = None, author_id: int | None = None,
+                    after: int | None = None, before: int | None = None, since: float | None = None,
+                    until: float | None = None) -> tuple[bool, str, list]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", []
+
+    if not query or not query.strip():
+        return False, "Search query cannot be empty", []
+
+    if other_user_id is not None:
+        lo, hi = min(user['user_id'], other_user_id), max(user['user_id'], other_user_id)
+        dm_channel = db.select('dm_channels', {'user1_id': lo, 'user2_id': hi})
+        if not dm_channel:
+            return True, "OK", []
+        hits = db.search_messages(query, 'dm_messages', channel_id=dm_channel[0]['dm_channel_id'],
+                                  author_id=author_id, after=after, before=before, since=since, until=until,
+                                  limit=PAGE_SIZE)
+        return True, "OK", _load_search_results(query, hits, db)
+
+    if channel_id is not None:
+        channel_list = db.select('channels', {'channel_id': channel_id})
+        if not channel_list:
+            return False, "Channel not found", []
+        server_id = channel_list[0]['server_id']
+    elif server_id is None:
+        return False, "Search needs a server_id, channel_id or user_id", []
+    elif not db.exists('servers', {'server_id': server_id}):
+        return False, "Server not found", []
+
+    if not _is_member(server_id, user['user_id'], db):
+        return False, "You are not a member of this server", []
+
+    hits = db.search_messages(query, 'messages', channel_id=channel_id, server_id=server_id,
+                              author_id=author_id, after=after, before=before, since=since, until=until,
+                              limit=PAGE_SIZE)
+    return True, "OK", _load_search_results(query, hits, db)
+
+
+@Tracing.traced
+def mark_read(message_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+              other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    error, target_id = _resolve_channel(user, db, channel_id, other_user_id)
+    if error is not None:
+        return False, error, {}
+    # a marker from another channel would make the unread count of this one meaningless
+    table_name = 'messages' if channel_id is not None else 'dm_messages'
+    if not _message_in_channel(table_name, target_id, message_id, db):
+        return False, "Message not found", {}
+
+    try:
+        with db.transaction():
+            where = {'user_id': user['user_id'], 'channel_id': target_id}
+            existing = db.select('read_states', where)
+            if not existing:
+                db.insert('read_states', {**where, 'message_id': message_id})
+            elif existing[0]['message_id'] < message_id:
+                db.update('read_states', where, {'message_id': message_id})
+            else:
+                message_id = existing[0]['message_id']
+    except Exception as e:
+        return False, f"Failed to save read state: {e}", {}
+
+    return True, "OK", {'channel_id': target_id, 'last_read': message_id}
+
+@Tracing.traced
+def get_unread_counts(user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    uid = user['user_id']
+    last_read = {r['channel_id']: r['message_id'] for r in db.select('read_states', {'user_id': uid})}
+
+    channels = []
+    for membership in db.select('members', {'user_id': uid}):
+        for c in db.select('channels', {'server_id': membership['server_id']}):
+            marker = last_read.get(c['channel_id'], 0)
+            channels.append({
+                'channel_id': c['channel_id'],
+                'server_id': c['server_id'],
+                'unread': db.unread_count('messages', c['channel_id'], marker),
+                'last_read': marker or None,
+            })
+
+    dms = []
+    for c in _user_dm_channels(uid, db):
+        marker = last_read.get(c['dm_channel_id'], 0)
+        dms.append({
+            'dm_channel_id': c['dm_channel_id'],
+            'user_id': c['user2_id'] if c['user1_id'] == uid else c['user1_id'],
+            'unread': db.unread_count('dm_messages', c['dm_channel_id'], marker),
+            'last_read': marker or None,
+        })
+
+    return True, "OK", {'channels': channels, 'dms': dms}
+
+@Tracing.traced
+def edit_message(message_id: int, content: str, user_token: str, db: ShardRouter.ShardedFreecordDB,
+                 channel_id: int | None = None, other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    if not content or not content.strip():
+        return False, "Message content cannot be empty", {}
+
+    error, table_name, where, message = _find_message(message_id, user, db, channel_id, other_user_id)
+    if error is not None:
+        return False, error, {}
+    if message['author_id'] != user['user_id']:
+        return False, "You can only edit your own messages", {}
+
+    edited_timestamp = int(time.time())
+    try:
+        db.update(table_name, where, {'content': content.strip(), 'edited_timestamp': edited_timestamp})
+    except Exception as e:
+        return False, f"Failed to edit message: {e}", {}
+
+    return True, "Message edited", {'message_id': message_id, 'edited_timestamp': edited_timestamp}
+
+@Tracing.traced
+def delete_message(message_id: int, user_token: str, db: ShardRouter.ShardedFreecordDB, channel_id: int | None = None,
+                   other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    error, table_name, where, message = _find_message(message_id, user, db, channel_id, other_user_id)
+    if error is not None:
+        return False, error, {}
+    if message['author_id'] != user['user_id']:
+        if table_name != 'messages':
+            return False, "You can only delete your own messages", {}
+        server = db.select('servers', {'server_id': message['server_id']})
+        if not server or server[0]['owner_id'] != user['user_id']:
+            return False, "Only the author or the server owner can delete this message", {}
+
+    try:
+        db.delete(table_name, where)
+    except Exception as e:
+        return False, f"Failed to delete message: {e}", {}
+
+    return True, "Message deleted", {'message_id': message_id}
+
+@Tracing.traced
+def set_presence(status: str, user_token: str, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    if status == 'offline':
+        store.delete('presence', user['user_id'])
+    elif status in PRESENCE_STATUSES:
+        store.set('presence', user['user_id'], status, PRESENCE_TTL)
+    else:
+        return False, f"Status must be one of {', '.join(PRESENCE_STATUSES)} or offline", {}
+
+    return True, "OK", {'status': status, 'expires_in': PRESENCE_TTL if status != 'offline' else None}
+
+@Tracing.traced
+def get_presence(user_ids: list, user_token: str, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore) -> tuple[bool, str, dict]:
+    if _resolve_user(user_token, db) is None:
+        return False, "Invalid user token", {}
+
+    if len(user_ids) > MAX_PRESENCE_IDS:
+        return False, f"At most {MAX_PRESENCE_IDS} user ids per request", {}
+
+    return True, "OK", {str(uid): store.get('presence', uid, 'offline') for uid in user_ids}
+
+@Tracing.traced
+def set_typing(user_token: str, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore, channel_id: int | None = None,
+               other_user_id: int | None = None) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    error, target_id = _resolve_channel(user, db, channel_id, other_user_id)
+    if error is not None:
+        return False, error, {}
+
+    store.set(('typing', target_id), user['user_id'], user['username'], TYPING_TTL)
+    return True, "OK", {'channel_id': target_id, 'expires_in': TYPING_TTL}
+
+@Tracing.traced
+def get_typing(user_token: str, db: ShardRouter.ShardedFreecordDB, store: EphemeralStore, channel_id: int | None = None,
+               other_user_id: int | None = None) -> tuple[bool, str, list]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", []
+
+    error, target_id = _resolve_channel(user, db, channel_id, other_user_id)
+    if error is not None:
+        return False, error, []
+
+    return True, "OK", [
+        {'user_id': uid, 'username': username}
+        for uid, username in store.items(('typing', target_id)).items()
+        if uid != user['user_id']
+    ]
+
+def _sync_servers(server_ids: set, uid: int, db: ShardRouter.ShardedFreecordDB, state: dict) -> None:
+    member_rows = []
+    owners = {}
+    for server_id in server_ids:
+        server_list = db.select('servers', {'server_id': server_id})
+        if not server_list:
+            continue
+        owners[server_id] = server_list[0]['owner_id']
+        state['servers'].append({
+            'server_id': server_id,
+            'name': server_list[0]['name'],
+            'is_owner': owners[server_id] == uid,
+        })
+        for c in db.select('channels', {'server_id': server_id}):
+            state['channels'].append({
+                'channel_id': c['channel_id'],
+                'server_id': server_id,
+                'name': c['name'],
+                'channel_type': c['channel_type'],
+            })
+            state['messages'].extend(
+                _message_dict('messages', m) for m in _page_rows('messages', 'channel_id', c['channel_id'], None, db)
+            )
+        member_rows.extend(db.select('members', {'server_id': server_id}))
+    _sync_members(member_rows, owners, db, state)
+
+def _sync_members(member_rows: list, owners: dict, db: ShardRouter.ShardedFreecordDB, state: dict) -> None:
+    if not member_rows:
+        return
+    wanted = {m['user_id'] for m in member_rows}
+    user_map = {u['user_id']: u for u in db.select('users', None) if u['user_id'] in wanted}
+    for m in member_rows:
+        u = user_map.get(m['user_id'])
+        if u is None:
+            continue
+        if m['server_id'] not in owners:
+            server_list = db.select('servers', {'server_id': m['server_id']})
+            owners[m['server_id']] = server_list[0]['owner_id'] if server_list else None
+        state['members'].append({
+            'server_id': m['server_id'],
+            'user_id': u['user_id'],
+            'username': u['username'],
+            'is_owner': u['user_id'] == owners[m['server_id']],
+        })
+
+def _sync_dms(dm_channels: list, uid: int, db: ShardRouter.ShardedFreecordDB, state: dict) -> None:
+    if not dm_channels:
+        return
+    other_ids = {c['user2_id'] if c['user1_id'] == uid else c['user1_id'] for c in dm_channels}
+    user_map = {u['user_id']: u for u in db.select('users', None) if u['user_id'] in other_ids}
+    for c in dm_channels:
+        other = user_map.get(c['user2_id'] if c['user1_id'] == uid else c['user1_id'])
+        if other is None:
+            continue
+        state['dms'].append({'dm_channel_id': c['dm_channel_id'], 'user_id': other['user_id'], 'username': other['username']})
+
+def _changed_rows(entry: dict) -> list:
+    if entry['op'] == 'insert':
+        return [entry['row']]
+    if entry['op'] == 'update':
+        return [{**row, **entry['data']} for row in entry['rows']]
+    return []
+
+@Tracing.traced
+def sync(cursor: str | None, user_token: str, db: ShardRouter.ShardedFreecordDB) -> tuple[bool, str, dict]:
+    user = _resolve_user(user_token, db)
+    if user is None:
+        return False, "Invalid user token", {}
+
+    uid = user['user_id']
+    # take the position before reading any state; a change the client already has is harmless to resend
+    epoch, seq = db.changes.epoch, db.changes.seq
+    entries = None
+    if cursor:
+        cursor_epoch, _, cursor_seq = cursor.partition(':')
+        if not cursor_seq.isdigit():
+            return False, "Invalid cursor", {}
+        if cursor_epoch == epoch and int(cursor_seq) <= seq:
+            entries = db.changes.since(int(cursor_seq), SYNC_BATCH)
+            if entries is not None and any(e['op'] == 'drop_table' for e in entries):
+                entries = None
+            if entries is not None:
+                seq = int(cursor_seq)
+
+    state = {
+        'full': entries is None,
+        'has_more': False,
+        'servers': [], 'channels': [], 'members': [], 'dms': [],
+        'messages': [], 'deleted_messages': [], 'read_states': [],
+    }
+    server_ids = {m['server_id'] for m in db.select('members', {'user_id': uid})}
+    dm_channels = _user_dm_channels(uid, db)
+
+    if entries is None:
+        _sync_servers(server_ids, uid, db, state)
+        _sync_dms(dm_channels, uid, db, state)
+        for c in dm_channels:
+            state['messages'].extend(
+                _message_dict('dm_messages', m)
+                for m in _page_rows('dm_messages', 'dm_channel_id', c['dm_channel_id'], None, db)
+            )
+        state['read_states'] = [
+            {'channel_id': r['channel_id'], 'message_id': r['message_id']}
+            for r in db.select('read_states', {'user_id': uid})
+        ]
+        state['cursor'] = f"{epoch}:{seq}"
+        return True, "OK", state
+
+    dm_ids = {c['dm_channel_id'] for c in dm_channels}
+    joined = set()
+    servers, channels, messages, deleted, read_states = {}, {}, {}, {}, {}
+    new_members, new_dms = [], []
+    for entry in entries:
+        table_name = entry['table']
+        if table_name == 'members' and entry['op'] == 'insert':
+            row = entry['row']
+            if row['server_id'] in server_ids:
+                if row['user_id'] == uid:
+                    joined.add(row['server_id'])
+                else:
+                    new_members.append(row)
+        elif table_name == 'servers':
+            for row in _changed_rows(entry):
+                if row['server_id'] in server_ids:
+                    servers[row['server_id']] = row
+        elif table_name == 'channels':
+            for row in _changed_rows(entry):
+                if row['server_id'] in server_ids:
+                    channels[row['channel_id']] = row
+        elif table_name in ShardRouter.CHANNEL_KEYS:
+            key = ShardRouter.CHANNEL_KEYS[table_name]
+            if table_name == 'messages':
+                visible = lambda row: row['server_id'] in server_ids
+            else:
+                visible = lambda row: row[key] in dm_ids
+            if entry['op'] == 'delete':
+                for row in entry['rows']:
+                    if visible(row):
+                        messages.pop(row['message_id'], None)
+                        deleted[row['message_id']] = {'message_id': row['message_id'], key: row[key]}
+            for row in _changed_rows(entry):
+                if visible(row):
+                    messages[row['message_id']] = _message_dict(table_name, row)
+        elif table_name == 'dm_channels' and entry['op'] == 'insert':
+            if uid in (entry['row']['user1_id'], entry['row']['user2_id']):
+                new_dms.append(entry['row'])
+        elif table_name == 'read_states':
+            for row in _changed_rows(entry):
+                if row['user_id'] == uid:
+                    read_states[row['channel_id']] = {'channel_id': row['channel_id'], 'message_id': row['message_id']}
+
+    # a server joined since the cursor is sent whole, which already covers its own changes
+    _sync_servers(joined, uid, db, state)
+    joined_channels = {c['channel_id'] for c in state['channels']}
+    state['servers'].extend(
+        {'server_id': s['server_id'], 'name': s['name'], 'is_owner': s['owner_id'] == uid}
+        for s in servers.values() if s['server_id'] not in joined
+    )
+    state['channels'].extend(
+        {'channel_id': c['channel_id'], 'server_id': c['server_id'], 'name': c['name'], 'channel_type': c['channel_type']}
+        for c in channels.values() if c['server_id'] not in joined
+    )
+    _sync_members([m for m in new_members if m['server_id'] not in joined], {}, db, state)
+    _sync_dms(new_dms, uid, db, state)
+    state['messages'].extend(m for m in messages.values() if m.get('channel_id') not in joined_channels)
+    state['deleted_messages'] = list(deleted.values())
+    state['read_states'] = list(read_states.values())
+
+    last_seq = entries[-1]['seq'] if entries else seq
+    state['has_more'] = len(entries) == SYNC_BATCH and last_seq < db.changes.seq
+    state['cursor'] = f"{epoch}:{last_seq}"
+    return True, "OK", state
@@ -0,0 +1,33 @@
+import heapq
+import threading
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+class ExpiryIndex:
+    def __init__(self):
+        # (expires_at, key); keys removed early stay until they come due and are skipped by the caller
+        self._heap: List[Tuple[float, Hashable]] = []
+        self._lock = threading.Lock()
+
+    def rebuild(self, entries: Iterable[Tuple[float, Hashable]]) -> None:
+        heap = list(entries)
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+
+    def add(self, expires_at: float, key: Hashable) -> None:
+        with self._lock:
+            heapq.heappush(self._heap, (expires_at, key))
+
+    def pop_due(self, now: float, limit: int) -> List[Hashable]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < limit:
+                due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self) -> int:
+        return len(self._heap)
@@ -0,0 +1,147 @@
+import collections
+import sys
+import threading
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+def _row_bytes(row: Dict[str, Any]) -> int:
+    # rough, but it moves with the content length, which is what varies between messages
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
+class _Tail:
+    __slots__ = ('rows', 'bytes', 'complete')
+
+    def __init__(self, capacity: int):
+        self.rows: Deque[Tuple[Dict[str, Any], int]] = collections.deque(maxlen=capacity)
+        self.bytes = 0
+        # True when rows holds every live row of the channel, not just the newest ones
+        self.complete = False
+
+class HotTailCache:
+    def __init__(self, capacity: int = 64, max_bytes: int = 64 * 1024 * 1024):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        # (table, channel id) -> newest rows in message_id order, least recently used first
+        self._tails: collections.OrderedDict = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def latest(self, table_name: str, channel_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        key = (table_name, channel_id)
+        with self._lock:
+            tail = self._tails.get(key)
+            # after deletes a tail can be shorter than a page, then older rows are needed from the table
+            if tail is None or (len(tail.rows) < limit and not tail.complete):
+                self.misses += 1
+                return None
+            self._tails.move_to_end(key)
+            self.hits += 1
+            return [row for row, _ in tail.rows][-limit:]
+
+    def fill(self, table_name: str, channel_id: int, rows: List[Dict[str, Any]], complete: bool) -> None:
+        # rows must be copies, the table tombstones and updates its own rows in place
+        key = (table_name, channel_id)
+        tail = _Tail(self.capacity)
+        for row in rows[-self.capacity:]:
+            size = _row_bytes(row)
+            tail.rows.append((row, size))
+            tail.bytes += size
+        tail.complete = complete and len(rows) <= self.capacity
+        with self._lock:
+            old = self._tails.pop(key, None)
+            if old is not None:
+                self._bytes -= old.bytes
+            self._tails[key] = tail
+            self._bytes += tail.bytes
+            self._evict()
+
+    def append(self, table_name: str, channel_id: int, row: Dict[str, Any]) -> None:
+        key = (table_name, channel_id)
+        with self._lock:
+            tail = self._tails.get(key)
+            if tail is None:
+                return
+            if tail.rows and row['message_id'] <= tail.rows[-1][0]['message_id']:
+                # out of order, the next read loads the channel again
+                self._drop(key)
+                return
+            if len(tail.rows) == self.capacity:
+                tail.bytes -= tail.rows[0][1]
+                self._bytes -= tail.rows[0][1]
+                tail.complete = False
+            size = _row_bytes(row)
+            tail.rows.append((row, size))
+            tail.bytes += size
+            self._bytes += size
+            self._tails.move_to_end(key)
+            self._evict()
+
+    def update(self, table_name: str, channel_id: int, message_id: int, data: Dict[str, Any]) -> None:
+        with self._lock:
+            tail = self._tails.get((table_name, channel_id))
+            if tail is None:
+                return
+            for index, (row, size) in enumerate(tail.rows):
+                if row['message_id'] == message_id:
+                    # a new dict, readers may still hold the old one
+                    row = {**row, **data}
+                    new_size = _row_bytes(row)
+                    tail.rows[index] = (row, new_size)
+                    tail.bytes += new_size - size
+                    self._bytes += new_size - size
+                    return
+
+    def remove(self, table_name: str, channel_id: int, message_id: int) -> None:
+        with self._lock:
+            tail = self._tails.get((table_name, channel_id))
+            if tail is None:
+                return
+            for index, (row, size) in enumerate(tail.rows):
+                if row['message_id'] == message_id:
+                    del tail.rows[index]
+                    tail.bytes -= size
+                    self._bytes -= size
+                    return
+
+    def remove_many(self, table_name: str, channel_id: int, message_ids: List[int]) -> None:
+        drop = set(message_ids)
+        with self._lock:
+            tail = self._tails.get((table_name, channel_id))
+            if tail is None:
+                return
+            kept = [(row, size) for row, size in tail.rows if row['message_id'] not in drop]
+            removed = sum(size for row, size in tail.rows if row['message_id'] in drop)
+            tail.rows = collections.deque(kept, maxlen=self.capacity)
+            tail.bytes -= removed
+            self._bytes -= removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tails.clear()
+            self._bytes = 0
+
+    def _drop(self, key: tuple) -> None:
+        tail = self._tails.pop(key, None)
+        if tail is not None:
+            self._bytes -= tail.bytes
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._tails:
+            _, tail = self._tails.popitem(last=False)
+            self._bytes -= tail.bytes
+            self.evictions += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'channels': len(self._tails),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+            }
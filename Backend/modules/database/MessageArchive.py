@@ -0,0 +1,179 @@
+import bisect
+import collections
+import json
+import os
+import threading
+import zlib
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from modules.database.SearchIndex import SearchIndex
+
+SEGMENT_ROWS = 1000
+# each segment has a search index of its own next to it, named after the segment
+INDEX_SUFFIX = '.idx'
+
+class MessageArchive:
+    def __init__(self, directory: str, cache_segments: int = 32, compression_level: int = 6):
+        self.directory = directory
+        self.cache_segments = cache_segments
+        self.compression_level = compression_level
+        self._index: Dict[tuple, List[tuple]] = {}
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        # segment name -> row count, learned when a segment is written or first counted
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refresh()
+
+    def refresh(self) -> None:
+        index: Dict[tuple, List[tuple]] = {}
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if not name.endswith('.seg'):
+                    continue
+                table_name, channel_id, first_id, last_id = name[:-4].rsplit('-', 3)
+                index.setdefault((table_name, int(channel_id)), []).append((int(first_id), int(last_id), name))
+        for segments in index.values():
+            segments.sort()
+        with self._lock:
+            self._index = index
+
+    def write_segments(self, table_name: str, channel_id: int, rows: List[Dict[str, Any]]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        rows = sorted(rows, key=lambda r: r['message_id'])
+        for start in range(0, len(rows), SEGMENT_ROWS):
+            chunk = rows[start:start + SEGMENT_ROWS]
+            name = f"{table_name}-{channel_id}-{chunk[0]['message_id']}-{chunk[-1]['message_id']}.seg"
+            path = os.path.join(self.directory, name)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(json.dumps(chunk).encode(), level=self.compression_level))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._write_index(table_name, name, chunk)
+            with self._lock:
+                segments = self._index.setdefault((table_name, channel_id), [])
+                bisect.insort(segments, (chunk[0]['message_id'], chunk[-1]['message_id'], name))
+                self._counts[name] = len(chunk)
+
+    def _write_index(self, table_name: str, name: str, rows: List[Dict[str, Any]]) -> SearchIndex:
+        index = SearchIndex(os.path.join(self.directory, name + INDEX_SUFFIX))
+        for row in rows:
+            index.add(table_name, row)
+        index.save()
+        return index
+
+    def _cached(self, key: str, load: Callable[[], Any]) -> Any:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = load()
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return value
+
+    def _load_segment(self, name: str) -> List[Dict[str, Any]]:
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return json.loads(zlib.decompress(f.read()).decode())
+
+    def _read_segment(self, name: str) -> List[Dict[str, Any]]:
+        return self._cached(name, lambda: self._load_segment(name))
+
+    def _segment_index(self, table_name: str, name: str) -> SearchIndex:
+        path = os.path.join(self.directory, name + INDEX_SUFFIX)
+
+        def load() -> SearchIndex:
+            if os.path.exists(path):
+                return SearchIndex(path)
+            # segments written before they had an index get one on their first search
+            return self._write_index(table_name, name, self._load_segment(name))
+
+        return self._cached(name + INDEX_SUFFIX, load)
+
+    def read_before(self, table_name: str, channel_id: int, before: Optional[int], limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            segments = list(self._index.get((table_name, channel_id), ()))
+        result: List[Dict[str, Any]] = []
+        for first_id, _, name in reversed(segments):
+            if before is not None and first_id >= before:
+                continue
+            rows = self._read_segment(name)
+            if before is not None:
+                rows = rows[:bisect.bisect_left([r['message_id'] for r in rows], before)]
+            result = rows[-(limit - len(result)):] + result
+            if len(result) >= limit:
+                break
+        return result
+
+    def iter_rows(self, table_name: str, channel_id: int) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            segments = list(self._index.get((table_name, channel_id), ()))
+        # a full scan would flush the cache for the paged readers, so segments are read straight from disk
+        for _, _, name in segments:
+            yield from self._load_segment(name)
+
+    def count_after(self, table_name: str, channel_id: int, after: int) -> int:
+        with self._lock:
+            segments = list(self._index.get((table_name, channel_id), ()))
+        count = 0
+        for first_id, last_id, name in segments:
+            if last_id <= after:
+                continue
+            if first_id > after:
+                count += self._segment_count(name)
+            else:
+                count += sum(r['message_id'] > after for r in self._read_segment(name))
+        return count
+
+    def _segment_count(self, name: str) -> int:
+        with self._lock:
+            count = self._counts.get(name)
+        if count is None:
+            # segments from an earlier run are counted once, straight from disk like iter_rows
+            count = len(self._load_segment(name))
+            with self._lock:
+                self._counts[name] = count
+        return count
+
+    def find(self, table_name: str, channel_id: int, message_ids: set) -> List[Dict[str, Any]]:
+        with self._lock:
+            segments = list(self._index.get((table_name, channel_id), ()))
+        found = []
+        for first_id, last_id, name in segments:
+            if any(first_id <= message_id <= last_id for message_id in message_ids):
+                found.extend(r for r in self._read_segment(name) if r['message_id'] in message_ids)
+        return found
+
+    def search(self, query: str, table_name: str, channel_ids: Iterable[int], after: Optional[int] = None,
+               before: Optional[int] = None, limit: int = 50, **filters: Any) -> List[list]:
+        with self._lock:
+            segments = [s for channel_id in channel_ids for s in self._index.get((table_name, channel_id), ())]
+        # newest segments first, so the search can stop once older ones can't make the page
+        segments.sort(key=lambda segment: segment[1], reverse=True)
+        hits: List[list] = []
+        for first_id, last_id, name in segments:
+            if len(hits) >= limit and last_id < hits[-1][0]:
+                break
+            if (after is not None and last_id <= after) or (before is not None and first_id >= before):
+                continue
+            found = self._segment_index(table_name, name).search(query, table_name, after=after, before=before,
+                                                                 limit=limit, **filters)
+            hits = sorted(hits + found, reverse=True)[:limit]
+        return hits
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'channels': len(self._index),
+                'segments': sum(len(s) for s in self._index.values()),
+                'cached_segments': len(self._cache),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+            }
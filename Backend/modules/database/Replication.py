@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+import urllib.request
+from typing import Any, Dict
+from modules.database import ShardRouter
+
+class ReplicaFollower:
+    def __init__(self, primary_url: str, db: ShardRouter.ShardedFreecordDB, poll_wait: float = 10.0):
+        self.primary_url = primary_url.rstrip('/')
+        self.db = db
+        self.poll_wait = poll_wait
+        self.epoch: str | None = None
+        self.applied_seq = 0
+        self.primary_seq = 0
+        self.applied_ts = 0.0
+        self.primary_ts = 0.0
+        self.last_contact: float | None = None
+        self.last_error: str | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _fetch(self, path: str) -> Dict[str, Any]:
+        with urllib.request.urlopen(self.primary_url + path, timeout=self.poll_wait + 5) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def resync(self) -> None:
+        snapshot = self._fetch('/replication/snapshot')
+        self.db.load_snapshot(snapshot)
+        self.epoch = snapshot['epoch']
+        self.applied_seq = self.primary_seq = snapshot['seq']
+        self.applied_ts = self.primary_ts = time.time()
+
+    def poll_once(self) -> None:
+        data = self._fetch(
+            f"/replication/changes?epoch={self.epoch}&since={self.applied_seq}&wait={self.poll_wait}"
+        )
+        if data['resync']:
+            self.resync()
+            return
+        for entry in data['changes']:
+            self.db.apply_change(entry)
+            self.applied_seq = entry['seq']
+            self.applied_ts = entry['ts']
+        self.primary_seq = data['seq']
+        self.primary_ts = data['ts']
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.epoch is None:
+                    self.resync()
+                else:
+                    self.poll_once()
+                self.last_contact = time.time()
+                self.last_error = None
+            except (OSError, ValueError, KeyError) as e:
+                self.last_error = str(e)
+                self._stop.wait(1.0)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="replica-follower", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def status(self) -> Dict[str, Any]:
+        behind = self.primary_seq - self.applied_seq
+        return {
+            'role': 'replica',
+            'primary': self.primary_url,
+            'epoch': self.epoch,
+            'applied_seq': self.applied_seq,
+            'primary_seq': self.primary_seq,
+            'lag_changes': behind,
+            'lag_seconds': round(max(self.primary_ts - self.applied_ts, 0.0), 3) if behind > 0 else 0.0,
+            'last_contact_age': round(time.time() - self.last_contact, 3) if self.last_contact else None,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import threading
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TOKEN_LENGTH = 64
+
+def tokenize(text: str) -> set[str]:
+    return {t for t in TOKEN_RE.findall(text.lower()) if len(t) <= MAX_TOKEN_LENGTH}
+
+class SearchIndex:
+    def __init__(self, path: str, in_memory: bool = False):
+        self.path = path
+        self.in_memory = in_memory
+        self._postings: Dict[str, Set[int]] = {}
+        # message_id -> [table, channel_id, server_id, author_id, timestamp]
+        self._docs: Dict[int, list] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if not in_memory and os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()).decode())
+        except Exception as e:
+            raise ValueError(f"Failed to load search index: {e}")
+        self._postings = {token: set(ids) for token, ids in data['postings'].items()}
+        self._docs = {int(k): v for k, v in data['docs'].items()}
+
+    def save(self) -> None:
+        if self.in_memory:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            postings = {token: sorted(ids) for token, ids in self._postings.items()}
+            data = json.dumps({'postings': postings, 'docs': self._docs}).encode()
+            self._dirty = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data, level=6))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add(self, table_name: str, row: Dict[str, Any]) -> None:
+        message_id = row['message_id']
+        channel_id = row['channel_id'] if table_name == 'messages' else row['dm_channel_id']
+        with self._lock:
+            if message_id in self._docs:
+                return
+            self._docs[message_id] = [table_name, channel_id, row.get('server_id'), row['author_id'], row['timestamp']]
+            for token in tokenize(row['content']):
+                self._postings.setdefault(token, set()).add(message_id)
+            self._dirty = True
+
+    def remove(self, message_id: int, content: str) -> None:
+        with self._lock:
+            if self._docs.pop(message_id, None) is None:
+                return
+            for token in tokenize(content):
+                postings = self._postings.get(token)
+                if postings and message_id in postings:
+                    postings.discard(message_id)
+                    if not postings:
+                        del self._postings[token]
+            self._dirty = True
+
+    def remove_many(self, message_ids: Iterable[int]) -> int:
+        # the caller no longer has the text, so the postings are swept once for the whole batch
+        with self._lock:
+            removed = {message_id for message_id in message_ids if self._docs.pop(message_id, None) is not None}
+            if not removed:
+                return 0
+            for token in list(self._postings):
+                postings = self._postings[token]
+                postings.difference_update(removed)
+                if not postings:
+                    del self._postings[token]
+            self._dirty = True
+        return len(removed)
+
+    def catch_up(self, table_name: str, rows: Iterable[Dict[str, Any]]) -> int:
+        # ids come from independent shards, so a single high-water mark could skip a lower id that was never indexed
+        with self._lock:
+            missing = [row for row in rows if row['message_id'] not in self._docs]
+        for row in missing:
+            self.add(table_name, row)
+        return len(missing)
+
+    def drop_stale(self, live_ids: Set[int]) -> int:
+        # a saved index can still hold messages archived or deleted after it was written
+        with self._lock:
+            stale = [message_id for message_id in self._docs if message_id not in live_ids]
+        return self.remove_many(stale)
+
+    def search(self, query: str, table_name: str, channel_id: Optional[int] = None,
+               server_id: Optional[int] = None, author_id: Optional[int] = None,
+               after: Optional[int] = None, before: Optional[int] = None, since: Optional[float] = None,
+               until: Optional[float] = None, limit: int = 50) -> List[list]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            postings = sorted((self._postings.get(t, set()) for t in tokens), key=len)
+            if not postings[0]:
+                return []
+            candidates = set(postings[0])
+            for other in postings[1:]:
+                candidates.intersection_update(other)
+                if not candidates:
+                    return []
+
+            results = []
+            for message_id in sorted(candidates, reverse=True):
+                # after a crash the saved postings can still name a message that is gone
+                doc = self._docs.get(message_id)
+                if doc is None or doc[0] != table_name:
+                    continue
+                if channel_id is not None and doc[1] != channel_id:
+                    continue
+                if server_id is not None and doc[2] != server_id:
+                    continue
+                if author_id is not None and doc[3] != author_id:
+                    continue
+                if after is not None and message_id <= after:
+                    break
+                if before is not None and message_id >= before:
+                    continue
+                if since is not None and doc[4] < since:
+                    continue
+                if until is not None and doc[4] >= until:
+                    continue
+                results.append([message_id, *doc])
+                if len(results) >= limit:
+                    break
+            return results
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'documents': len(self._docs), 'tokens': len(self._postings)}
@@ -0,0 +1,406 @@
+import json
+import os
+import time
+import zlib
+from contextlib import ExitStack
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+from modules.database import Database
+from modules.database.ChangeStream import ChangeStream
+from modules.database.ExpiryIndex import ExpiryIndex
+from modules.database.HotTail import HotTailCache
+from modules.database.MessageArchive import MessageArchive
+from modules.database.SearchIndex import SearchIndex
+from modules.database.Timeline import ChannelTimeline
+
+SHARDED_TABLES = ('servers', 'channels', 'members', 'messages', 'invites')
+ROUTING_KEYS = ('channel_id', 'invite_code')
+CHANNEL_KEYS = {'messages': 'channel_id', 'dm_messages': 'dm_channel_id'}
+INDEXES = {
+    'users': ('user_id', 'user_token', 'username'),
+    'messages': ('message_id', 'channel_id'),
+    'dm_messages': ('message_id', 'dm_channel_id'),
+    'invites': ('invite_code',),
+    'read_states': ('user_id',),
+    'attachment_refs': ('attachment_id',),
+}
+INVITE_SWEEP_BATCH = 500
+# newest rows kept per cached channel, a bit over a page so a few deletes don't force a reload
+HOT_TAIL_ROWS = 64
+
+def _past(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+def shard_of(server_id: int, shard_count: int) -> int:
+    # snowflake ids have their low bits mostly zeroed, so a plain modulo would skew
+    return zlib.crc32(str(server_id).encode()) % shard_count
+
+class ShardedFreecordDB:
+    def __init__(self, db_path: str, shard_count: int = 4, in_memory: bool = False,
+                 archive_path: Optional[str] = None, storage_format: str = 'json', compression_level: int = 9,
+                 hot_tail_bytes: int = 64 * 1024 * 1024):
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+        self.db_path = db_path[:-5] if db_path.endswith('.fcdb') else db_path
+        self.in_memory = in_memory
+        self.changes = ChangeStream()
+        self.global_db = Database.FreecordDB(f"{self.db_path}.global", self.changes, 'global', in_memory,
+                                             storage_format, compression_level)
+        self.shards = [
+            Database.FreecordDB(f"{self.db_path}.shard{i}", self.changes, f"shard{i}", in_memory,
+                                storage_format, compression_level)
+            for i in range(shard_count)
+        ]
+        self.archive = MessageArchive(archive_path or f"{self.db_path}.segments")
+        self.search = SearchIndex(f"{self.db_path}.search", in_memory)
+        self.timeline = ChannelTimeline()
+        self.invite_expiry = ExpiryIndex()
+        self.hot_tail = HotTailCache(HOT_TAIL_ROWS, hot_tail_bytes)
+        self._routes: Dict[tuple, int] = {}
+        # maintenance that stops at a deadline starts where the previous run left off
+        self._maintenance_offset = 0
+        for db in self._all_dbs():
+            for table_name, columns in INDEXES.items():
+                for column in columns:
+                    db.create_index(table_name, column)
+        self._build_routes()
+        if not in_memory:
+            self._import_legacy(f"{self.db_path}.fcdb")
+        self._index_messages()
+        self._index_invites()
+        self.changes.subscribe(self._on_change)
+
+    def shard_index(self, server_id: int) -> int:
+        return shard_of(server_id, len(self.shards))
+
+    def shard_for(self, server_id: int) -> Database.FreecordDB:
+        return self.shards[self.shard_index(server_id)]
+
+    def _build_routes(self) -> None:
+        self._routes = {}
+        for index, shard in enumerate(self.shards):
+            for table_name in SHARDED_TABLES:
+                if not shard.exists_table(table_name):
+                    continue
+                for row in shard.select(table_name):
+                    if self.shard_index(row['server_id']) != index:
+                        raise ValueError(
+                            f"row in '{table_name}' of {shard.db_path} belongs to another shard; "
+                            f"was the shard count changed?"
+                        )
+                    self._remember_routes(row, index)
+
+    def _message_tables(self):
+        if self.global_db.exists_table('dm_messages'):
+            yield 'dm_messages', self.global_db.select('dm_messages')
+        for shard in self.shards:
+            if shard.exists_table('messages'):
+                yield 'messages', shard.select('messages')
+
+    def _index_messages(self) -> None:
+        positions = []
+        for table_name, rows in self._message_tables():
+            self.search.catch_up(table_name, rows)
+            key = CHANNEL_KEYS[table_name]
+            positions.extend((row[key], row['message_id']) for row in rows)
+        self.search.drop_stale({message_id for _, message_id in positions})
+        self.timeline.rebuild(positions)
+
+    def _index_invites(self) -> None:
+        self.invite_expiry.rebuild(
+            (row['expires_at'], row['invite_code'])
+            for shard in self.shards if shard.exists_table('invites')
+            for row in shard.select('invites') if row.get('expires_at') is not None
+        )
+
+    def _on_change(self, entry: Dict[str, Any]) -> None:
+        if entry['table'] == 'invites':
+            if entry['op'] == 'insert' and entry['row'].get('expires_at') is not None:
+                self.invite_expiry.add(entry['row']['expires_at'], entry['row']['invite_code'])
+            elif entry['op'] == 'delete':
+                for row in entry['rows']:
+                    self._routes.pop(('invite_code', row['invite_code']), None)
+            return
+        if entry['table'] not in CHANNEL_KEYS:
+            return
+        key = CHANNEL_KEYS[entry['table']]
+        if entry['op'] == 'insert':
+            row = entry['row']
+            self.search.add(entry['table'], row)
+            self.timeline.add(row[key], row['message_id'])
+            self.hot_tail.append(entry['table'], row[key], row)
+        elif entry['op'] == 'delete':
+            for row in entry['rows']:
+                self.search.remove(row['message_id'], row['content'])
+                self.timeline.remove(row[key], row['message_id'])
+                self.hot_tail.remove(entry['table'], row[key], row['message_id'])
+        elif entry['op'] == 'update':
+            for row in entry['rows']:
+                if 'content' in entry['data']:
+                    self.search.remove(row['message_id'], row['content'])
+                    self.search.add(entry['table'], {**row, **entry['data']})
+                self.hot_tail.update(entry['table'], row[key], row['message_id'], entry['data'])
+        elif entry['op'] == 'archive':
+            # archived rows are searched through the segment indexes, the in-memory views let them go
+            for channel_id, message_ids in entry['archived']:
+                self.search.remove_many(message_ids)
+                self.timeline.remove_many(channel_id, message_ids)
+                self.hot_tail.remove_many(entry['table'], channel_id, message_ids)
+
+    def _remember_routes(self, row: Dict[str, Any], index: int) -> None:
+        for key in ROUTING_KEYS:
+            if key in row:
+                self._routes[(key, row[key])] = index
+
+    def _import_legacy(self, legacy_path: str) -> None:
+        if not os.path.exists(legacy_path):
+            return
+        if any(self.global_db.count(t) for t in self.global_db.list_tables()):
+            return
+        legacy = Database.FreecordDB(legacy_path)
+        for table_name in legacy.list_tables():
+            if not self.exists_table(table_name):
+                self.create_table(table_name)
+            for row in legacy.select(table_name):
+                data = {k: v for k, v in row.items() if k != 'id'}
+                self.insert(table_name, data, save=False)
+        self.save()
+        os.replace(legacy_path, legacy_path + '.migrated')
+
+    def _shards_for(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> List[Database.FreecordDB]:
+        if table_name not in SHARDED_TABLES:
+            return [self.global_db]
+        if where:
+            if 'server_id' in where:
+                return [self.shard_for(where['server_id'])]
+            for key in ROUTING_KEYS:
+                if key in where:
+                    index = self._routes.get((key, where[key]))
+                    return [self.shards[index]] if index is not None else []
+        return self.shards
+
+    def _all_dbs(self) -> List[Database.FreecordDB]:
+        return [self.global_db, *self.shards]
+
+    def _rotated_dbs(self) -> List[Database.FreecordDB]:
+        dbs = self._all_dbs()
+        offset = self._maintenance_offset % len(dbs)
+        self._maintenance_offset += 1
+        return dbs[offset:] + dbs[:offset]
+
+    def _db_by_source(self, source: str) -> Database.FreecordDB:
+        for db in self._all_dbs():
+            if db.stream_source == source:
+                return db
+        raise ValueError(f"unknown change source '{source}'")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with ExitStack() as stack:
+            for db in self._all_dbs():
+                stack.enter_context(db._lock)
+            return {
+                'epoch': self.changes.epoch,
+                'seq': self.changes.seq,
+                'shards': len(self.shards),
+                'tables': {db.stream_source: json.loads(json.dumps(db.tables)) for db in self._all_dbs()},
+                'next_ids': {db.stream_source: dict(db.next_ids) for db in self._all_dbs()},
+            }
+
+    def load_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        if snapshot['shards'] != len(self.shards):
+            raise ValueError(f"snapshot has {snapshot['shards']} shards, expected {len(self.shards)}")
+        for db in self._all_dbs():
+            db.replace_tables(snapshot['tables'][db.stream_source], snapshot['next_ids'][db.stream_source])
+        self._build_routes()
+        self._index_messages()
+        self._index_invites()
+        self.hot_tail.clear()
+        self.changes.reset()
+        self.save()
+
+    def apply_change(self, entry: Dict[str, Any]) -> None:
+        self._db_by_source(entry['source']).apply_change(entry)
+        if entry['op'] == 'insert' and entry['source'] != 'global':
+            self._remember_routes(entry['row'], self.shard_index(entry['row']['server_id']))
+        elif entry['op'] == 'archive':
+            self.archive.refresh()
+
+    def archive_messages(self, older_than: float, deadline: Optional[float] = None) -> int:
+        cutoff = time.time() - older_than
+        archived = 0
+        for db in self._rotated_dbs():
+            if _past(deadline):
+                break
+            if db is self.global_db:
+                archived += db.archive_older_than('dm_messages', 'dm_channel_id', 'message_id', cutoff, self.archive)
+            else:
+                archived += db.archive_older_than('messages', 'channel_id', 'message_id', cutoff, self.archive)
+        return archived
+
+    def expire_invites(self, now: Optional[float] = None, batch_size: int = INVITE_SWEEP_BATCH,
+                       deadline: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        while not _past(deadline):
+            codes = self.invite_expiry.pop_due(now, batch_size)
+            if not codes:
+                return removed
+            by_shard: Dict[int, List[str]] = {}
+            for code in codes:
+                # invites that ran out of uses are already gone and have no route left
+                index = self._routes.get(('invite_code', code))
+                if index is not None:
+                    by_shard.setdefault(index, []).append(code)
+            for index, batch in by_shard.items():
+                removed += self.shards[index].delete_in('invites', 'invite_code', batch)
+        return removed
+
+    def latest_messages(self, table_name: str, channel_id: int, limit: int) -> List[Dict[str, Any]]:
+        rows = self.hot_tail.latest(table_name, channel_id, limit)
+        if rows is not None:
+            return rows
+        key = CHANNEL_KEYS[table_name]
+        # the owning file's lock keeps inserts out until the tail is cached, so the listener can't miss one
+        with ExitStack() as stack:
+            for db in self._shards_for(table_name, {key: channel_id}):
+                stack.enter_context(db._lock)
+            live = self.select(table_name, {key: channel_id})
+            rows = [dict(row) for row in live[-self.hot_tail.capacity:]]
+            self.hot_tail.fill(table_name, channel_id, rows, complete=len(live) <= self.hot_tail.capacity)
+        return rows[-limit:]
+
+    def unread_count(self, table_name: str, channel_id: int, after: int) -> int:
+        # the timeline only knows the rows still in memory, the archive adds the ones moved out
+        return self.timeline.count_after(channel_id, after) + self.archive.count_after(table_name, channel_id, after)
+
+    def search_messages(self, query: str, table_name: str, channel_id: Optional[int] = None,
+                        server_id: Optional[int] = None, limit: int = 50, **filters: Any) -> List[list]:
+        live = self.search.search(query, table_name, channel_id=channel_id, server_id=server_id, limit=limit,
+                                  **filters)
+        if channel_id is not None:
+            channel_ids = [channel_id]
+        else:
+            channel_ids = [row['channel_id'] for row in self.select('channels', {'server_id': server_id})]
+        archived = self.archive.search(query, table_name, channel_ids, limit=limit, **filters)
+        # a concurrent archive run can leave a message in both for a moment
+        hits = {hit[0]: hit for hit in live + archived}
+        return sorted(hits.values(), reverse=True)[:limit]
+
+    def iter_messages(self, table_name: str, channel_id: int) -> Iterator[Dict[str, Any]]:
+        key = CHANNEL_KEYS[table_name]
+        last_id = None
+        for row in self.archive.iter_rows(table_name, channel_id):
+            last_id = row['message_id']
+            yield row
+        for db in self._shards_for(table_name, {key: channel_id}):
+            for row in db.iter_rows(table_name, {key: channel_id}):
+                # a concurrent archive run can leave a row in both places for a moment
+                if last_id is None or row['message_id'] > last_id:
+                    yield row
+
+    def transaction(self, server_id: Optional[int] = None) -> ContextManager[Database.FreecordDB]:
+        if server_id is None:
+            return self.global_db.transaction()
+        return self.shard_for(server_id).transaction()
+
+    def create_table(self, table_name: str) -> None:
+        for db in self._shards_for(table_name):
+            db.create_table(table_name)
+
+    def exists_table(self, table_name: str) -> bool:
+        return all(db.exists_table(table_name) for db in self._shards_for(table_name))
+
+    def drop_table(self, table_name: str) -> None:
+        for db in self._shards_for(table_name):
+            db.drop_table(table_name)
+
+    def list_tables(self) -> List[str]:
+        tables = self.global_db.list_tables()
+        for table_name in self.shards[0].list_tables():
+            if table_name not in tables:
+                tables.append(table_name)
+        return tables
+
+    def insert(self, table_name: str, data: Dict[str, Any], save: bool = True) -> int:
+        if table_name not in SHARDED_TABLES:
+            return self.global_db.insert(table_name, data, save)
+        if 'server_id' not in data:
+            raise ValueError(f"rows in sharded table '{table_name}' need a server_id")
+        index = self.shard_index(data['server_id'])
+        row_id = self.shards[index].insert(table_name, data, save)
+        self._remember_routes(data, index)
+        return row_id
+
+    def exists(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> bool:
+        return any(db.exists(table_name, where) for db in self._shards_for(table_name, where))
+
+    def select(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        dbs = self._shards_for(table_name, where)
+        if len(dbs) == 1:
+            return dbs[0].select(table_name, where)
+        result = []
+        for db in dbs:
+            result.extend(db.select(table_name, where))
+        return result
+
+    def update(self, table_name: str, where: Dict[str, Any], data: Dict[str, Any]) -> int:
+        if table_name in SHARDED_TABLES and 'server_id' in data:
+            raise ValueError("server_id cannot be updated on sharded tables")
+        return sum(db.update(table_name, where, data) for db in self._shards_for(table_name, where))
+
+    def delete(self, table_name: str, where: Dict[str, Any]) -> int:
+        return sum(db.delete(table_name, where) for db in self._shards_for(table_name, where))
+
+    def count(self, table_name: str, where: Optional[Dict[str, Any]] = None) -> int:
+        return sum(db.count(table_name, where) for db in self._shards_for(table_name, where))
+
+    def compact(self, deadline: Optional[float] = None) -> int:
+        removed = 0
+        for db in self._rotated_dbs():
+            if _past(deadline):
+                break
+            removed += db.compact()
+        # edits and deletes are not replayed into the index on startup, so it is saved with the tables
+        if removed:
+            self.search.save()
+        return removed
+
+    def checkpoint(self, min_log_bytes: int = 0, deadline: Optional[float] = None) -> int:
+        # folds the update/delete log into the main file, so a restart has less to replay
+        saved = 0
+        for db in self._rotated_dbs():
+            if _past(deadline):
+                break
+            if os.path.exists(db.log_path) and os.path.getsize(db.log_path) > min_log_bytes:
+                db.save()
+                saved += 1
+        if saved:
+            self.search.save()
+        return saved
+
+    def save(self) -> None:
+        for db in self._all_dbs():
+            db.save()
+
+    def close(self) -> None:
+        for db in self._all_dbs():
+            db.close()
+        self.search.save()
+
+    def get_info(self) -> Dict[str, Any]:
+        infos = [db.get_info() for db in self._all_dbs()]
+        table_info: Dict[str, int] = {}
+        for info in infos:
+            for name, rows in info['table_info'].items():
+                table_info[name] = table_info.get(name, 0) + rows
+        return {
+            'file': self.db_path,
+            'shards': len(self.shards),
+            'tables': len(table_info),
+            'table_info': table_info,
+            'file_size': sum(info['file_size'] for info in infos),
+            'tombstones': sum(info['tombstones'] for info in infos),
+            'shard_info': infos,
+            'archive': self.archive.metrics(),
+            'search': self.search.metrics(),
+            'hot_tail': self.hot_tail.metrics(),
+        }
@@ -0,0 +1,53 @@
+import bisect
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+class ChannelTimeline:
+    def __init__(self):
+        self._positions: Dict[int, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self, entries: Iterable[Tuple[int, int]]) -> None:
+        positions: Dict[int, List[int]] = {}
+        for channel_id, message_id in entries:
+            positions.setdefault(channel_id, []).append(message_id)
+        for ids in positions.values():
+            ids.sort()
+        with self._lock:
+            self._positions = positions
+
+    def add(self, channel_id: int, message_id: int) -> None:
+        with self._lock:
+            ids = self._positions.setdefault(channel_id, [])
+            if not ids or message_id > ids[-1]:
+                ids.append(message_id)
+            else:
+                bisect.insort(ids, message_id)
+
+    def remove(self, channel_id: int, message_id: int) -> None:
+        with self._lock:
+            ids = self._positions.get(channel_id)
+            if not ids:
+                return
+            index = bisect.bisect_left(ids, message_id)
+            if index < len(ids) and ids[index] == message_id:
+                del ids[index]
+
+    def remove_many(self, channel_id: int, message_ids: Iterable[int]) -> None:
+        drop = set(message_ids)
+        with self._lock:
+            ids = self._positions.get(channel_id)
+            if ids:
+                self._positions[channel_id] = [message_id for message_id in ids if message_id not in drop]
+
+    def count_after(self, channel_id: int, message_id: int) -> int:
+        with self._lock:
+            ids = self._positions.get(channel_id)
+            if not ids:
+                return 0
+            return len(ids) - bisect.bisect_right(ids, message_id)
+
+    def latest(self, channel_id: int) -> Optional[int]:
+        with self._lock:
+            ids = self._positions.get(channel_id)
+            return ids[-1] if ids else None
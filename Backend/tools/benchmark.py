@@ -0,0 +1,208 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.generate_dataset import generate
+
+# the production size we want to reach; --scales are fractions of it
+FULL_SCALE = {
+    'users': 1_000_000,
+    'servers': 50_000,
+    'messages': 50_000_000,
+    'dm_channels': 500_000,
+    'dm_messages': 10_000_000,
+}
+
+def _percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+def _peak_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def _cold_start(path: str, shard_count: int, results) -> None:
+    from modules.database import ShardRouter
+    started = time.perf_counter()
+    db = ShardRouter.ShardedFreecordDB(path, shard_count)
+    elapsed = time.perf_counter() - started
+    db.search.save()
+    results.put({'cold_start_s': round(elapsed, 3), 'cold_start_peak_rss_mb': _peak_rss_mb()})
+
+def _warm_run(path: str, shard_count: int, queries: int, writes: int, seed: int, storage_format: str, results) -> None:
+    from modules.database import ShardRouter, DatabaseEvents as DBEvents
+    rng = random.Random(seed)
+
+    started = time.perf_counter()
+    db = ShardRouter.ShardedFreecordDB(path, shard_count, storage_format=storage_format,
+                                       compression_level=6 if storage_format == 'binary' else 9)
+    warm_start = time.perf_counter() - started
+
+    users = db.global_db.tables['users']
+    tokens = {u['user_id']: u['user_token'] for u in users}
+    members = [m for shard in db.shards for m in rng.sample(shard.tables['members'], min(len(shard.tables['members']), queries))]
+    dm_channels = db.global_db.tables['dm_channels']
+
+    def random_membership():
+        m = rng.choice(members)
+        channels = [c for c in db.select('channels', {'server_id': m['server_id']}) if c['channel_type'] == 'text']
+        return m, tokens[m['user_id']], rng.choice(channels)['channel_id'] if channels else None
+
+    def as_member(func):
+        def case():
+            m = rng.choice(members)
+            func(m['server_id'], tokens[m['user_id']], db)
+        return case
+
+    def as_user(func):
+        return lambda: func(tokens[rng.choice(members)['user_id']], db)
+
+    def get_user_by_id():
+        DBEvents.get_user_by_id(rng.choice(users)['user_id'], tokens[rng.choice(members)['user_id']], db)
+
+    def get_dm_messages():
+        c = rng.choice(dm_channels)
+        DBEvents.get_dm_messages(c['user2_id'], tokens[c['user1_id']], db)
+
+    cases = {
+        'get_user_servers': as_user(DBEvents.get_user_servers),
+        'get_server_channels': as_member(DBEvents.get_server_channels),
+        'get_server_members': as_member(DBEvents.get_server_members),
+        'get_server_by_id': as_member(DBEvents.get_server_by_id),
+        'get_user_by_id': get_user_by_id,
+        'get_dm_list': as_user(DBEvents.get_dm_list),
+        'get_unread_counts': as_user(DBEvents.get_unread_counts),
+    }
+    if dm_channels:
+        cases['get_dm_messages'] = get_dm_messages
+
+    latencies: dict[str, list[float]] = {}
+    for name, case in cases.items():
+        latencies[name] = []
+        for _ in range(queries):
+            started = time.perf_counter()
+            case()
+            latencies[name].append(time.perf_counter() - started)
+
+    for name in ('get_messages', 'search_messages'):
+        latencies[name] = []
+    for _ in range(queries):
+        m, token, channel_id = random_membership()
+        if channel_id is None:
+            continue
+        started = time.perf_counter()
+        DBEvents.get_messages(channel_id, token, db)
+        latencies['get_messages'].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        DBEvents.search_messages(rng.choice(('game', 'release notes', 'lol', 'python bug')), token, db, server_id=m['server_id'])
+        latencies['search_messages'].append(time.perf_counter() - started)
+
+    latencies['send_message'] = []
+    for _ in range(writes):
+        _, token, channel_id = random_membership()
+        if channel_id is None:
+            continue
+        started = time.perf_counter()
+        DBEvents.send_message(channel_id, token, "benchmark message", db)
+        latencies['send_message'].append(time.perf_counter() - started)
+    if dm_channels:
+        latencies['send_dm'] = []
+        for _ in range(writes):
+            c = rng.choice(dm_channels)
+            started = time.perf_counter()
+            DBEvents.send_dm(c['user2_id'], tokens[c['user1_id']], "benchmark dm", db)
+            latencies['send_dm'].append(time.perf_counter() - started)
+
+    save_times = {}
+    for shard in db._all_dbs():
+        started = time.perf_counter()
+        shard.save()
+        save_times[shard.stream_source] = round(time.perf_counter() - started, 3)
+    saved_bytes = sum(os.path.getsize(shard.db_path) for shard in db._all_dbs())
+
+    results.put({
+        'warm_start_s': round(warm_start, 3),
+        'peak_rss_mb': _peak_rss_mb(),
+        'save_s': save_times,
+        'saved_bytes': saved_bytes,
+        'queries': {name: _percentiles(samples) for name, samples in latencies.items() if samples},
+    })
+
+def _in_child(target, *args) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=target, args=(*args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def run(scales: list[float], shard_count: int, queries: int, writes: int, seed: int, workdir: str,
+        storage_format: str = 'binary') -> list[dict]:
+    runs = []
+    for scale in scales:
+        sizes = {name: max(1, int(count * scale)) for name, count in FULL_SCALE.items()}
+        path = os.path.join(workdir, f"scale-{scale}", "freecord_data")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        print(f"scale {scale}: generating {sizes}", file=sys.stderr)
+        dataset = generate(path, shard_count=shard_count, seed=seed, **sizes)
+
+        result = {'scale': scale, 'dataset': dataset}
+        print(f"scale {scale}: cold start", file=sys.stderr)
+        result.update(_in_child(_cold_start, path, shard_count))
+        print(f"scale {scale}: queries", file=sys.stderr)
+        result.update(_in_child(_warm_run, path, shard_count, queries, writes, seed, storage_format))
+        runs.append(result)
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    return runs
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FreecordDB and DatabaseEvents at growing dataset sizes")
+    parser.add_argument('--scales', default="0.0001,0.001,0.01",
+                        help="comma separated fractions of 1M users / 50M messages")
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=200, help="samples per read query")
+    parser.add_argument('--writes', type=int, default=20, help="samples per write query, each one saves a file")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage-format', choices=('binary', 'json'), default='binary',
+                        help="format the warm run saves in, the generated dataset is always json")
+    parser.add_argument('--workdir', default=None, help="where datasets are generated, defaults to a temp dir")
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='freecord-bench-')
+    try:
+        runs = run([float(s) for s in args.scales.split(',')], args.shards, args.queries, args.writes, args.seed, workdir,
+                   args.storage_format)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'shards': args.shards,
+        'storage_format': args.storage_format,
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import bisect
+import itertools
+import json
+import os
+import random
+import secrets
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.database import ShardRouter
+
+EPOCH = 1609459200000
+GLOBAL_TABLES = ('users', 'dm_channels', 'dm_messages', 'read_states')
+WORDS = (
+    "the a to and of you i it is that in for this on with be have are just not so but we what can "
+    "like do was if get your all my me at lol ok yeah no one up out about know they will it's time "
+    "go now good how think there see when more want new game server channel message voice update "
+    "release build bug fix test today tomorrow night work play stream link video music meme gg nice "
+    "thanks please anyone here free encrypted freecord discord python rust linux windows mac phone"
+).split()
+
+class FcdbWriter:
+    def __init__(self, path: str, compression_level: int = 9):
+        self.path = path if path.endswith('.fcdb') else f"{path}.fcdb"
+        self._file = open(self.path + '.tmp', 'wb')
+        self._zlib = zlib.compressobj(compression_level)
+        self._first_table = True
+        self._first_row = True
+        self._row_id = 0
+        self.rows = 0
+
+    def _write(self, text: str) -> None:
+        self._file.write(self._zlib.compress(text.encode()))
+
+    def begin_table(self, table_name: str) -> None:
+        self._write(('{' if self._first_table else ',') + json.dumps(table_name) + ':[')
+        self._first_table = False
+        self._first_row = True
+        self._row_id = 0
+
+    def row(self, data: dict) -> None:
+        self._write(('' if self._first_row else ',') + json.dumps({'id': self._row_id, **data}))
+        self._first_row = False
+        self._row_id += 1
+        self.rows += 1
+
+    def end_table(self) -> None:
+        self._write(']')
+
+    def close(self) -> None:
+        self._write('{}' if self._first_table else '}')
+        self._file.write(self._zlib.flush())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+def _snowflake(prefix: int, ts_ms: int, seq: int) -> int:
+    return int(str(prefix) + str(((ts_ms - EPOCH) << 12) | (seq & 0xfff)))
+
+def _zipf_picker(rng: random.Random, n: int, skew: float):
+    cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+    total = cumulative[-1]
+    return lambda: bisect.bisect_left(cumulative, rng.random() * total)
+
+def _content(rng: random.Random) -> str:
+    return ' '.join(rng.choices(WORDS, k=max(1, int(rng.expovariate(1 / 8)))))
+
+def generate(path: str, users: int, servers: int, messages: int, dm_channels: int, dm_messages: int,
+             shard_count: int = 4, channels_per_server: int = 6, days: int = 365, seed: int = 0,
+             skew: float = 1.1, compression_level: int = 9) -> dict:
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    base = path[:-5] if path.endswith('.fcdb') else path
+    end_ms = int(time.time() * 1000)
+    start_ms = end_ms - days * 86400 * 1000
+    seq = itertools.count()
+
+    user_ids = [_snowflake(1, start_ms + i, next(seq)) for i in range(users)]
+    server_ids = [_snowflake(2, start_ms + i, next(seq)) for i in range(servers)]
+    owners = [rng.randrange(users) for _ in server_ids]
+    pick_server = _zipf_picker(rng, servers, skew)
+    pick_user = _zipf_picker(rng, users, skew)
+
+    members = [{owner} for owner in owners]
+    for user_index in range(users):
+        for _ in range(min(servers, 1 + int(rng.expovariate(1 / 2)))):
+            members[pick_server()].add(user_index)
+    members = [list(m) for m in members]
+
+    channels = []
+    for index, server_id in enumerate(server_ids):
+        for number in range(1 + rng.randrange(channels_per_server)):
+            channel_type = 'voice' if number and rng.random() < 0.2 else 'text'
+            channels.append((_snowflake(3, start_ms + index, next(seq)), index, f"channel-{number}", channel_type))
+    text_channels = [c for c in channels if c[3] == 'text']
+    text_channels.sort(key=lambda c: c[1])
+    pick_channel = _zipf_picker(rng, len(text_channels), skew)
+
+    shards = [FcdbWriter(f"{base}.shard{i}", compression_level) for i in range(shard_count)]
+    shard_of_server = [ShardRouter.shard_of(server_id, shard_count) for server_id in server_ids]
+
+    for table_name in ShardRouter.SHARDED_TABLES:
+        for writer in shards:
+            writer.begin_table(table_name)
+        if table_name == 'servers':
+            for index, server_id in enumerate(server_ids):
+                shards[shard_of_server[index]].row({
+                    'name': f"server-{index}", 'server_id': server_id, 'owner_id': user_ids[owners[index]],
+                })
+        elif table_name == 'channels':
+            for channel_id, index, name, channel_type in channels:
+                shards[shard_of_server[index]].row({
+                    'name': name, 'channel_id': channel_id, 'server_id': server_ids[index], 'channel_type': channel_type,
+                })
+        elif table_name == 'members':
+            for index, server_members in enumerate(members):
+                for user_index in server_members:
+                    shards[shard_of_server[index]].row({'server_id': server_ids[index], 'user_id': user_ids[user_index]})
+        elif table_name == 'messages':
+            for i in range(messages):
+                ts_ms = start_ms + (end_ms - start_ms) * i // max(messages, 1)
+                channel_id, index, _, _ = text_channels[pick_channel()]
+                author = rng.choice(members[index])
+                shards[shard_of_server[index]].row({
+                    'message_id': _snowflake(4, ts_ms, next(seq)),
+                    'channel_id': channel_id,
+                    'server_id': server_ids[index],
+                    'author_id': user_ids[author],
+                    'author_name': f"user-{author}",
+                    'content': _content(rng),
+                    'timestamp': ts_ms // 1000,
+                })
+        elif table_name == 'invites':
+            for index, server_id in enumerate(server_ids):
+                shards[shard_of_server[index]].row({
+                    'invite_code': secrets.token_urlsafe(8), 'server_id': server_id, 'creator_id': user_ids[owners[index]],
+                })
+        for writer in shards:
+            writer.end_table()
+
+    pairs = set()
+    while len(pairs) < min(dm_channels, users * (users - 1) // 2):
+        a, b = pick_user(), pick_user()
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    dm_list = [(_snowflake(5, start_ms + i, next(seq)), lo, hi) for i, (lo, hi) in enumerate(sorted(pairs))]
+
+    global_writer = FcdbWriter(f"{base}.global", compression_level)
+    for table_name in GLOBAL_TABLES:
+        global_writer.begin_table(table_name)
+        if table_name == 'users':
+            for index, user_id in enumerate(user_ids):
+                global_writer.row({
+                    'username': f"user-{index}",
+                    'hashed_passwd': secrets.token_hex(32),
+                    'user_token': f"FCT_{secrets.token_urlsafe(84)}",
+                    'user_id': user_id,
+                })
+        elif table_name == 'dm_channels':
+            for dm_channel_id, lo, hi in dm_list:
+                global_writer.row({'dm_channel_id': dm_channel_id, 'user1_id': user_ids[lo], 'user2_id': user_ids[hi]})
+        elif table_name == 'dm_messages' and dm_list:
+            pick_dm = _zipf_picker(rng, len(dm_list), skew)
+            for i in range(dm_messages):
+                ts_ms = start_ms + (end_ms - start_ms) * i // max(dm_messages, 1)
+                dm_channel_id, lo, hi = dm_list[pick_dm()]
+                author = lo if rng.random() < 0.5 else hi
+                global_writer.row({
+                    'message_id': _snowflake(6, ts_ms, next(seq)),
+                    'dm_channel_id': dm_channel_id,
+                    'author_id': user_ids[author],
+                    'author_name': f"user-{author}",
+                    'content': _content(rng),
+                    'timestamp': ts_ms // 1000,
+                })
+        global_writer.end_table()
+
+    writers = [global_writer, *shards]
+    for writer in writers:
+        writer.close()
+
+    return {
+        'path': base,
+        'users': users,
+        'servers': servers,
+        'channels': len(channels),
+        'members': sum(len(m) for m in members),
+        'messages': messages,
+        'dm_channels': len(dm_list),
+        'dm_messages': dm_messages if dm_list else 0,
+        'rows': sum(w.rows for w in writers),
+        'bytes': sum(os.path.getsize(w.path) for w in writers),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Freecord dataset in the layout main.py uses")
+    parser.add_argument('path', help="database path prefix, e.g. bench/freecord_data")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--servers', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=500000)
+    parser.add_argument('--dm-channels', type=int, default=5000)
+    parser.add_argument('--dm-messages', type=int, default=100000)
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--skew', type=float, default=1.1, help="zipf exponent for server, channel and DM activity")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directory = os.path.dirname(args.path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    stats = generate(args.path, args.users, args.servers, args.messages, args.dm_channels, args.dm_messages,
+                     args.shards, days=args.days, seed=args.seed, skew=args.skew)
+    print(json.dumps(stats, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.database import Database
+
+def migrate(path: str, storage_format: str = 'binary', compression_level: int = 6, keep_backup: bool = True) -> dict:
+    with open(path, 'rb') as f:
+        data = f.read()
+    started = time.perf_counter()
+    tables = Database.decode_file(data)
+    converted = Database.encode_file(tables, storage_format, compression_level)
+    if Database.decode_file(converted) != tables:
+        raise ValueError(f"{path}: converted file does not read back the same rows")
+
+    if keep_backup:
+        with open(path + '.bak', 'wb') as f:
+            f.write(data)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(converted)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return {
+        'path': path,
+        'rows': sum(len(rows) for rows in tables.values()),
+        'bytes_before': len(data),
+        'bytes_after': len(converted),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .fcdb files between the json and binary storage formats")
+    parser.add_argument('paths', nargs='*', help="files to convert, defaults to every .fcdb in the current directory")
+    parser.add_argument('--to', choices=('binary', 'json'), default='binary')
+    parser.add_argument('--level', type=int, choices=range(0, 10), default=6, metavar='0-9', help="zlib level")
+    parser.add_argument('--no-backup', action='store_true', help="do not keep the original as <file>.bak")
+    args = parser.parse_args()
+
+    # stop the server first, it rewrites its files from memory on every save
+    paths = args.paths or sorted(glob.glob('*.fcdb'))
+    for path in paths:
+        print(json.dumps(migrate(path, args.to, args.level, not args.no_backup)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.database import Database, ShardRouter, DatabaseEvents as DBEvents
+from tools.benchmark import _percentiles
+
+TABLES = ('users', 'servers', 'channels', 'members', 'messages', 'invites', 'dm_channels', 'dm_messages', 'read_states',
+          'attachment_refs')
+# relative weight of each operation in the threaded workload
+THREAD_MIX = {
+    'send_message': 30,
+    'send_dm': 15,
+    'get_messages': 25,
+    'get_dm_messages': 10,
+    'edit_message': 8,
+    'delete_message': 5,
+    'join_server': 4,
+    'add_user': 3,
+}
+CRASH_MIX = {'send_message': 5, 'send_dm': 2, 'edit_message': 2, 'delete_message': 1}
+CRASH_MODES = ('before_replace', 'after_replace', 'sigkill')
+# exit code of a child that crashed itself at an injected point
+CRASH_EXIT_CODE = 99
+DELETED = None
+
+def _open(path: str, shard_count: int, storage_format: str) -> ShardRouter.ShardedFreecordDB:
+    db = ShardRouter.ShardedFreecordDB(path, shard_count, storage_format=storage_format)
+    for table_name in TABLES:
+        if not db.exists_table(table_name):
+            db.create_table(table_name)
+    return db
+
+def _expect_ok(result: tuple, what: str):
+    success, message, data = result
+    if not success:
+        raise RuntimeError(f"{what}: {message}")
+    return data
+
+def populate(db: ShardRouter.ShardedFreecordDB, users: int, servers: int, contested_servers: int, max_uses: int) -> dict:
+    tokens, user_ids = [], []
+    for i in range(users):
+        _expect_ok(DBEvents.add_user(f"stress-{i}", "x", db), "add_user")
+        login = db.select('users', {'username': f"stress-{i}"})[0]
+        tokens.append(login['user_token'])
+        user_ids.append(login['user_id'])
+
+    channels, invites = [], []
+    for i in range(servers + contested_servers):
+        server_id = _expect_ok(DBEvents.add_server(f"server-{i}", tokens[0], db), "add_server")['server_id']
+        channel_id = _expect_ok(DBEvents.add_channel("general", server_id, tokens[0], 'text', db),
+                                "add_channel")['channel_id']
+        if i < servers:
+            invite = _expect_ok(DBEvents.create_invite(server_id, tokens[0], db), "create_invite")
+            for token in tokens[1:]:
+                _expect_ok(DBEvents.join_server(invite['invite_code'], token, db), "join_server")
+            channels.append(channel_id)
+        else:
+            invite = _expect_ok(DBEvents.create_invite(server_id, tokens[0], db, max_uses=max_uses), "create_invite")
+            invites.append({'invite_code': invite['invite_code'], 'max_uses': max_uses})
+    return {'tokens': tokens, 'user_ids': user_ids, 'channels': channels, 'invites': invites}
+
+def check_invariants(db: ShardRouter.ShardedFreecordDB) -> list[str]:
+    problems = []
+    for part in db._all_dbs():
+        for table_name, rows in part.tables.items():
+            where = f"{part.stream_source}.{table_name}"
+            ids = [row['id'] for row in rows]
+            if any(a >= b for a, b in zip(ids, ids[1:])):
+                problems.append(f"{where}: row ids are not strictly increasing")
+            if ids and part.next_ids.get(table_name, 0) <= ids[-1]:
+                problems.append(f"{where}: next id {part.next_ids.get(table_name)} would reuse row id {ids[-1]}")
+            tombstones = sum(Database.TOMBSTONE in row for row in rows)
+            if tombstones != part.tombstones.get(table_name, 0):
+                problems.append(f"{where}: {tombstones} tombstones but {part.tombstones.get(table_name, 0)} counted")
+            for column in part._index_columns.get(table_name, ()):
+                expected = {(row[column], row['id']) for row in rows if Database.TOMBSTONE not in row and column in row}
+                indexed = {(value, row_id) for value, bucket in part._indexes[(table_name, column)].items()
+                           for row_id in bucket}
+                if expected != indexed:
+                    problems.append(f"{where}: index on {column} is off by {len(expected ^ indexed)} entries")
+
+    def unique(table_name: str, *columns: str) -> None:
+        seen = set()
+        for row in db.select(table_name, None):
+            key = tuple(row.get(c) for c in columns)
+            if key in seen:
+                problems.append(f"{table_name}: duplicate {'/'.join(columns)} {key}")
+            seen.add(key)
+
+    unique('users', 'username')
+    unique('users', 'user_id')
+    unique('messages', 'message_id')
+    unique('dm_messages', 'message_id')
+    unique('dm_channels', 'dm_channel_id')
+    unique('dm_channels', 'user1_id', 'user2_id')
+    unique('members', 'server_id', 'user_id')
+
+    for invite in db.select('invites', None):
+        if invite.get('max_uses') is not None and invite['uses'] >= invite['max_uses']:
+            problems.append(f"invites: {invite['invite_code']} used {invite['uses']} of {invite['max_uses']} times")
+    for table_name, channel_id in list(db.hot_tail._tails):
+        cached = db.hot_tail.latest(table_name, channel_id, db.hot_tail.capacity) or []
+        live = db.select(table_name, {ShardRouter.CHANNEL_KEYS[table_name]: channel_id})[-len(cached):] if cached else []
+        if [(m['message_id'], m['content']) for m in cached] != [(m['message_id'], m['content']) for m in live]:
+            problems.append(f"hot tail: cached rows of {table_name} {channel_id} differ from the table")
+    channel_ids = {c['channel_id'] for c in db.select('channels', None)}
+    for message in db.select('messages', None):
+        if message['channel_id'] not in channel_ids:
+            problems.append(f"messages: {message['message_id']} points at missing channel {message['channel_id']}")
+    return problems
+
+def check_messages(db: ShardRouter.ShardedFreecordDB, expected: dict) -> list[str]:
+    # expected maps (table, message id) to the set of contents it may have, None meaning deleted
+    problems = []
+    for (table_name, message_id), allowed in expected.items():
+        rows = db.select(table_name, {'message_id': message_id})
+        actual = rows[0]['content'] if rows else DELETED
+        if actual not in allowed:
+            problems.append(f"{table_name}: {message_id} is {actual!r}, expected one of {sorted(allowed, key=str)}")
+    return problems
+
+class Worker(threading.Thread):
+    def __init__(self, index: int, db: ShardRouter.ShardedFreecordDB, fixture: dict, ops: int, seed: int):
+        super().__init__(name=f"stress-{index}", daemon=True)
+        self.db = db
+        self.fixture = fixture
+        self.ops = ops
+        self.rng = random.Random(seed * 1000 + index)
+        self.token = fixture['tokens'][index % len(fixture['tokens'])]
+        self.user_id = fixture['user_ids'][index % len(fixture['user_ids'])]
+        # message id -> (table, channel_id or other user id, current content)
+        self.sent: dict[int, tuple[str, int, str | None]] = {}
+        self.joins: dict[str, int] = {}
+        self.errors: list[str] = []
+        self.latencies: dict[str, list[float]] = {name: [] for name in THREAD_MIX}
+
+    def _other_user(self) -> int:
+        return self.rng.choice([u for u in self.fixture['user_ids'] if u != self.user_id])
+
+    def _own_message(self) -> tuple[int, tuple] | None:
+        alive = [item for item in self.sent.items() if item[1][2] is not DELETED]
+        return self.rng.choice(alive) if alive else None
+
+    def _locate(self, table_name: str, target: int) -> dict:
+        return {'channel_id': target} if table_name == 'messages' else {'other_user_id': target}
+
+    def step(self, op: str) -> None:
+        db, rng, token = self.db, self.rng, self.token
+        if op == 'send_message':
+            channel_id = rng.choice(self.fixture['channels'])
+            content = f"m{rng.getrandbits(32)}"
+            data = _expect_ok(DBEvents.send_message(channel_id, token, content, db), op)
+            self.sent[data['message_id']] = ('messages', channel_id, content)
+        elif op == 'send_dm':
+            other = self._other_user()
+            content = f"d{rng.getrandbits(32)}"
+            data = _expect_ok(DBEvents.send_dm(other, token, content, db), op)
+            self.sent[data['message_id']] = ('dm_messages', other, content)
+        elif op == 'get_messages':
+            channel_id = rng.choice(self.fixture['channels'])
+            page = _expect_ok(DBEvents.get_messages(channel_id, token, db), op)
+            if any(a['message_id'] >= b['message_id'] for a, b in zip(page, page[1:])):
+                raise RuntimeError(f"{op}: page of {channel_id} is out of order")
+        elif op == 'get_dm_messages':
+            success, message, _ = DBEvents.get_dm_messages(self._other_user(), token, db)
+            if not success and message != "DM channel not found":
+                raise RuntimeError(f"{op}: {message}")
+        elif op in ('edit_message', 'delete_message'):
+            own = self._own_message()
+            if own is None:
+                return
+            message_id, (table_name, target, _) = own
+            if op == 'edit_message':
+                content = f"e{rng.getrandbits(32)}"
+                _expect_ok(DBEvents.edit_message(message_id, content, token, db, **self._locate(table_name, target)), op)
+            else:
+                content = DELETED
+                _expect_ok(DBEvents.delete_message(message_id, token, db, **self._locate(table_name, target)), op)
+            self.sent[message_id] = (table_name, target, content)
+        elif op == 'join_server':
+            invite = rng.choice(self.fixture['invites'])
+            success, message, _ = DBEvents.join_server(invite['invite_code'], token, db)
+            if success:
+                self.joins[invite['invite_code']] = self.joins.get(invite['invite_code'], 0) + 1
+            elif message not in ("Invalid invite code", "You are already a member of this server"):
+                raise RuntimeError(f"{op}: {message}")
+        elif op == 'add_user':
+            # a small pool of names, so threads race to register the same one
+            DBEvents.add_user(f"contested-{rng.randrange(8)}", "x", db)
+
+    def run(self) -> None:
+        names, weights = list(THREAD_MIX), list(THREAD_MIX.values())
+        for _ in range(self.ops):
+            op = self.rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                self.step(op)
+            except Exception as e:
+                self.errors.append(f"{op}: {type(e).__name__}: {e}")
+            self.latencies[op].append(time.perf_counter() - started)
+
+def _maintain(db: ShardRouter.ShardedFreecordDB, interval: float, stop: threading.Event, errors: list) -> None:
+    # compaction and checkpoints rewrite whole files while the workers keep writing
+    while not stop.wait(interval):
+        try:
+            db.compact()
+            db.checkpoint()
+        except Exception as e:
+            errors.append(f"maintenance: {type(e).__name__}: {e}")
+
+def run_threads(workdir: str, threads: int, ops: int, shard_count: int, storage_format: str, seed: int,
+                maintenance_interval: float) -> dict:
+    path = os.path.join(workdir, "threads", "freecord_data")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = _open(path, shard_count, storage_format)
+    fixture = populate(db, users=max(threads, 2), servers=4, contested_servers=2, max_uses=max(1, threads // 2))
+
+    workers = [Worker(i, db, fixture, ops, seed) for i in range(threads)]
+    stop, maintenance_errors = threading.Event(), []
+    maintenance = threading.Thread(target=_maintain, args=(db, maintenance_interval, stop, maintenance_errors), daemon=True)
+    started = time.perf_counter()
+    maintenance.start()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    maintenance.join()
+
+    errors = maintenance_errors + [error for worker in workers for error in worker.errors]
+    problems = check_invariants(db)
+    joins: dict[str, int] = {}
+    for worker in workers:
+        for code, count in worker.joins.items():
+            joins[code] = joins.get(code, 0) + count
+    for invite in fixture['invites']:
+        if joins.get(invite['invite_code'], 0) > invite['max_uses']:
+            problems.append(f"invites: {invite['invite_code']} accepted {joins[invite['invite_code']]} joins, "
+                            f"max_uses is {invite['max_uses']}")
+    expected = {(table_name, message_id): {content}
+                for worker in workers for message_id, (table_name, _, content) in worker.sent.items()}
+    problems += check_messages(db, expected)
+    db.close()
+
+    started_reopen = time.perf_counter()
+    reopened = _open(path, shard_count, storage_format)
+    reopen_s = time.perf_counter() - started_reopen
+    problems += [f"after restart: {p}" for p in check_invariants(reopened) + check_messages(reopened, expected)]
+    reopened.close()
+
+    latencies = {op: [s for worker in workers for s in worker.latencies[op]] for op in THREAD_MIX}
+    total_ops = sum(len(samples) for samples in latencies.values())
+    return {
+        'threads': threads,
+        'ops': total_ops,
+        'elapsed_s': round(elapsed, 3),
+        'ops_per_s': round(total_ops / elapsed, 1),
+        'reopen_s': round(reopen_s, 3),
+        'messages_checked': len(expected),
+        'errors': errors,
+        'violations': problems,
+        'queries': {op: _percentiles(samples) for op, samples in latencies.items() if samples},
+    }
+
+def _append_ack(ack_file, entry: dict) -> None:
+    ack_file.write(json.dumps(entry) + '\n')
+    ack_file.flush()
+    os.fsync(ack_file.fileno())
+
+def _crash_child(path: str, shard_count: int, storage_format: str, fixture: dict, ack_path: str, mode: str,
+                 crash_after: int, ops: int, seed: int, ready) -> None:
+    real_replace, real_save = os.replace, Database.FreecordDB.save
+    replaces = 0
+    log_pending = False
+
+    def tracking_save(self):
+        # only saves that have logged changes to fold in are counted, those are the ones a misordered save can lose
+        nonlocal log_pending
+        log_pending = os.path.exists(self.log_path)
+        try:
+            real_save(self)
+        finally:
+            log_pending = False
+
+    def crashing_replace(src, dst):
+        # every FreecordDB.save ends in os.replace(tmp, file) followed by removing the log
+        nonlocal replaces
+        if not log_pending:
+            return real_replace(src, dst)
+        replaces += 1
+        if replaces == crash_after and mode == 'before_replace':
+            os._exit(CRASH_EXIT_CODE)
+        real_replace(src, dst)
+        if replaces == crash_after and mode == 'after_replace':
+            os._exit(CRASH_EXIT_CODE)
+
+    db = _open(path, shard_count, storage_format)
+    rng = random.Random(seed)
+    tokens = dict(zip(fixture['user_ids'], fixture['tokens']))
+    own: dict[int, list] = {user_id: [] for user_id in tokens}
+    for channel_id in fixture['channels']:
+        for m in db.select('messages', {'channel_id': channel_id}):
+            own[m['author_id']].append(('messages', m['message_id'], {'channel_id': channel_id}))
+    for c in db.select('dm_channels', None):
+        for m in db.select('dm_messages', {'dm_channel_id': c['dm_channel_id']}):
+            other = c['user2_id'] if m['author_id'] == c['user1_id'] else c['user1_id']
+            own[m['author_id']].append(('dm_messages', m['message_id'], {'other_user_id': other}))
+
+    if mode != 'sigkill':
+        Database.FreecordDB.save = tracking_save
+        os.replace = crashing_replace
+    names, weights = list(CRASH_MIX), list(CRASH_MIX.values())
+    with open(ack_path, 'a') as ack_file:
+        ready.set()
+        # a SIGKILL writer keeps going until it is killed, so it never finishes before the signal lands
+        for n in itertools.count():
+            if n >= ops + 20 and mode != 'sigkill':
+                break
+            if n < ops or mode == 'sigkill':
+                op = rng.choices(names, weights)[0]
+                user_id = rng.choice(fixture['user_ids'])
+            else:
+                # the random point was never reached, so an edit leaves a log pending and its save crashes
+                crash_after = replaces + 1
+                authors = [u for u in fixture['user_ids'] if own[u]]
+                op = 'edit_message' if authors else 'send_message'
+                user_id = rng.choice(authors or fixture['user_ids'])
+            token = tokens[user_id]
+            if op == 'send_message':
+                channel_id = rng.choice(fixture['channels'])
+                content = f"m{rng.getrandbits(32)}"
+                data = _expect_ok(DBEvents.send_message(channel_id, token, content, db), op)
+                own[user_id].append(('messages', data['message_id'], {'channel_id': channel_id}))
+                _append_ack(ack_file, {'op': 'send', 'table': 'messages', 'id': data['message_id'], 'content': content})
+            elif op == 'send_dm':
+                other = rng.choice([u for u in fixture['user_ids'] if u != user_id])
+                content = f"d{rng.getrandbits(32)}"
+                data = _expect_ok(DBEvents.send_dm(other, token, content, db), op)
+                own[user_id].append(('dm_messages', data['message_id'], {'other_user_id': other}))
+                _append_ack(ack_file, {'op': 'send', 'table': 'dm_messages', 'id': data['message_id'], 'content': content})
+            elif own[user_id]:
+                table_name, message_id, target = rng.choice(own[user_id])
+                content = f"e{rng.getrandbits(32)}" if op == 'edit_message' else DELETED
+                entry = {'table': table_name, 'id': message_id, 'content': content}
+                # the intent is logged first, so a crash mid-operation allows either outcome
+                _append_ack(ack_file, {'op': 'intent', **entry})
+                if op == 'edit_message':
+                    _expect_ok(DBEvents.edit_message(message_id, content, token, db, **target), op)
+                else:
+                    _expect_ok(DBEvents.delete_message(message_id, token, db, **target), op)
+                    own[user_id].remove((table_name, message_id, target))
+                _append_ack(ack_file, {'op': 'ack', **entry})
+            if n >= ops and mode != 'sigkill':
+                db.save()
+    os._exit(0)
+
+def _apply_acks(expected: dict, ack_path: str, offset: int) -> int:
+    with open(ack_path) as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            entry = json.loads(line)
+            offset += len(line.encode())
+            key = (entry['table'], entry['id'])
+            if entry['op'] == 'send':
+                expected[key] = {entry['content']}
+            elif entry['op'] == 'intent':
+                expected[key] = expected[key] | {entry['content']}
+            else:
+                expected[key] = {entry['content']}
+    return offset
+
+def run_crashes(workdir: str, crashes: int, ops: int, shard_count: int, storage_format: str, seed: int) -> dict:
+    path = os.path.join(workdir, "crash", "freecord_data")
+    ack_path = os.path.join(workdir, "crash", "acks.jsonl")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = _open(path, shard_count, storage_format)
+    fixture = populate(db, users=4, servers=shard_count * 2, contested_servers=0, max_uses=1)
+    db.close()
+    open(ack_path, 'w').close()
+
+    ctx = multiprocessing.get_context('spawn')
+    rng = random.Random(seed)
+    expected: dict = {}
+    offset = 0
+    runs, problems = [], []
+    for i in range(crashes):
+        mode = CRASH_MODES[i % len(CRASH_MODES)]
+        ready = ctx.Event()
+        process = ctx.Process(target=_crash_child, args=(path, shard_count, storage_format, fixture, ack_path, mode,
+                                                         rng.randint(1, 10), ops, seed + i, ready))
+        process.start()
+        if mode == 'sigkill':
+            ready.wait()
+            time.sleep(rng.uniform(0.01, 0.5))
+            process.kill()
+        process.join()
+
+        offset = _apply_acks(expected, ack_path, offset)
+        started = time.perf_counter()
+        try:
+            db = _open(path, shard_count, storage_format)
+        except Exception as e:
+            problems.append(f"run {i} ({mode}): database does not open: {e}")
+            break
+        recovery_s = time.perf_counter() - started
+        found = [f"run {i} ({mode}): {p}" for p in check_invariants(db) + check_messages(db, expected)]
+        if process.exitcode not in (0, CRASH_EXIT_CODE, -9):
+            found.append(f"run {i} ({mode}): writer failed with exit code {process.exitcode}")
+        problems += found
+        # whatever survived is the starting point for the next run, including sends that finished but were never acked
+        survived = {(table_name, m['message_id']): {m['content']}
+                    for table_name in ('messages', 'dm_messages') for m in db.select(table_name, None)}
+        expected = {key: survived.get(key, {DELETED}) for key in expected.keys() | survived.keys()}
+        db.close()
+        runs.append({'mode': mode, 'exitcode': process.exitcode, 'recovery_s': round(recovery_s, 3),
+                     'messages': len(expected), 'violations': len(found)})
+        print(f"crash {i + 1}/{crashes} {mode}: exit {process.exitcode}, {len(found)} violations", file=sys.stderr)
+
+    return {
+        'crashes': len(runs),
+        'injected': sum(run['exitcode'] in (CRASH_EXIT_CODE, -9) for run in runs),
+        'messages_checked': len(expected),
+        'recovery_s_max': max((run['recovery_s'] for run in runs), default=0),
+        'runs': runs,
+        'violations': problems,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer DatabaseEvents from many threads, crash writers mid-save "
+                                                 "and check invariants and durability after restart")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=300, help="operations per thread")
+    parser.add_argument('--crashes', type=int, default=12, help="crashed writer processes, 0 to skip")
+    parser.add_argument('--crash-ops', type=int, default=200, help="operations a writer process runs before exiting")
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--storage-format', choices=('binary', 'json'), default='binary')
+    parser.add_argument('--maintenance-interval', type=float, default=0.2,
+                        help="seconds between compact and checkpoint runs during the threaded phase")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help="where databases are created, defaults to a temp dir")
+    parser.add_argument('--output', default='stress_results.json')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='freecord-stress-')
+    try:
+        print(f"threads: {args.threads} x {args.ops} ops", file=sys.stderr)
+        threaded = run_threads(workdir, args.threads, args.ops, args.shards, args.storage_format, args.seed,
+                               args.maintenance_interval)
+        crashed = run_crashes(workdir, args.crashes, args.crash_ops, args.shards, args.storage_format, args.seed) \
+            if args.crashes else None
+    except Exception:
+        traceback.print_exc()
+        sys.exit(2)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'shards': args.shards,
+        'storage_format': args.storage_format,
+        'threads': threaded,
+        'crashes': crashed,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    # a writer that exits cleanly tested nothing, so every run has to have crashed
+    failed = threaded['errors'] or threaded['violations'] or \
+        (crashed and (crashed['violations'] or crashed['injected'] < crashed['crashes']))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()